@@ -0,0 +1,256 @@
+from concurrent.futures import ProcessPoolExecutor
+from benchmarks.syntheticBackend import SyntheticBackend, SyntheticDate
+from helpers.geeApi import PrecorsiaGee
+from helpers.imageCorrelator import ImageCorrelator
+from helpers.imageProcessor import ImageProcessor
+from helpers.precorsiaFilter import PrecorsiaFilter
+from helpers.temporalJoin import TemporalJoin
+from helpers.lagSearch import LagSearch
+import multiprocessing
+import subprocess
+import contextlib
+import statistics
+import argparse
+import platform
+import resource
+import tempfile
+import shutil
+import time
+import json
+import sys
+import os
+
+START_DATE = '2020-01-01'
+START_MS = 1577836800000
+REFERENCE = 'SYNTHETIC/REFERENCE'
+COMPARABLE = 'SYNTHETIC/COMPARABLE'
+
+DEFAULTS = {
+    'images': 240, 'cadence_days': 5, 'nodata_fraction': 0.2, 'tile_size': 256, 'lag_days': 12, 'latency': 0.0,
+    'round_factor': 9, 'tile_format': 'png', 'concurrency': 4, 'repeats': 3, 'seed': 0
+}
+
+def configuration(params):
+    """
+    @brief Builds a PrecorsiaFilter configuration served by a SyntheticBackend.
+    @param params A dictionary of benchmark parameters, see DEFAULTS.
+    @return Returns the configuration dictionary.
+    """
+    backend = SyntheticBackend(START_MS, image_count=params['images'], cadence_days={REFERENCE: params['cadence_days']},
+                               nodata_fraction=params['nodata_fraction'], tile_size=params['tile_size'],
+                               lag_days=params['lag_days'], latency=params['latency'], seed=params['seed'])
+    gee = type('SyntheticGee', (PrecorsiaGee,), {'backend': backend, 'date_daily': staticmethod(SyntheticDate.daily)})
+    return {
+        "climate": "synthetic", "start_date": START_DATE, "days": params['images'] * max(1, params['cadence_days']),
+        "geolocation": [0.0, 0.0], "image_scale": 5120, "round_factor": params['round_factor'],
+        "reference_dataset": REFERENCE, "reference_band_name": 'value', "reference_band_range": [0, 1], "reference_band_unit": 'u',
+        "comparable_dataset": COMPARABLE, "comparable_band_name": 'value', "comparable_band_range": [0, 1], "comparable_band_unit": 'u',
+        "gee": gee, "imageCorrelator": ImageCorrelator, "imageProcessor": ImageProcessor,
+        "download_concurrency": params['concurrency'], "tile_format": params['tile_format']
+    }
+
+def until(precorsia, stage):
+    """
+    @brief Runs the stages of a PrecorsiaFilter that come before a stage.
+    @param precorsia The PrecorsiaFilter instance.
+    @param stage The name of the stage: 'list', 'download', 'filter' or 'correlate'.
+    """
+    precorsia.prepare()
+    for _name in ('list', 'download', 'filter', 'correlate'):
+        if _name == stage:
+            return
+        getattr(precorsia, f'{_name}_stage')()
+
+def bench_list(precorsia):
+    until(precorsia, 'list')
+    yield
+    precorsia.list_stage()
+    yield len(precorsia.gds_one_list) + len(precorsia.gds_two_list)
+
+def bench_list_cached(precorsia):
+    until(precorsia, 'download')
+    yield
+    precorsia.list_stage()
+    yield len(precorsia.gds_one_list) + len(precorsia.gds_two_list)
+
+def bench_join(precorsia):
+    precorsia.prepare()
+    _one = precorsia.gds_one.list(precorsia.geolocation, [precorsia.START, precorsia.END])
+    _two = precorsia.gds_two.list(precorsia.geolocation, [precorsia.START, precorsia.END])
+    yield
+    TemporalJoin.buckets(_one, _two, 10**precorsia.round_factor)
+    yield len(_one) + len(_two)
+
+def bench_download(precorsia):
+    until(precorsia, 'download')
+    yield
+    precorsia.download_stage()
+    yield len(precorsia.gds_one_list) + len(precorsia.gds_two_list)
+
+def bench_reduce(precorsia):
+    precorsia.mode = 'reduce'
+    yield from bench_download(precorsia)
+
+def bench_filter(precorsia):
+    until(precorsia, 'filter')
+    yield
+    precorsia.filter_stage()
+    yield len(precorsia.gds_one_list) + len(precorsia.gds_two_list)
+
+def bench_correlation(precorsia):
+    until(precorsia, 'correlate')
+    _join = TemporalJoin.buckets(precorsia.gds_one_lz, precorsia.gds_two_lz, 10**precorsia.round_factor)
+    _tiles = ({_img['id']: _img['path'] for _img in precorsia.gds_one_lz}, {_img['id']: _img['path'] for _img in precorsia.gds_two_lz})
+    yield
+    ImageCorrelator(_join.pairs, tiles=_tiles).calculate_correlation()
+    yield sum(len(_one) + len(_two) for _one, _two in _join.pairs)
+
+def bench_lag_search(precorsia):
+    _backend = precorsia.gee.backend
+    _one = _backend.synthetic_images(REFERENCE, None)
+    _two = _backend.synthetic_images(COMPARABLE, None)
+    _values = [[_backend.synthetic_pixels(f'{_dataset}/{_img["id"]}', None)[-1, :8].mean() for _img in _list]
+               for _dataset, _list in ((REFERENCE, _one), (COMPARABLE, _two))]
+    yield
+    LagSearch().search(TemporalJoin.times(_one), _values[0], TemporalJoin.times(_two), _values[1])
+    yield len(_one) + len(_two)
+
+def bench_correlate_stage(precorsia):
+    until(precorsia, 'correlate')
+    yield
+    precorsia.correlate_stage()
+    yield len(precorsia.corr_list)
+
+def bench_execute(precorsia):
+    yield
+    precorsia.execute()
+    yield len(precorsia.gds_one_list) + len(precorsia.gds_two_list)
+
+BENCHMARKS = {
+    'list': bench_list, 'list_cached': bench_list_cached, 'join': bench_join, 'download': bench_download,
+    'reduce': bench_reduce, 'filter': bench_filter, 'correlation': bench_correlation, 'lag_search': bench_lag_search,
+    'correlate_stage': bench_correlate_stage, 'execute': bench_execute
+}
+
+def peak_rss_mb():
+    """
+    @brief Gives the peak resident memory of the current process.
+    @return Returns the peak in megabytes.
+    """
+    _peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return _peak / 2**20 if sys.platform == 'darwin' else _peak / 2**10
+
+def run_benchmark(name, params):
+    """
+    @brief Runs the repeats of one benchmark. Executed in a fresh worker process, so its peak memory is its own.
+    Every repeat starts from an empty working directory: caches, indexes and outputs are cold.
+    @param name The name of the benchmark, a key of BENCHMARKS.
+    @param params A dictionary of benchmark parameters, see DEFAULTS.
+    @return Returns a dictionary with the measures of the benchmark.
+    """
+    _cwd = os.getcwd()
+    _latencies, _items = [], 0
+    for _ in range(params['repeats']):
+        _dir = tempfile.mkdtemp(prefix='precorsia-bench-')
+        try:
+            os.chdir(_dir)
+            os.makedirs('data')
+            _precorsia = PrecorsiaFilter(configuration(params))
+            _bench = BENCHMARKS[name](_precorsia)
+            with open(os.devnull, 'w') as _null, contextlib.redirect_stdout(_null):
+                next(_bench)
+                _start = time.perf_counter()
+                _items = next(_bench)
+                _latencies.append(time.perf_counter() - _start)
+        finally:
+            os.chdir(_cwd)
+            shutil.rmtree(_dir, ignore_errors=True)
+
+    _median = statistics.median(_latencies)
+    return {
+        'name': name, 'items': _items, 'repeats': len(_latencies),
+        'latency_s': {'min': min(_latencies), 'median': _median, 'max': max(_latencies)},
+        'throughput_items_s': _items / _median if _median > 0 else None,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+def commit():
+    """
+    @brief Gives the current git commit, to tell benchmark results apart.
+    @return Returns the short commit hash, or None outside a git checkout.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(names, params):
+    """
+    @brief Runs benchmarks, each one in its own process.
+    @param names A list of benchmark names.
+    @param params A dictionary of benchmark parameters, see DEFAULTS.
+    @return Returns the report as a JSON serialisable dictionary.
+    """
+    results = []
+    for _name in names:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results.append(executor.submit(run_benchmark, _name, params).result())
+        print(f"{_name}: {results[-1]['latency_s']['median']:.4f} s, {results[-1]['throughput_items_s'] or 0:.1f} items/s, "
+              f"{results[-1]['peak_rss_mb']:.0f} MB", file=sys.stderr)
+
+    return {'commit': commit(), 'created': time.time(), 'python': platform.python_version(),
+            'machine': platform.machine(), 'params': params, 'results': results}
+
+def compare(report, baseline, threshold=0.1):
+    """
+    @brief Compares the median latencies of a report with a baseline report.
+    @param report The report of the current run.
+    @param baseline The report of a previous run.
+    @param threshold (Optional) The relative slowdown flagged as a regression. Default is 0.1.
+    @return Returns a list of dictionaries with 'name', 'ratio' (current / baseline) and 'regression' keys.
+    """
+    _baseline = {_r['name']: _r for _r in baseline['results']}
+    _rows = []
+    for _result in report['results']:
+        if _result['name'] in _baseline:
+            _ratio = _result['latency_s']['median'] / _baseline[_result['name']]['latency_s']['median']
+            _rows.append({'name': _result['name'], 'ratio': _ratio, 'regression': _ratio > 1 + threshold})
+    return _rows
+
+def main(argv=None):
+    """
+    @brief Command line entry point. Run from the repository root with `python -m benchmarks.pipelineBenchmark`.
+    @param argv (Optional) The command line arguments. Default is None, sys.argv.
+    @return Returns the exit status: 1 when a regression against the baseline was found, 0 otherwise.
+    """
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the PRECORSIA pipeline on synthetic data.')
+    parser.add_argument('benchmarks', nargs='*', help=f'Benchmarks to run, among {", ".join(BENCHMARKS)}. Default is all.')
+    for _key, _value in DEFAULTS.items():
+        parser.add_argument(f'--{_key.replace("_", "-")}', type=type(_value), default=_value)
+    parser.add_argument('--output', help='Path of the JSON report. Default is the standard output.')
+    parser.add_argument('--baseline', help='Path of a previous JSON report to compare with.')
+    args = parser.parse_args(argv)
+    _unknown = [_name for _name in args.benchmarks if _name not in BENCHMARKS]
+    if _unknown:
+        parser.error(f'unknown benchmarks: {", ".join(_unknown)}')
+
+    params = {_key: getattr(args, _key) for _key in DEFAULTS}
+    report = run(args.benchmarks or list(BENCHMARKS), params)
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as file:
+            report['comparison'] = compare(report, json.load(file))
+        for _row in report['comparison']:
+            print(f"{_row['name']}: x{_row['ratio']:.2f}{' REGRESSION' if _row['regression'] else ''}", file=sys.stderr)
+        status = int(any(_row['regression'] for _row in report['comparison']))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,128 @@
+from helpers.geeBackend import LocalBackend
+import numpy as np
+import time
+import zlib
+
+DAY_MS = 86400000
+
+class SyntheticNumber:
+
+    def __init__(self, number):
+        """
+        @brief Client side stand-in for an ee.Number, as read by PrecorsiaFilter when naming its outputs.
+        @param number The value of the number.
+        """
+        self._number = number
+
+
+class SyntheticDate:
+
+    def __init__(self, args):
+        """
+        @brief Client side stand-in for an ee.Date, carrying the same 'args' as the dates built by PrecorsiaGee.date_daily.
+        @param args A dictionary with either a 'value' key, or 'date', 'delta' and 'unit' keys.
+        """
+        self.args = args
+
+    @staticmethod
+    def daily(start, interval):
+        """
+        @brief Builds the dates of a daily interval without the Earth Engine client, like PrecorsiaGee.date_daily.
+        @param start A string representing the start date in the format 'YYYY-MM-DD'.
+        @param interval An integer representing the number of days to include in the interval.
+        @return Returns a tuple of SyntheticDate objects representing the start and end dates of the interval.
+        """
+        _start = SyntheticDate({'value': start})
+        return _start, SyntheticDate({'date': _start, 'delta': SyntheticNumber(interval), 'unit': 'day'})
+
+
+class SyntheticBackend(LocalBackend):
+
+    def __init__(self, start_ms, image_count=365, cadence_days=None, nodata_fraction=0.2, tile_size=512, lag_days=12, latency=0.0, seed=0):
+        """
+        @brief Constructor for the SyntheticBackend class, a deterministic offline stand-in for Earth Engine.
+        Every dataset is a collection of images whose mean follows a yearly cycle, shifted by lag_days for datasets whose
+        name contains 'COMPARABLE', so the lag search has a known answer. Pixels and listings only depend on the parameters,
+        the dataset and the image ID, so two runs with the same parameters see the same data.
+        @param start_ms The time in milliseconds of the first image of every dataset.
+        @param image_count (Optional) The number of images of each dataset. Default is 365.
+        @param cadence_days (Optional) A dictionary mapping dataset IDs to their revisit time in days. Unlisted datasets are daily. Default is None.
+        @param nodata_fraction (Optional) The mean proportion of nodata pixels of an image. Default is 0.2.
+        @param tile_size (Optional) The largest side in pixels of the generated noise, see synthetic_pixels. Default is 512.
+        @param lag_days (Optional) The shift in days between the reference and the comparable signals. Default is 12.
+        @param latency (Optional) The time in seconds added to every backend call, to mimic the network. Default is 0.
+        @param seed (Optional) The seed of the generated data. Default is 0.
+        """
+        super().__init__(self.synthetic_pixels, images=self.synthetic_images)
+        self.start_ms = start_ms
+        self.image_count = image_count
+        self.cadence_days = cadence_days or {}
+        self.nodata_fraction = nodata_fraction
+        self.tile_size = tile_size
+        self.lag_days = lag_days
+        self.latency = latency
+        self.seed = seed
+
+    def rng(self, name):
+        """
+        @brief Creates the random generator of an asset, independent of the interpreter hash seed.
+        @param name A string identifying the asset.
+        @return Returns a numpy Generator.
+        """
+        return np.random.default_rng([self.seed, zlib.crc32(name.encode())])
+
+    def synthetic_images(self, dataset, geolocation):
+        """
+        @brief Lists the images of a synthetic dataset.
+        @param dataset The ID of the dataset.
+        @param geolocation A tuple containing the longitude and latitude of the location, ignored.
+        @return Returns a list of dictionaries with 'id' and 'time_start' keys.
+        """
+        _cadence = self.cadence_days.get(dataset, 1)
+        _offset = int(self.rng(dataset).integers(0, 6)) * 3600000
+        return [{'id': f'{_i:06d}', 'time_start': self.start_ms + int(_i * _cadence * DAY_MS) + _offset}
+                for _i in range(self.image_count)]
+
+    def synthetic_pixels(self, asset_id, request):
+        """
+        @brief Generates the band values of an image over the grid of a request.
+        The noise is drawn at most tile_size pixels per side and repeated up to the dimensions of the grid, so large
+        footprints stay cheap to generate. Every window of a mosaic draws its own noise and nodata rows.
+        @param asset_id The full asset ID of the image.
+        @param request The computePixels request, a request with a 'grid' key as built by LocalBackend.reduce, or None
+        for a tile_size square.
+        @return Returns a numpy array with the height and width of the grid and values in [0, 1]. NaN marks nodata pixels.
+        """
+        _dataset, _, _id = asset_id.rpartition('/')
+        if request is None:
+            _height = _width = self.tile_size
+            _rng = self.rng(asset_id)
+        else:
+            _grid = request['grid']
+            _height, _width = _grid['dimensions']['height'], _grid['dimensions']['width']
+            _rng = self.rng(f"{asset_id}@{_grid['affineTransform']['translateX']},{_grid['affineTransform']['translateY']}")
+        _day = int(_id) * self.cadence_days.get(_dataset, 1) - (self.lag_days if 'COMPARABLE' in _dataset else 0)
+        _level = 0.5 + 0.3 * np.sin(2 * np.pi * _day / 365.25)
+
+        _shape = (min(_height, self.tile_size), min(_width, self.tile_size))
+        _values = np.clip(_level + 0.1 * _rng.standard_normal(_shape), 0, 1)
+        _rows = int(round(min(1.0, _rng.uniform(0, 2 * self.nodata_fraction)) * _shape[0]))
+        _values[:_rows] = np.nan
+        return _values[np.ix_(np.arange(_height) * _shape[0] // _height, np.arange(_width) * _shape[1] // _width)]
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def list_images(self, dataset, geolocation, start_ms, end_ms, page_size=1000, margin=0):
+        for _page in super().list_images(dataset, geolocation, start_ms, end_ms, page_size, margin):
+            self.wait()
+            yield _page
+
+    def computePixels(self, request):
+        self.wait()
+        return super().computePixels(request)
+
+    def reduce(self, asset_ids, band, grid):
+        self.wait()
+        return super().reduce(asset_ids, band, grid)
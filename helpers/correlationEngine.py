@@ -0,0 +1,258 @@
+# Importing data processing tools
+from helpers.precorsiaFilter import PrecorsiaFilter
+from helpers.lagSearch import LagSearch, LagResult, DAY_MS
+from helpers.temporalJoin import TemporalJoin
+from helpers.tileFormat import read_tile, tile_mean
+from helpers.resultsStore import ResultsStore
+import numpy as np
+import json
+import os
+
+class CorrelationEngine(PrecorsiaFilter):
+
+    EXPECTED_KEYS = [
+        "climate", "start_date", "days", "geolocation", "image_scale", "round_factor",
+        "reference_dataset", "reference_band_name", "reference_band_range", "reference_band_unit",
+        "comparables", "gee", "imageProcessor"
+    ]
+    COMPARABLE_KEYS = ("dataset", "band_name", "band_range", "band_unit")
+
+    def __init__(self, configuration):
+        """
+        @brief Constructor for the CorrelationEngine class, which correlates one reference dataset with N comparable datasets at a location.
+        The reference is listed and downloaded once, every series is placed on one shared time axis and the lag curves of
+        all the comparables are computed in a single vectorized pass. The settings, metrics, catalogue and download stage are
+        those of PrecorsiaFilter.
+        @param configuration A dictionary with the keys of a PrecorsiaFilter configuration, where the comparable_* keys are
+        replaced by a 'comparables' list of dictionaries with 'dataset', 'band_name', 'band_range' and 'band_unit' keys.
+        An optional 'max_lag_days' key bounds the lag search.
+        @throws TypeError If the configuration is not a dictionary.
+        @throws ValueError If keys are missing from the configuration or from a comparable, or if incremental runs or pixel maps are requested.
+        """
+        self.check(configuration)
+
+        for comparable in configuration["comparables"]:
+            missing_keys = [key for key in self.COMPARABLE_KEYS if key not in comparable]
+            if missing_keys:
+                raise ValueError(f"Missing keys in comparable {comparable.get('dataset')}: {missing_keys}")
+
+        self.reference = {"dataset": configuration["reference_dataset"], "band_name": configuration["reference_band_name"],
+                          "band_range": configuration["reference_band_range"], "band_unit": configuration["reference_band_unit"]}
+        self.comparables = [{_key: _comparable[_key] for _key in self.COMPARABLE_KEYS} for _comparable in configuration["comparables"]]
+
+        self.configure(configuration)
+        self.max_lag_days = configuration.get("max_lag_days", None)
+
+        if self.incremental or self.pixel_maps:
+            raise ValueError("The correlation engine does not support incremental runs or pixel maps, use PrecorsiaFilter.")
+
+    def metric_labels(self):
+        """
+        @brief Gives the labels of the metrics of the study, with every comparable dataset.
+        @return Returns a dictionary.
+        """
+        return {'reference_dataset': self.reference["dataset"], 'comparable_dataset': ','.join(_c["dataset"] for _c in self.comparables),
+                'climate': self.climate, 'longitude': self.geolocation[0], 'latitude': self.geolocation[1]}
+
+    @property
+    def series(self):
+        """
+        @brief Lists the reference followed by the comparables.
+        @return Returns a list of dictionaries, one per dataset.
+        """
+        return [self.reference] + self.comparables
+
+    def execute(self):
+        """
+        @brief Runs every stage of the study: listing, download, zero counting filter, averaging and correlation.
+        The tile cache is trimmed to its max_bytes once the run is over.
+        @return Returns the path of the JSON file with the correlation matrix.
+        """
+        self.prepare()
+        self.timed('list', self.list_stage)
+        self.timed('download', self.download_stage)
+        self.timed('filter', self.filter_stage)
+        self.timed('average', self.average_stage)
+        file_name = self.timed('correlate', self.correlate_stage)
+        self.store_results(file_name)
+        self.export_metrics()
+        if self.tile_cache is not None:
+            self.tile_cache.evict()
+        return file_name
+
+    def create_datasets(self):
+        """
+        @brief Creates the PrecorsiaGee object of each dataset.
+        """
+        for _series in self.series:
+            _series["gds"] = self.gee(_series["dataset"], _series["band_range"], file_format=self.tile_format, metrics=self.metrics)
+
+    def list_stage(self):
+        """
+        @brief Lists the images of every dataset. Each comparable keeps the images matching a reference date and the
+        reference images matching one of its dates, as a PrecorsiaFilter run of the pair does. The reference keeps the
+        images matching a date of any comparable.
+        """
+        _reference = self.reference["gds"].list(self.geolocation, [self.START, self.END], catalog=self.image_catalog)
+        _matched = np.zeros(len(_reference), dtype=bool)
+        _times = TemporalJoin.times(_reference) // 10**self.round_factor
+
+        for _comparable in self.comparables:
+            _list = _comparable["gds"].list(self.geolocation, [self.START, self.END], catalog=self.image_catalog)
+            _join = TemporalJoin.buckets(_reference, _list, 10**self.round_factor)
+            _comparable["list"] = _join.two
+            _comparable["reference_list"] = _join.one
+            _matched |= np.isin(_times, TemporalJoin.times(_join.two) // 10**self.round_factor)
+
+        self.reference["list"] = TemporalJoin.select(_reference, _matched)
+        self.metrics.count('images_matched', sum(len(_series["list"]) for _series in self.series))
+
+    def downloads(self):
+        """
+        @brief Lists what the download stage fetches, the reference only once.
+        @return Returns a list of tuples with the PrecorsiaGee object, the image list and the band name of each dataset.
+        """
+        return [(_series["gds"], _series["list"], _series["band_name"]) for _series in self.series]
+
+    def filter_stage(self):
+        """
+        @brief Runs the zero counting filter over the images of every comparable and over the reference images matching it.
+        The reference is filtered once per comparable because the gap fill depends on the best images of the series, so
+        each pair is filtered exactly as a PrecorsiaFilter run of the pair would; the statistics index and the shared
+        gap-filled copies keep the repeated passes cheap.
+        In 'reduce' mode there are no tiles to gap-fill, so the images are only discarded by their proportion of nodata pixels.
+        """
+        process = self.imageProcessor([], stats=self.tile_stats, filled_dir=os.path.join(self.buffer_dir, 'filled'), cache=self.tile_cache)
+        _filter = process.discard_images if self.mode == 'reduce' else process.filter_series
+        for _comparable in self.comparables:
+            _comparable["reference_lz"] = _filter(_comparable["reference_list"])
+            _comparable["lz"] = _filter(_comparable["list"])
+        self.metrics.count('images_kept', sum(len(_c["reference_lz"]) + len(_c["lz"]) for _c in self.comparables))
+
+    def image_means(self, image_list):
+        """
+        @brief Gives the average value of every image of a list, as ImageCorrelator.calculate_correlation does.
+        @param image_list A list of filtered images, with 'path' keys, or 'mean' keys in 'reduce' mode.
+        @return Returns a numpy array with one average per image.
+        """
+        if self.mode == 'reduce':
+            return np.array([np.nan if _img['mean'] is None else _img['mean'] for _img in image_list], dtype=float)
+        _paths = [_img['path'] for _img in image_list]
+        if self.tile_stats is not None:
+            return self.tile_stats.column(_paths, 'mean')
+        return np.array([tile_mean(read_tile(_path)) for _path in _paths], dtype=float)
+
+    def average(self, image_list, band_range):
+        """
+        @brief Averages the images of a series per time bucket, scaled as PrecorsiaFilter.correlate_stage scales its averages.
+        @param image_list A list of filtered images.
+        @param band_range A tuple containing the minimum and maximum band values of the dataset.
+        @return Returns a dictionary with 'times' (bucket starts in milliseconds), 'values' (bucket averages) and 'ids' (image IDs per bucket).
+        """
+        _bucket_ms = 10**self.round_factor
+        _unique, _inverse = np.unique(TemporalJoin.times(image_list) // _bucket_ms, return_inverse=True)
+        _means = self.image_means(image_list)
+
+        _series = {"times": _unique * _bucket_ms, "ids": [[] for _ in _unique]}
+        _series["values"] = np.bincount(_inverse, weights=_means, minlength=len(_unique)) / np.bincount(_inverse, minlength=len(_unique))
+        if self.tile_format != 'raw' and self.mode != 'reduce':
+            _series["values"] = _series["values"] * (band_range[1] / 255)
+        for _img, _index in zip(image_list, _inverse):
+            _series["ids"][_index].append(_img['id'])
+        return _series
+
+    def average_stage(self):
+        """
+        @brief Averages the images of every comparable, and the reference images filtered with it, per time bucket.
+        Each comparable receives 'times', 'values' and 'ids' keys, and a 'reference' dictionary with the same keys, see average.
+        """
+        for _comparable in self.comparables:
+            _comparable["reference"] = self.average(_comparable["reference_lz"], self.reference["band_range"])
+            _comparable.update(self.average(_comparable["lz"], _comparable["band_range"]))
+
+    def common(self, comparable):
+        """
+        @brief Finds the time buckets shared by a comparable and the reference filtered with it.
+        @param comparable A dictionary of the comparables list, after the average stage.
+        @return Returns a tuple with the common bucket starts and their indices in the reference and comparable series.
+        """
+        return np.intersect1d(comparable["reference"]["times"], comparable["times"], return_indices=True)
+
+    def correlate_stage(self):
+        """
+        @brief Computes the lag curves of every comparable against the reference in one pass and saves the correlation matrix.
+        Each comparable is compared with the reference on their common time buckets, as PrecorsiaFilter does for a single
+        pair, and all the pairs share one time grid. With one comparable the grid is the one of a PrecorsiaFilter run, and
+        the results are the same up to floating point rounding. With several, the grid spans the pairs of every comparable,
+        so without a max_lag_days the searched lags, a quarter of the grid, may reach further than in a run of the pair.
+        @return Returns the path of the JSON file with the correlation matrix.
+        @throws ValueError If no comparable has a pair left after filtering.
+        """
+        _pairs = [self.common(_c) for _c in self.comparables]
+        if not any(len(_times) for _times, _, _ in _pairs):
+            raise ValueError(f"No pairs of images left to correlate with {self.reference['dataset']} after filtering.")
+
+        self.lag_search = LagSearch(step_days=max(1, 10**self.round_factor / DAY_MS), max_lag_days=self.max_lag_days)
+        _origin, _length = self.lag_search.grid(*[_times for _times, _, _ in _pairs if len(_times)])
+
+        _x = np.stack([self.lag_search.resample(_times, _c["reference"]["values"][_i], _origin, _length)
+                       for _c, (_times, _i, _) in zip(self.comparables, _pairs)])
+        _y = np.stack([self.lag_search.resample(_times, _c["values"][_j], _origin, _length)
+                       for _c, (_times, _, _j) in zip(self.comparables, _pairs)])
+        _max_lag = None if self.max_lag_days is None else int(self.max_lag_days // self.lag_search.step_days)
+        _lags, _corr, _counts = self.lag_search.correlate(_x, _y, _max_lag)
+        self.lag_result = LagResult(_lags, _corr, _counts, _x, _y, self.lag_search.step_days)
+        self.best_shifts = [float(_s) for _s in self.lag_result.best_lag_days]
+        self.best_corrs = [float(_c) for _c in self.lag_result.best_corr]
+
+        for _comparable, _shift, _corr in zip(self.comparables, self.best_shifts, self.best_corrs):
+            print(f"{_comparable['dataset']}: Best shift: {_shift} days, Best correlation: {_corr}")
+
+        data = {"reference_dataset": self.reference["dataset"]}
+        data["comparable_datasets"] = [_c["dataset"] for _c in self.comparables]
+        data["best_correlation"] = self.best_corrs
+        data["best_shift"] = self.best_shifts
+        data["lags_days"] = [float(_l) for _l in self.lag_result.lags_days]
+        data["correlation"] = [[None if np.isnan(_c) else float(_c) for _c in _row] for _row in self.lag_result.corr]
+        data["counts"] = self.lag_result.counts.tolist()
+        file_name = f'data/corr_matrix_{self.reference["dataset"].replace("/", "_")}_{self.climate}_{self.geolocation[0]}_{self.geolocation[1]}_{self.START.args.get("value")}_{self.END.args.get("delta")._number}.json'
+        with open(file_name, 'w') as file:
+            json.dump(data, file)
+
+        return file_name
+
+    def pairs(self, comparable):
+        """
+        @brief Lists the time buckets shared by the reference and a comparable, with their image IDs and averages.
+        @param comparable A dictionary of the comparables list, after the average stage.
+        @return Returns a list of dictionaries with the keys of ResultsStore.PAIR_COLUMNS, without 'run_id' and 'pair_index'.
+        """
+        _reference = comparable["reference"]
+        return [{'time_start': int(_time), 'reference_ids': _reference["ids"][_i], 'comparable_ids': comparable["ids"][_j],
+                 'reference_value': float(_reference["values"][_i]), 'comparable_value': float(comparable["values"][_j])}
+                for _time, _i, _j in zip(*self.common(comparable))]
+
+    def store_results(self, file_name):
+        """
+        @brief Appends one run per comparable, with its pairs, to the results store. The stage timings and the metrics are
+        those of the whole engine run, shared by its comparables.
+        @param file_name The path of the JSON file with the correlation matrix.
+        @return Returns the list of the run_id of each comparable.
+        """
+        _timings = {f'{_name}_seconds': _seconds for _name, _seconds in self.metrics.timings().items()
+                    if f'{_name}_seconds' in ResultsStore.RUN_COLUMNS}
+        _metrics = json.dumps(self.metrics.to_dict()['stages'])
+
+        self.run_ids = []
+        for _comparable, _shift, _corr in zip(self.comparables, self.best_shifts, self.best_corrs):
+            _pairs = self.pairs(_comparable)
+            run = {
+                'reference_dataset': self.reference["dataset"], 'comparable_dataset': _comparable["dataset"], 'climate': self.climate,
+                'longitude': float(self.geolocation[0]), 'latitude': float(self.geolocation[1]), 'start_date': str(self.start_date),
+                'days': int(self.days), 'image_scale': self.image_scale, 'pixel_scale': self.pixel_scale, 'round_factor': self.round_factor,
+                'mode': self.mode, 'best_correlation': _corr, 'best_shift': _shift, 'n_pairs': len(_pairs), 'file_name': file_name,
+                'metrics': _metrics
+            }
+            run.update(_timings)
+            self.run_ids.append(self.results_store.add_run(run, _pairs))
+        return self.run_ids
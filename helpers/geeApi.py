@@ -1,23 +1,57 @@
-import matplotlib.pyplot as plt
-from PIL import Image
-import numpy as np
-import time
-import os
-import io
+from helpers.tileDownloader import TileDownloader
+from helpers.geeBackend import EarthEngineBackend, parse_time
+from helpers.imageCatalog import ImageCatalog
+from helpers.tileFormat import EXTENSIONS, MASK_BAND, create_tile, decode_pixels, write_tile
+from helpers.tileCache import TileCache
+from helpers.temporalJoin import TemporalJoin
+import contextlib
+import threading
+import weakref
+import copy
 import ee
 
 class PrecorsiaGee:
 
-    def __init__(self, dataset, band_range, margin=50):
+    backend = EarthEngineBackend()
+    metrics = None
+    _grids = weakref.WeakKeyDictionary()
+    _grids_lock = threading.Lock()
+
+    def __init__(self, dataset, band_range, margin=50, backend=None, file_format='png', metrics=None):
         """
         @brief Constructor for the class.
         @param dataset The ID of the dataset to use.
         @param band_range A tuple containing the minimum and maximum band values to include in the images.
-        @param margin (Optional) The margin to use when creating the bounding box for the image search. Default is 50.
+        @param margin (Optional) The half side in meters of the bounding box of the image search around the location. Default is 50.
+        @param backend (Optional) The object serving projections and pixels. Default is the shared EarthEngineBackend.
+        @param file_format (Optional) The storage format of the tiles: 'png', 'uint8' or 'raw' (see helpers.tileFormat). Default is 'png'.
+        @param metrics (Optional) A Metrics object counting the network calls, bytes and cache hits. Default is None.
         """
         self.dataset = dataset
         self.band_range = band_range
         self.margin = margin
+        self.file_format = file_format
+        if backend is not None:
+            self.backend = backend
+        if metrics is not None:
+            self.metrics = metrics
+
+    def count(self, name, value=1):
+        """
+        @brief Increments a counter of the metrics, if any.
+        @param name The name of the counter.
+        @param value (Optional) The increment. Default is 1.
+        """
+        if self.metrics is not None:
+            self.metrics.count(name, value)
+
+    def timer(self, name):
+        """
+        @brief Times a block in the metrics, if any.
+        @param name The name of the timed operation.
+        @return Returns a context manager.
+        """
+        return self.metrics.timer(name) if self.metrics is not None else contextlib.nullcontext()
 
     @staticmethod
     def init():
@@ -52,105 +86,361 @@ class PrecorsiaGee:
         END = START.advance(interval, 'day')
         return START, END
 
-    def list(self, geolocation, dateset):
+    @staticmethod
+    def date_ms(date):
+        """
+        @brief Converts a date to milliseconds since the epoch, without a server round trip when possible.
+        Dates built by date_daily are resolved on the client; any other ee.Date is evaluated on the server.
+        @param date An ee.Date object, a string in the format 'YYYY-MM-DD' or a number of milliseconds.
+        @return Returns the date in milliseconds.
+        """
+        _units = {'second': 1000, 'minute': 60000, 'hour': 3600000, 'day': 86400000, 'week': 604800000}
+        date = getattr(date, '_number', getattr(date, '_string', date))
+
+        if isinstance(date, (int, float)):
+            return int(date)
+        if isinstance(date, str):
+            try:
+                return parse_time(date + 'T00:00:00Z' if len(date) == 10 else date)
+            except ValueError:
+                return int(ee.Date(date).millis().getInfo())
+
+        _args = getattr(date, 'args', None) or {}
+        if 'value' in _args:
+            return PrecorsiaGee.date_ms(_args['value'])
+        _unit = getattr(_args.get('unit'), '_string', _args.get('unit'))
+        if {'date', 'delta'} <= set(_args) and _unit in _units and _args.get('timeZone') is None:
+            _delta = getattr(_args['delta'], '_number', _args['delta'])
+            if isinstance(_delta, (int, float)):
+                return PrecorsiaGee.date_ms(_args['date']) + int(_delta * _units[_unit])
+        return int(date.millis().getInfo())
+
+    def list(self, geolocation, dateset, catalog=None):
         """
         @brief Fetches a list of images from a specific dataset that match the given geolocation and date range.
+        The listing is streamed page by page. With a catalogue, only the dates it does not cover yet are requested.
         @param geolocation A tuple containing the longitude and latitude of the location.
         @param dateset A tuple containing the START and END ee object dates for the image search.
-        @return Returns a list of images. Each image is represented as a dictionary with 'id' and 'time_start' keys.
+        @param catalog (Optional) The ImageCatalog remembering previous listings. Default is None, everything is listed.
+        @return Returns a list of images in time order. Each image is represented as a dictionary with 'id' and 'time_start' keys.
         @throws Exception If no images are found, an exception is raised.
         """
-        _filter = ee.Filter.And(
-            ee.Filter.bounds(ee.Geometry.Point(geolocation, 'EPSG:4326'), self.margin),
-            ee.Filter.date(dateset[0], dateset[1])
-        )
+        _start, _end = PrecorsiaGee.date_ms(dateset[0]), PrecorsiaGee.date_ms(dateset[1])
+
+        if catalog is None:
+            _image_list = [_img for _page in self.pages(geolocation, _start, _end) for _img in _page]
+            _image_list.sort(key=lambda img: (img['time_start'], img['id']))
+        else:
+            _footprint = ImageCatalog.footprint(geolocation, self.margin)
+            _missing = catalog.missing(self.dataset, _footprint, _start, _end)
+            self.count('catalog_hits' if not _missing else 'catalog_misses')
+            for _missing_start, _missing_end in _missing:
+                for _page in self.pages(geolocation, _missing_start, _missing_end):
+                    catalog.add(self.dataset, _footprint, _page)
+                catalog.cover(self.dataset, _footprint, _missing_start, _missing_end)
+            _image_list = catalog.entries(self.dataset, _footprint, _start, _end)
 
-        _image_collection = ee.ImageCollection(self.dataset).filter(_filter)
-        _image_list = _image_collection.toList(0xffff)
+        self.count('images_listed', len(_image_list))
 
-        if _image_list.size().getInfo() == 0:
+        if len(_image_list) == 0:
             raise Exception('No images found')
-        
-        _image_list = _image_list.map(lambda img: ee.Dictionary(
-            {'id': ee.Image(img).id(), 'time_start': ee.Image(img).get('system:time_start')})).getInfo()
 
         return _image_list
 
-    def request(self, image, bands, geolocation, scale=5120):
+    def pages(self, geolocation, start_ms, end_ms):
         """
-        @brief Generates a request for a specific image from the dataset.
-        @param image The ID of the image to request.
-        @param bands A list of band IDs to include in the request.
+        @brief Streams the listing of the dataset from the backend, counting and timing every page.
+        @param geolocation A tuple containing the longitude and latitude of the location.
+        @param start_ms The start of the date range in milliseconds.
+        @param end_ms The end of the date range in milliseconds, exclusive.
+        @return Yields lists of dictionaries with 'id' and 'time_start' keys.
+        """
+        _pages = self.backend.list_images(self.dataset, geolocation, start_ms, end_ms, margin=self.margin)
+        while True:
+            with self.timer('list_page'):
+                _page = next(_pages, None)
+            if _page is None:
+                return
+            yield _page
+
+    def grid(self, geolocation, scale=5120, size=512):
+        """
+        @brief Builds the pixel grid of a request, computing it only once per backend, scale, size and geolocation.
+        The grids are cached per backend object and dropped with it.
         @param geolocation A tuple containing the longitude and latitude of the location.
         @param scale (Optional) The scale in meters of the side of the square in meters.
-        @return Returns a dictionary containing the request parameters.
+        @param size (Optional) The side of the square in pixels. Default is 512.
+        @return Returns a dictionary describing the grid, as expected by computePixels.
         """
-        _proj = ee.Projection('EPSG:4326').atScale(scale/512).getInfo()
-        _scale_x = _proj['transform'][0]
-        _scale_y = _proj['transform'][4]
+        _key = (scale, size, tuple(geolocation))
+        with self._grids_lock:
+            _grid = self._grids.get(self.backend, {}).get(_key)
 
-        return {
-            'expression': ee.Image(self.dataset + '/' + image),
-            'fileFormat': 'PNG',
-            'bandIds': bands,
-            'grid': {
+        if _grid is None:
+            _proj = self.backend.projection('EPSG:4326', scale/size)
+            _grid = {
                 'dimensions': {
-                    'width': 512,
-                    'height': 512
+                    'width': size,
+                    'height': size
                 },
                 'affineTransform': {
-                    'scaleX': _scale_x,
+                    'scaleX': _proj['transform'][0],
                     'shearX': 0,
                     'translateX': geolocation[0],
-                    'scaleY': _scale_y,
+                    'scaleY': _proj['transform'][4],
                     'shearY': 0,
                     'translateY': geolocation[1]
                 },
                 'crsCode': _proj['crs']
-            },
+            }
+            with self._grids_lock:
+                self._grids.setdefault(self.backend, {})[_key] = _grid
+
+        return copy.deepcopy(_grid)
+
+    @staticmethod
+    def mosaic_size(scale, pixel_scale):
+        """
+        @brief Gives the side in pixels of a footprint fetched at a given pixel size.
+        @param scale The scale in meters of the side of the square in meters.
+        @param pixel_scale The size in meters of one pixel, e.g. 10 for Sentinel-2.
+        @return Returns an integer.
+        """
+        return max(1, int(round(scale / pixel_scale)))
+
+    @staticmethod
+    def windows(size, tile_size=512):
+        """
+        @brief Splits a square grid into tiles small enough for a single computePixels call.
+        @param size The side of the grid in pixels.
+        @param tile_size (Optional) The largest side of a tile in pixels. Default is 512.
+        @return Returns a list of (row, column, height, width) tuples, in pixels of the grid.
+        """
+        return [(_row, _col, min(tile_size, size - _row), min(tile_size, size - _col))
+                for _row in range(0, size, tile_size) for _col in range(0, size, tile_size)]
+
+    @staticmethod
+    def window_grid(grid, window):
+        """
+        @brief Restricts a grid to one of its tiles.
+        @param grid A dictionary describing the grid, as built by grid.
+        @param window A (row, column, height, width) tuple, as built by windows.
+        @return Returns a dictionary describing the grid of the tile.
+        """
+        _row, _col, _height, _width = window
+        _transform = grid['affineTransform']
+        _transform['translateX'] += _col * _transform['scaleX']
+        _transform['translateY'] += _row * _transform['scaleY']
+        grid['dimensions'] = {'width': _width, 'height': _height}
+        return grid
+
+    def request(self, image, bands, geolocation, scale=5120, size=512, window=None):
+        """
+        @brief Generates a request for a specific image from the dataset.
+        @param image The ID of the image to request.
+        @param bands A list of band IDs to include in the request.
+        @param geolocation A tuple containing the longitude and latitude of the location.
+        @param scale (Optional) The scale in meters of the side of the square in meters.
+        @param size (Optional) The side of the square in pixels. Default is 512.
+        @param window (Optional) A (row, column, height, width) tuple restricting the request to a tile of the square. Default is None, the whole square.
+        @return Returns a dictionary containing the request parameters.
+        """
+        _grid = self.grid(geolocation, scale, size)
+        if window is not None:
+            _grid = PrecorsiaGee.window_grid(_grid, window)
+
+        if self.file_format == 'raw':
+            return {
+                'expression': self.backend.expression(self.dataset + '/' + image, raw_band=bands[0]),
+                'fileFormat': 'NPY',
+                'bandIds': [bands[0], MASK_BAND],
+                'grid': _grid
+            }
+
+        return {
+            'expression': self.backend.expression(self.dataset + '/' + image),
+            'fileFormat': 'PNG',
+            'bandIds': bands,
+            'grid': _grid,
             'visualizationOptions':  {'ranges': [{'min': self.band_range[0], 'max': self.band_range[1]}], 'paletteColors': ['010101', 'ffffff']},
         }
 
-    def image(self, image, bands, geolocation, scale):
+    def image(self, image, bands, geolocation, scale, size=512, window=None):
         """
         @brief Fetches a specific image from the dataset and converts it to a grayscale numpy array.
         @param image The ID of the image to fetch.
         @param bands A list of band IDs to include in the image.
         @param geolocation A tuple containing the longitude and latitude of the location.
-        @return Returns a numpy array representing the grayscale image.
+        @param size (Optional) The side of the square in pixels. Default is 512.
+        @param window (Optional) A (row, column, height, width) tuple restricting the image to a tile of the square. Default is None, the whole square.
+        @return Returns a numpy array representing the grayscale image, or the float32 band values (NaN for nodata) in the 'raw' format.
         """
-        _image_request = self.request(image, bands, geolocation, scale)
-        _image_data = ee.data.computePixels(_image_request)
-
-        _image_pixels = Image.open(io.BytesIO(_image_data))
-        _image_p_l = _image_pixels.convert('L')
-        _image_array = np.array(_image_p_l)
+        _image_request = self.request(image, bands, geolocation, scale, size, window)
+        with self.timer('compute_pixels'):
+            _image_data = self.backend.computePixels(_image_request)
+        self.count('bytes_downloaded', len(_image_data))
 
-        return _image_array
+        with self.timer('decode'):
+            return decode_pixels(_image_data, self.file_format, bands[0])
     
+    def reduce_images(self, gds_list, band_name, geolocation, image_scale, batch_size=250, concurrency=1, rate=None, retries=3, size=512):
+        """
+        @brief Reduces a list of images to their statistics over the request footprint on the server, without downloading any tile.
+        Each image dictionary receives 'mean' (raw band value, None when no pixel is valid), 'count' (valid pixels) and
+        'zeros' (proportion of nodata pixels, as computed by ImageProcessor.calculate_zeros) keys.
+        @param gds_list A list of dictionaries representing images. Each dictionary should have an 'id' key.
+        @param band_name A string representing the band to reduce.
+        @param geolocation A tuple containing the longitude and latitude of the location.
+        @param image_scale The scale in meters of the side of the square in meters.
+        @param batch_size (Optional) The number of images reduced by each backend call. Default is 250.
+        @param concurrency (Optional) The maximum number of backend calls at the same time. Default is 1.
+        @param rate (Optional) The maximum number of backend calls started per second. Default is None, no limit.
+        @param retries (Optional) The number of times a transient failure is retried, with exponential backoff. Default is 3.
+        @param size (Optional) The side of the footprint in pixels, see mosaic_size. Default is 512.
+        @return Returns gds_list.
+        """
+        _grid = self.grid(geolocation, image_scale, size)
+        _pixels = _grid['dimensions']['width'] * _grid['dimensions']['height']
+        _batches = [gds_list[_i:_i + batch_size] for _i in range(0, len(gds_list), batch_size)]
+
+        def reduce(batch):
+            with self.timer('reduce'):
+                return self.backend.reduce([self.dataset + '/' + _img['id'] for _img in batch], band_name, _grid)
+
+        downloader = TileDownloader(concurrency, rate, retries, is_transient=self.backend.is_transient)
+        for _batch, _stats in zip(_batches, downloader.map(reduce, _batches, label=self.dataset)):
+            for _img, _stat in zip(_batch, _stats):
+                _img['mean'] = _stat['mean']
+                _img['count'] = _stat['count']
+                _img['zeros'] = 1 - _stat['count'] / _pixels
+        self.count('images_reduced', len(gds_list))
+        return gds_list
+
     @staticmethod
-    def download_images(gds_list, gds_object, band_name, geolocation, image_scale):
+    def download_images(gds_list, gds_object, band_name, geolocation, image_scale, concurrency=1, rate=None, retries=3, cache=None, stats=None):
         """
         @brief Downloads a list of images from the Google Earth Engine servers.
+        Each downloaded image dictionary receives a 'path' key pointing to its tile in the cache.
         @param gds_list A list of dictionaries representing images. Each dictionary should have an 'id' key.
         @param gds_object An instance of the PrecorsiaGee class.
         @param band_name A string representing the band to include in the image.
         @param geolocation A tuple containing the longitude and latitude of the location.
         @param image_scale The scale in meters of the side of the square in meters.
+        @param concurrency (Optional) The maximum number of images downloaded at the same time. Default is 1.
+        @param rate (Optional) The maximum number of requests started per second. Default is None, no limit.
+        @param retries (Optional) The number of times a transient failure is retried, with exponential backoff. Default is 3.
+        @param cache (Optional) The TileCache storing the images. Default is a TileCache in './buffer/'.
+        @param stats (Optional) A TileStats index filled with the statistics of every new tile. Default is None.
         """
-        gds_list_len = len(gds_list)
-        start_time = time.time()
+        cache = cache if cache is not None else TileCache()
 
-        for i, id in enumerate(gds_list):
-            filename = f'./buffer/{id["id"]}.png'
-            if not os.path.exists(filename):
+        def fetch(id):
+            key = TileCache.key(gds_object.dataset, id['id'], band_name, geolocation, image_scale, gds_object.band_range,
+                                gds_object.file_format)
+            filename = cache.get(key)
+            gds_object.count('cache_hits' if filename is not None else 'cache_misses')
+            if filename is None:
                 gds_image = gds_object.image(id['id'], [band_name], geolocation, image_scale)
-                plt.imsave(filename, gds_image, cmap='gray')
+                with gds_object.timer('write_tile'):
+                    filename = cache.put(key, lambda path: write_tile(path, gds_image, raw=gds_object.file_format == 'raw'), EXTENSIONS[gds_object.file_format],
+                                         dataset=gds_object.dataset, image=id['id'])
+                if stats is not None:
+                    stats.record(filename, None if gds_object.file_format == 'png' else gds_image)
+            id['path'] = filename
 
-            elapsed_time = time.time() - start_time
-            estimated_time = elapsed_time / (i+1) * (gds_list_len - i - 1)
-            print(f"\r{gds_object.dataset} Progress: {(i+1)/gds_list_len*100:.2f}% | Estimated time: {estimated_time:.2f}s", end=" "*10)
-        print("\n")
+        downloader = TileDownloader(concurrency, rate, retries, is_transient=gds_object.backend.is_transient)
+        downloader.map(fetch, gds_list, label=gds_object.dataset)
+        gds_object.count('images_requested', len(gds_list))
+
+    @staticmethod
+    def download_mosaics(gds_list, gds_object, band_name, geolocation, image_scale, pixel_scale, tile_size=512, concurrency=1, rate=None,
+                         retries=3, cache=None, stats=None):
+        """
+        @brief Downloads a list of images over a footprint too large for one request, at a given pixel size.
+        The footprint of each image is split into tiles of at most tile_size pixels, fetched concurrently and written in
+        place into a memory-mapped .npy mosaic, so no mosaic is ever held in memory. Mosaics are written one after the
+        other, leaving at most one partial file at a time, and the downloader prints the progress of each one. Each image
+        dictionary receives a 'path' key pointing to its mosaic.
+        @param gds_list A list of dictionaries representing images. Each dictionary should have an 'id' key.
+        @param gds_object An instance of the PrecorsiaGee class, using the 'uint8' or 'raw' format.
+        @param band_name A string representing the band to include in the image.
+        @param geolocation A tuple containing the longitude and latitude of the location.
+        @param image_scale The scale in meters of the side of the square in meters.
+        @param pixel_scale The size in meters of one pixel of the mosaics.
+        @param tile_size (Optional) The largest side in pixels of a request. Default is 512.
+        @param concurrency (Optional) The maximum number of tiles downloaded at the same time. Default is 1.
+        @param rate (Optional) The maximum number of requests started per second. Default is None, no limit.
+        @param retries (Optional) The number of times a transient failure is retried, with exponential backoff. Default is 3.
+        @param cache (Optional) The TileCache storing the mosaics. Default is a TileCache in './buffer/'.
+        @param stats (Optional) A TileStats index filled with the statistics of every new mosaic. Default is None.
+        @throws ValueError If gds_object uses the 'png' format, which cannot be memory-mapped.
+        """
+        if gds_object.file_format == 'png':
+            raise ValueError("Mosaics need the 'uint8' or 'raw' tile format")
+
+        cache = cache if cache is not None else TileCache()
+        _size = PrecorsiaGee.mosaic_size(image_scale, pixel_scale)
+        _windows = PrecorsiaGee.windows(_size, tile_size)
+        _raw = gds_object.file_format == 'raw'
+        downloader = TileDownloader(concurrency, rate, retries, is_transient=gds_object.backend.is_transient)
+
+        def write(image, label, path):
+            _mosaic = create_tile(path, (_size, _size), raw=_raw)
+
+            def fetch(window):
+                _tile = gds_object.image(image['id'], [band_name], geolocation, image_scale, _size, window)
+                with gds_object.timer('write_tile'):
+                    _mosaic[window[0]:window[0] + window[2], window[1]:window[1] + window[3]] = _tile
+
+            downloader.map(fetch, _windows, label=label)
+            _mosaic.flush()
+            del _mosaic
+
+        for _done, _image in enumerate(gds_list):
+            key = TileCache.key(gds_object.dataset, _image['id'], band_name, geolocation, image_scale, gds_object.band_range,
+                                gds_object.file_format, size=_size)
+            filename = cache.get(key)
+            gds_object.count('cache_hits' if filename is not None else 'cache_misses')
+            if filename is None:
+                _label = f"{gds_object.dataset} Mosaic {_done + 1}/{len(gds_list)}"
+                filename = cache.put(key, lambda path: write(_image, _label, path), EXTENSIONS[gds_object.file_format],
+                                     dataset=gds_object.dataset, image=_image['id'])
+                gds_object.count('tiles_requested', len(_windows))
+                if stats is not None:
+                    stats.record(filename)
+            _image['path'] = filename
+
+        gds_object.count('images_requested', len(gds_list))
+
+    def fetch(self, gds_list, band_name, geolocation, image_scale, mode='tiles', pixel_scale=None, tile_size=512, concurrency=1,
+              rate=None, cache=None, stats=None):
+        """
+        @brief Fetches what the filter needs of a list of images of this dataset: their statistics in 'reduce' mode, their
+        mosaics with a pixel_scale, their tiles otherwise.
+        @param gds_list A list of dictionaries representing images. Each dictionary should have an 'id' key.
+        @param band_name A string representing the band to fetch.
+        @param geolocation A tuple containing the longitude and latitude of the location.
+        @param image_scale The scale in meters of the side of the square in meters.
+        @param mode (Optional) 'reduce' to fetch statistics only, anything else to download pixels. Default is 'tiles'.
+        @param pixel_scale (Optional) The size in meters of one pixel, see download_mosaics. Default is None, 512 pixels per side.
+        @param tile_size (Optional) The largest side in pixels of a mosaic request. Default is 512.
+        @param concurrency (Optional) The maximum number of backend calls at the same time. Default is 1.
+        @param rate (Optional) The maximum number of backend calls started per second. Default is None, no limit.
+        @param cache (Optional) The TileCache storing the downloads. Default is a TileCache in './buffer/'.
+        @param stats (Optional) A TileStats index filled with the statistics of every new download. Default is None.
+        @return Returns gds_list.
+        """
+        if mode == 'reduce':
+            _size = 512 if pixel_scale is None else self.mosaic_size(image_scale, pixel_scale)
+            return self.reduce_images(gds_list, band_name, geolocation, image_scale, concurrency=concurrency, rate=rate, size=_size)
+
+        if pixel_scale is not None:
+            self.download_mosaics(gds_list, self, band_name, geolocation, image_scale, pixel_scale, tile_size, concurrency=concurrency,
+                                  rate=rate, cache=cache, stats=stats)
+        else:
+            self.download_images(gds_list, self, band_name, geolocation, image_scale, concurrency=concurrency, rate=rate, cache=cache,
+                                 stats=stats)
+        return gds_list
 
     @staticmethod
     def correlate_dates(list_one, list_two, round_factor):
@@ -161,15 +451,8 @@ class PrecorsiaGee:
         @param round_factor Number of decimal places to filter to zero when rounding the date.
         @return Returns two lists of images. Each list contains the images from the input lists whose 'time_start' values, when rounded, are found in both lists.
         """
-        _one_rounded = [_img['time_start'] // 10**round_factor * 10**round_factor for _img in list_one]
-        _two_rounded = [_img['time_start'] // 10**round_factor * 10**round_factor for _img in list_two]
-
-        _common_rounded = np.intersect1d(_one_rounded, _two_rounded)
-
-        _intersected_list_one = [img for img in list_one if img['time_start'] // 10**round_factor * 10**round_factor in _common_rounded]
-        _intersected_list_two = [img for img in list_two if img['time_start'] // 10**round_factor * 10**round_factor in _common_rounded]
-
-        return _intersected_list_one, _intersected_list_two
+        _join = TemporalJoin.buckets(list_one, list_two, 10**round_factor)
+        return _join.one, _join.two
     
     @staticmethod
     def connected_correlation(list_one, list_two, round_factor):
@@ -180,13 +463,4 @@ class PrecorsiaGee:
         @param round_factor An integer representing the factor by which to round the 'time_start' values.
         @return Returns a list of tuples. Each tuple contains two lists of image IDs from list_one and list_two that fall within the same time interval.
         """
-        _one_rounded = [_img['time_start'] // 10**round_factor * 10**round_factor for _img in list_one]
-        _two_rounded = [_img['time_start'] // 10**round_factor * 10**round_factor for _img in list_two]
-
-        _common_rounded = []
-        for rounded_val in set(_one_rounded).intersection(set(_two_rounded)):
-            one_ids = [img['id'] for img in list_one if img['time_start'] // 10**round_factor * 10**round_factor == rounded_val]
-            two_ids = [img['id'] for img in list_two if img['time_start'] // 10**round_factor * 10**round_factor == rounded_val]
-            _common_rounded.append((one_ids, two_ids))
-
-        return _common_rounded
\ No newline at end of file
+        return TemporalJoin.buckets(list_one, list_two, 10**round_factor).pairs
\ No newline at end of file
@@ -0,0 +1,252 @@
+from helpers.tileFormat import MASK_BAND
+from PIL import Image
+import numpy as np
+import threading
+import datetime
+import math
+import io
+import ee
+
+def iso_time(time_ms):
+    """
+    @brief Formats a time for the Earth Engine REST API.
+    @param time_ms A time in milliseconds since the epoch.
+    @return Returns an ISO 8601 string in UTC.
+    """
+    _time = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(milliseconds=time_ms)
+    return _time.strftime('%Y-%m-%dT%H:%M:%S.') + f'{_time.microsecond // 1000:03d}Z'
+
+def parse_time(text):
+    """
+    @brief Parses a time returned by the Earth Engine REST API.
+    @param text An ISO 8601 string in UTC, e.g. '2015-06-23T10:20:30.123Z'.
+    @return Returns the time in milliseconds since the epoch.
+    """
+    _seconds, _, _fraction = text.rstrip('Z').partition('.')
+    _time = datetime.datetime.strptime(_seconds, '%Y-%m-%dT%H:%M:%S').replace(tzinfo=datetime.timezone.utc)
+    return int(_time.timestamp()) * 1000 + int((_fraction + '000')[:3])
+
+METERS_PER_DEGREE = 111319.49079327357
+
+def search_region(geolocation, margin=0):
+    """
+    @brief Builds the GeoJSON region of an image search around a location.
+    @param geolocation A tuple containing the longitude and latitude of the location.
+    @param margin (Optional) The half side in meters of the square searched around the location. Default is 0, the point only.
+    @return Returns a GeoJSON Point, or a Polygon for a positive margin.
+    """
+    _lon, _lat = float(geolocation[0]), float(geolocation[1])
+    if not margin:
+        return {'type': 'Point', 'coordinates': [_lon, _lat]}
+    _dlat = margin / METERS_PER_DEGREE
+    _dlon = min(180.0, _dlat / max(math.cos(math.radians(_lat)), 1e-6))
+    return {'type': 'Polygon', 'coordinates': [[[_lon - _dlon, _lat - _dlat], [_lon + _dlon, _lat - _dlat], [_lon + _dlon, _lat + _dlat],
+                                                 [_lon - _dlon, _lat + _dlat], [_lon - _dlon, _lat - _dlat]]]}
+
+class EarthEngineBackend:
+    """
+    @brief Backend that forwards every call to the Google Earth Engine servers.
+    PrecorsiaGee talks to the servers only through this interface, so any object
+    exposing the same methods (see LocalBackend) can take its place.
+    """
+
+    TRANSIENT_STATUS = (429, 500, 502, 503, 504)
+    TRANSIENT_MESSAGES = ('too many requests', 'rate limit', 'quota exceeded', 'computation timed out', 'deadline exceeded',
+                          'an internal error has occurred', 'service unavailable', 'backend error')
+
+    def projection(self, crs, scale):
+        """
+        @brief Fetches the projection information for a CRS at a given pixel scale.
+        @param crs A string representing the CRS code, e.g. 'EPSG:4326'.
+        @param scale The size in meters of one pixel.
+        @return Returns a dictionary with 'crs' and 'transform' keys.
+        """
+        return ee.Projection(crs).atScale(scale).getInfo()
+
+    def expression(self, asset_id, raw_band=None):
+        """
+        @brief Builds the image expression for an asset.
+        @param asset_id The full asset ID of the image, e.g. 'GOOGLE/DYNAMICWORLD/V1/<id>'.
+        @param raw_band (Optional) A band to request as raw float values, along with its mask in the MASK_BAND band. Default is None, the whole image.
+        @return Returns the ee.Image object for the asset.
+        """
+        _image = ee.Image(asset_id)
+        if raw_band is None:
+            return _image
+        return _image.select([raw_band]).toFloat().addBands(_image.select([raw_band]).mask().rename(MASK_BAND))
+
+    def computePixels(self, request):
+        """
+        @brief Computes the pixels of an image expression.
+        @param request A dictionary with the computePixels request parameters.
+        @return Returns the encoded image bytes.
+        """
+        return ee.data.computePixels(request)
+
+    def reduce(self, asset_ids, band, grid):
+        """
+        @brief Reduces a batch of images to their statistics over a grid footprint, on the server.
+        @param asset_ids A list with the full asset IDs of the images.
+        @param band A string representing the band to reduce.
+        @param grid A dictionary describing the grid, as built by PrecorsiaGee.grid.
+        @return Returns a list of dictionaries with 'mean' (None when no pixel is valid) and 'count' keys, in the order of asset_ids.
+        """
+        _transform = grid['affineTransform']
+        _crs_transform = [_transform['scaleX'], 0, _transform['translateX'], 0, _transform['scaleY'], _transform['translateY']]
+        _x0, _y0 = _transform['translateX'], _transform['translateY']
+        _x1 = _x0 + _transform['scaleX'] * grid['dimensions']['width']
+        _y1 = _y0 + _transform['scaleY'] * grid['dimensions']['height']
+        _footprint = ee.Geometry.Rectangle([min(_x0, _x1), min(_y0, _y1), max(_x0, _x1), max(_y0, _y1)], grid['crsCode'], False)
+        _reducer = ee.Reducer.mean().combine(ee.Reducer.count(), sharedInputs=True)
+
+        def reduce_image(asset_id):
+            _stats = ee.Image(asset_id).select([band]).reduceRegion(
+                reducer=_reducer, geometry=_footprint, crs=grid['crsCode'], crsTransform=_crs_transform, maxPixels=1e9)
+            return ee.Feature(None, {'mean': _stats.get(f'{band}_mean'), 'count': _stats.get(f'{band}_count')})
+
+        _features = ee.FeatureCollection([reduce_image(_asset) for _asset in asset_ids]).getInfo()['features']
+        return [{'mean': _f['properties'].get('mean'), 'count': _f['properties'].get('count') or 0} for _f in _features]
+
+    def list_images(self, dataset, geolocation, start_ms, end_ms, page_size=1000, margin=0):
+        """
+        @brief Lists the images of a dataset covering a location, one page at a time.
+        @param dataset The ID of the dataset.
+        @param geolocation A tuple containing the longitude and latitude of the location.
+        @param start_ms The start of the date range in milliseconds.
+        @param end_ms The end of the date range in milliseconds, exclusive.
+        @param page_size (Optional) The number of images of each page. Default is 1000.
+        @param margin (Optional) The distance in meters from the location within which an image counts as covering it, see search_region. Default is 0.
+        @return Yields lists of dictionaries with 'id' (relative to the dataset) and 'time_start' keys. Assets without a start time are left out.
+        """
+        _params = {
+            'parent': dataset,
+            'pageSize': page_size,
+            'startTime': iso_time(start_ms),
+            'endTime': iso_time(end_ms),
+            'region': search_region(geolocation, margin),
+            'view': 'BASIC'
+        }
+        while True:
+            _page = ee.data.listImages(_params)
+            yield [{'id': _img['id'][len(dataset) + 1:], 'time_start': parse_time(_img['startTime'])}
+                   for _img in _page.get('images', []) if _img.get('startTime')]
+            if not _page.get('nextPageToken'):
+                return
+            _params['pageToken'] = _page['nextPageToken']
+
+    @staticmethod
+    def status(error):
+        """
+        @brief Reads the HTTP status code carried by an exception of the HTTP clients used by the Earth Engine API.
+        @param error An exception.
+        @return Returns an integer, or None when the exception carries no status code.
+        """
+        for _holder, _name in ((getattr(error, 'resp', None), 'status'), (getattr(error, 'response', None), 'status_code'),
+                               (error, 'status_code')):
+            _status = getattr(_holder, _name, None)
+            if _status is not None:
+                try:
+                    return int(_status)
+                except (TypeError, ValueError):
+                    return None
+        return None
+
+    def is_transient(self, error):
+        """
+        @brief Tells whether a failed call is worth retrying.
+        HTTP errors are classified by their status code. Earth Engine errors, which carry no status code, are classified
+        by the server messages of throttling, timeouts and internal errors.
+        @param error The exception raised by the backend.
+        @return Returns True for connection problems, timeouts and server side throttling.
+        """
+        if isinstance(error, (ConnectionError, TimeoutError)):
+            return True
+        _status = self.status(error)
+        if _status is not None:
+            return _status in self.TRANSIENT_STATUS
+        if isinstance(error, ee.EEException):
+            _message = str(error).lower()
+            return any(_m in _message for _m in self.TRANSIENT_MESSAGES)
+        return False
+
+
+class LocalBackend(EarthEngineBackend):
+    """
+    @brief In-process stand-in for EarthEngineBackend, serving pixels from a local source.
+    Useful to exercise the download pipeline without an Earth Engine account.
+    """
+
+    METERS_PER_DEGREE = METERS_PER_DEGREE
+
+    def __init__(self, pixels, images=None):
+        """
+        @brief Constructor for the LocalBackend class.
+        @param pixels A callable receiving (asset_id, request) and returning a 2D numpy array of band values. NaN marks nodata pixels.
+        @param images (Optional) A callable receiving (dataset, geolocation) and returning a list of dictionaries with 'id' and
+        'time_start' keys. Default is None, no image is listed.
+        """
+        self.pixels = pixels
+        self.images = images
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        _state = self.__dict__.copy()
+        del _state['lock']
+        return _state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def count(self):
+        """
+        @brief Counts a backend call, from any downloader thread.
+        """
+        with self.lock:
+            self.calls += 1
+
+    def projection(self, crs, scale):
+        _degrees = scale / self.METERS_PER_DEGREE
+        return {'crs': crs, 'transform': [_degrees, 0, 0, 0, -_degrees, 0]}
+
+    def expression(self, asset_id, raw_band=None):
+        return asset_id
+
+    def list_images(self, dataset, geolocation, start_ms, end_ms, page_size=1000, margin=0):
+        self.count()
+        _images = [] if self.images is None else self.images(dataset, geolocation)
+        _images = [_img for _img in _images if start_ms <= _img['time_start'] < end_ms]
+        for _start in range(0, len(_images), page_size):
+            yield _images[_start:_start + page_size]
+
+    def reduce(self, asset_ids, band, grid):
+        self.count()
+        _stats = []
+        for _asset in asset_ids:
+            _values = np.asarray(self.pixels(_asset, {'expression': _asset, 'bandIds': [band], 'grid': grid}), dtype=np.float64)
+            _count = int(np.count_nonzero(~np.isnan(_values)))
+            _stats.append({'mean': float(np.nanmean(_values)) if _count else None, 'count': _count})
+        return _stats
+
+    def computePixels(self, request):
+        self.count()
+        _values = np.asarray(self.pixels(request['expression'], request), dtype=np.float64)
+        _buffer = io.BytesIO()
+
+        if request['fileFormat'] == 'NPY':
+            _band = request['bandIds'][0]
+            _pixels = np.zeros(_values.shape, dtype=[(_band, np.float32), (MASK_BAND, np.float32)])
+            _pixels[_band] = np.nan_to_num(_values, nan=0.0)
+            _pixels[MASK_BAND] = ~np.isnan(_values)
+            np.save(_buffer, _pixels)
+            return _buffer.getvalue()
+
+        _range = request['visualizationOptions']['ranges'][0]
+
+        _scaled = (_values - _range['min']) / (_range['max'] - _range['min'])
+        _scaled = np.clip(np.nan_to_num(_scaled, nan=0.0), 0, 1) * 254 + 1
+        _scaled[np.isnan(_values)] = 0
+
+        Image.fromarray(_scaled.astype(np.uint8), 'L').save(_buffer, format='PNG')
+        return _buffer.getvalue()
@@ -0,0 +1,116 @@
+from helpers.sqliteIndex import connect
+import time
+import os
+
+class ImageCatalog:
+
+    def __init__(self, catalog_dir='./catalog/', settle_days=7):
+        """
+        @brief Constructor for the ImageCatalog class, an on-disk index of the images listed for each dataset and footprint.
+        The catalogue records which date ranges were already listed, so only the uncovered dates are requested again.
+        @param catalog_dir (Optional) A string representing the directory of the catalogue. Default is './catalog/'.
+        @param settle_days (Optional) The number of most recent days never marked as covered, since images may still be
+        ingested for them. Default is 7.
+        """
+        self.index_path = os.path.join(catalog_dir, 'catalog.sqlite')
+        self.settle_ms = int(settle_days * 86400000)
+
+        os.makedirs(catalog_dir, exist_ok=True)
+        with connect(self.index_path) as _db:
+            _db.execute('CREATE TABLE IF NOT EXISTS images (dataset TEXT NOT NULL, footprint TEXT NOT NULL, id TEXT NOT NULL, '
+                        'time_start INTEGER NOT NULL, PRIMARY KEY (dataset, footprint, id))')
+            _db.execute('CREATE INDEX IF NOT EXISTS images_time ON images (dataset, footprint, time_start)')
+            _db.execute('CREATE TABLE IF NOT EXISTS coverage (dataset TEXT NOT NULL, footprint TEXT NOT NULL, '
+                        'start_ms INTEGER NOT NULL, end_ms INTEGER NOT NULL)')
+
+    @staticmethod
+    def footprint(geolocation, margin=0):
+        """
+        @brief Builds the key of a search footprint.
+        @param geolocation A tuple containing the longitude and latitude of the location.
+        @param margin (Optional) The margin in meters of the search around the location. Default is 0, the point only.
+        @return Returns a string.
+        """
+        _key = f'{float(geolocation[0]):.6f},{float(geolocation[1]):.6f}'
+        return _key if not margin else f'{_key},{float(margin):g}m'
+
+    def coverage(self, dataset, footprint):
+        """
+        @brief Lists the date ranges already listed for a dataset and footprint.
+        @param dataset The ID of the dataset.
+        @param footprint The key of the footprint.
+        @return Returns a sorted list of [start_ms, end_ms) tuples.
+        """
+        with connect(self.index_path) as _db:
+            return _db.execute('SELECT start_ms, end_ms FROM coverage WHERE dataset = ? AND footprint = ? ORDER BY start_ms',
+                               (dataset, footprint)).fetchall()
+
+    def missing(self, dataset, footprint, start_ms, end_ms):
+        """
+        @brief Finds the parts of a date range not listed yet.
+        @param dataset The ID of the dataset.
+        @param footprint The key of the footprint.
+        @param start_ms The start of the range in milliseconds.
+        @param end_ms The end of the range in milliseconds, exclusive.
+        @return Returns a list of [start_ms, end_ms) tuples.
+        """
+        _missing = []
+        _cursor = start_ms
+        for _start, _end in self.coverage(dataset, footprint):
+            if _end <= _cursor:
+                continue
+            if _start >= end_ms:
+                break
+            if _start > _cursor:
+                _missing.append((_cursor, _start))
+            _cursor = max(_cursor, _end)
+        if _cursor < end_ms:
+            _missing.append((_cursor, end_ms))
+        return _missing
+
+    def add(self, dataset, footprint, entries):
+        """
+        @brief Records listed images, replacing any previous entry with the same ID.
+        @param dataset The ID of the dataset.
+        @param footprint The key of the footprint.
+        @param entries A list of dictionaries with 'id' and 'time_start' keys.
+        """
+        with connect(self.index_path) as _db:
+            _db.executemany('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)',
+                            [(dataset, footprint, _e['id'], int(_e['time_start'])) for _e in entries])
+
+    def cover(self, dataset, footprint, start_ms, end_ms):
+        """
+        @brief Marks a date range as completely listed, merging it with the ranges it touches.
+        The part of the range within the settle period is left uncovered, so it is listed again by the next request.
+        @param dataset The ID of the dataset.
+        @param footprint The key of the footprint.
+        @param start_ms The start of the listed range in milliseconds.
+        @param end_ms The end of the listed range in milliseconds, exclusive.
+        """
+        end_ms = min(end_ms, int(time.time() * 1000) - self.settle_ms)
+        if end_ms <= start_ms:
+            return
+
+        with connect(self.index_path) as _db:
+            _ranges = _db.execute('SELECT start_ms, end_ms FROM coverage WHERE dataset = ? AND footprint = ? '
+                                  'AND end_ms >= ? AND start_ms <= ?', (dataset, footprint, start_ms, end_ms)).fetchall()
+            _start = min([start_ms] + [_r[0] for _r in _ranges])
+            _end = max([end_ms] + [_r[1] for _r in _ranges])
+            _db.execute('DELETE FROM coverage WHERE dataset = ? AND footprint = ? AND end_ms >= ? AND start_ms <= ?',
+                        (dataset, footprint, start_ms, end_ms))
+            _db.execute('INSERT INTO coverage VALUES (?, ?, ?, ?)', (dataset, footprint, _start, _end))
+
+    def entries(self, dataset, footprint, start_ms, end_ms):
+        """
+        @brief Reads the images of a date range from the catalogue.
+        @param dataset The ID of the dataset.
+        @param footprint The key of the footprint.
+        @param start_ms The start of the range in milliseconds.
+        @param end_ms The end of the range in milliseconds, exclusive.
+        @return Returns a list of dictionaries with 'id' and 'time_start' keys, in time order.
+        """
+        with connect(self.index_path) as _db:
+            _rows = _db.execute('SELECT id, time_start FROM images WHERE dataset = ? AND footprint = ? AND time_start >= ? '
+                                'AND time_start < ? ORDER BY time_start, id', (dataset, footprint, start_ms, end_ms)).fetchall()
+        return [{'id': _id, 'time_start': _time} for _id, _time in _rows]
@@ -1,37 +1,58 @@
+from helpers.tileFormat import read_tile, tile_mean
 import matplotlib.pyplot as plt
-from PIL import Image
 import seaborn as sns
 import numpy as np
 
 class ImageCorrelator:
 
-    def __init__(self, corr_list, buffer_dir='./buffer/'):
+    def __init__(self, corr_list, buffer_dir='./buffer/', tiles=None, stats=None, means=None):
         """
         @brief Constructor for the ImageCorrelator class.
         @param corr_list A list of tuples, where each tuple contains two lists of image IDs from two different lists that fall within the same time interval.
         @param buffer_dir (Optional) A string representing the directory where the images are stored. Default is './buffer/'.
+        @param tiles (Optional) A tuple of two dictionaries mapping the image IDs of each list to their tile paths. Images missing from it are read from buffer_dir.
+        @param stats (Optional) A TileStats index. When given, the averages are read from it instead of from the pixels. Default is None.
+        @param means (Optional) A tuple of two dictionaries mapping the image IDs of each list to their average, as given by
+        PrecorsiaGee.reduce_images. When given, no tile is read. Default is None.
         """
         self.corr_list = corr_list
         self.buffer_dir = buffer_dir
+        self.tiles = tiles if tiles is not None else ({}, {})
+        self.stats = stats
+        self.means = means
+
+    def tile_path(self, side, image_id):
+        """
+        @brief Gives the location of the tile of an image.
+        @param side 0 for an image of the first list, 1 for an image of the second list.
+        @param image_id The ID of the image.
+        @return Returns a string representing the path of the tile.
+        """
+        return self.tiles[side].get(image_id, f'{self.buffer_dir}{image_id}.png')
 
     def calculate_correlation(self):
         """
         @brief Calculates the average pixel value for each pair of images in the corr_list attribute.
         @return Returns a list of tuples. Each tuple contains the average pixel values for a pair of images.
         """
+        if self.means is not None:
+            mean = lambda side, img: self.means[side][img]
+        elif self.stats is not None:
+            _paths = [self.tile_path(_side, img) for pair in self.corr_list for _side in (0, 1) for img in pair[_side]]
+            _means = dict(zip(_paths, self.stats.column(_paths, 'mean')))
+            mean = lambda side, img: _means[self.tile_path(side, img)]
+        else:
+            mean = lambda side, img: tile_mean(read_tile(self.tile_path(side, img)))
+
         corr_avr = []
         for pair in self.corr_list:
             one_pair = []
             for img in pair[0]:
-                img = Image.open(f'{self.buffer_dir}{img}.png')
-                img = np.asarray(img)
-                one_pair.append(np.average(img))
+                one_pair.append(mean(0, img))
 
             two_pair = []
             for img in pair[1]:
-                img = Image.open(f'{self.buffer_dir}{img}.png')
-                img = np.asarray(img)
-                two_pair.append(np.average(img))
+                two_pair.append(mean(1, img))
 
             one_pair_avg = np.average(one_pair)
             two_pair_avg = np.average(two_pair)
@@ -1,18 +1,114 @@
-import matplotlib.pyplot as plt
-from PIL import Image
+from helpers.tileFormat import read_tile, write_tile, create_tile, to_storage, tile_shape, tile_zeros, row_blocks, nodata_mask, is_raw
+from helpers.tileCache import atomic_save, atomic_save_many
 import numpy as np
+import hashlib
+import json
 import os
 
 class ImageProcessor:
 
-    def __init__(self, image_lists, buffer_dir='./buffer/'):
+    def __init__(self, image_lists, buffer_dir='./buffer/', chunk_size=128, stats=None, max_pixels=1 << 25, filled_dir=None, cache=None):
         """
         @brief Constructor for the ImageProcessor class.
         @param image_lists A list of lists, where each sublist contains dictionaries representing images with 'id' and 'zeros' keys.
         @param buffer_dir (Optional) A string representing the directory where the images are stored. Default is './buffer/'.
+        @param chunk_size (Optional) The maximum number of images held in memory at once when processing a series. Default is 128.
+        @param stats (Optional) A TileStats index. When given, zero fractions are read from it instead of from the pixels. Default is None.
+        @param max_pixels (Optional) The maximum number of pixels held in memory at once. Chunks are shortened to fit in it, and
+        tiles too large for it, such as mosaics, are processed in row blocks. Default is 2**25, a full chunk of 512x512 tiles.
+        @param filled_dir (Optional) A string representing the directory of the gap-filled tiles. The downloaded tiles are never
+        overwritten, so a TileCache can be shared by runs and processes. Default is None, a 'filled' directory in buffer_dir.
+        @param cache (Optional) The TileCache of the downloaded tiles. The gap-filled copies are recorded in it, so they count
+        toward its max_bytes and are evicted with the tiles, and hard deletes go through it. Default is None.
         """
         self.image_lists = image_lists
         self.buffer_dir = buffer_dir
+        self.chunk_size = chunk_size
+        self.stats = stats
+        self.max_pixels = max_pixels
+        self.filled_dir = filled_dir if filled_dir is not None else os.path.join(buffer_dir, 'filled')
+        self.cache = cache
+
+    def tile_path(self, image):
+        """
+        @brief Gives the location of the tile of an image.
+        @param image A dictionary representing an image. The 'path' key, set by PrecorsiaGee.download_images, takes precedence over the buffer directory.
+        @return Returns a string representing the path of the tile.
+        """
+        return image.get('path', f'{self.buffer_dir}%s.png' % image['id'])
+
+    def filled_path(self, image, image_list, tag):
+        """
+        @brief Gives the location of the gap-filled copy of a tile. The name is derived from the tile, from every tile it is
+        filled from and from the fill parameters, so series filled from the same tiles share one copy.
+        @param image A dictionary representing the image.
+        @param image_list A list of dictionaries representing the images the tile is filled from, itself included.
+        @param tag A JSON serialisable value identifying the fill parameters.
+        @return Returns a string representing the path of the copy.
+        """
+        _source = self.tile_path(image)
+        _key = hashlib.sha256(json.dumps([_source, [self.tile_path(_image) for _image in image_list], tag]).encode()).hexdigest()[:40]
+        return os.path.join(self.filled_dir, _key[:2], f'{_key}{os.path.splitext(_source)[1]}')
+
+    def keep(self, image, path):
+        """
+        @brief Records a gap-filled copy in the tile cache, if any, refreshing it when it was already there.
+        @param image A dictionary representing the image of the copy.
+        @param path A string representing the path of the copy, see filled_path.
+        """
+        if self.cache is not None:
+            self.cache.add(os.path.splitext(os.path.basename(path))[0], path, image=image['id'])
+
+    def load_stack(self, image_list):
+        """
+        @brief Loads the tiles of a list of images into a single array.
+        @param image_list A list of dictionaries representing images.
+        @return Returns a numpy array of shape (N, H, W).
+        """
+        return np.stack([read_tile(self.tile_path(_image)) for _image in image_list])
+
+    def chunk_length(self, image_list):
+        """
+        @brief Gives the number of tiles of a list that fit in memory at once, judging by the size of its first tile.
+        @param image_list A list of dictionaries representing images of the same size.
+        @return Returns an integer between 0 and chunk_size. 0 means a single tile exceeds max_pixels.
+        """
+        if not image_list:
+            return self.chunk_size
+        _height, _width = tile_shape(self.tile_path(image_list[0]))
+        return min(self.chunk_size, self.max_pixels // (_height * _width))
+
+    def chunks(self, image_list, length=None):
+        """
+        @brief Loads a list of images chunk by chunk, keeping at most chunk_size tiles in memory.
+        @param image_list A list of dictionaries representing images.
+        @param length (Optional) The number of tiles of a chunk. Default is None, as given by chunk_length.
+        @return Yields tuples with the index of the first image of the chunk and the (n, H, W) stack of the chunk.
+        """
+        length = max(1, self.chunk_length(image_list) if length is None else length)
+        for _start in range(0, len(image_list), length):
+            yield _start, self.load_stack(image_list[_start:_start + length])
+
+    @staticmethod
+    def zero_fractions(stack):
+        """
+        @brief Calculates the proportion of zero pixels of every image of a stack.
+        @param stack A numpy array of shape (N, H, W).
+        @return Returns a numpy array of shape (N,).
+        """
+        return nodata_mask(stack).reshape(len(stack), -1).mean(axis=1)
+
+    @staticmethod
+    def fill_stack(stack, weight=0.3332):
+        """
+        @brief Replaces the zero pixels of every image of a stack with the weighted sum of the stack.
+        @param stack A numpy array of shape (N, H, W).
+        @param weight (Optional) The weight of each image in the sum. Default is 0.3332.
+        @return Returns a tuple with the filled float stack and the (H, W) weighted sum.
+        """
+        _mask = nodata_mask(stack)
+        _best_image = np.where(_mask, 0, stack).sum(axis=0) * weight
+        return np.where(_mask, _best_image, stack), _best_image
 
     def calculate_zeros(self, image_list):
         """
@@ -20,15 +116,17 @@ class ImageProcessor:
         @param image_list A list of dictionaries representing images. Each dictionary should have an 'id' key.
         @return Returns a list of dictionaries. Each dictionary represents an image and contains 'id' and 'zeros' keys. The 'zeros' key is the proportion of zero pixels in the image.
         """
-        _zeros_class = []
-        for _image in [image for image in image_list]:
-            _id = _image['id']
-            _img = Image.open(f'{self.buffer_dir}%s.png' % _id).convert('L')
-            _img_arr = np.array(_img)
-            _zeros = np.count_nonzero(_img_arr == 0)
-            _zeros_class.append({'id': _id, 'time_start': _image['time_start'], 'zeros': (_zeros / np.prod(_img_arr.shape))})
-        
-        return _zeros_class
+        if self.stats is not None:
+            _zeros = self.stats.column([self.tile_path(_image) for _image in image_list], 'zeros')
+        elif self.chunk_length(image_list) == 0:
+            _zeros = np.array([tile_zeros(read_tile(self.tile_path(_image)), self.max_pixels) for _image in image_list])
+        else:
+            _zeros = np.empty(len(image_list))
+            for _start, _stack in self.chunks(image_list):
+                _zeros[_start:_start + len(_stack)] = ImageProcessor.zero_fractions(_stack)
+
+        return [{'id': _image['id'], 'time_start': _image['time_start'], 'path': self.tile_path(_image), 'zeros': float(_z)}
+                for _image, _z in zip(image_list, _zeros)]
 
     def discard_images(self, zeros_class, clip_amount=0.33, hard_delete=False):
         """
@@ -37,12 +135,14 @@ class ImageProcessor:
         @param clip_amount (Optional) A float representing the threshold proportion of zero pixels. Default is 0.33.
         @return Returns a list of dictionaries representing the remaining images after discarding.
         """
-        _zeros_class = zeros_class
-        for _image in _zeros_class:
-            if _image['zeros'] > clip_amount:
-                if hard_delete:
-                    os.remove(f'{self.buffer_dir}%s.png' % _image['id'])
-                _zeros_class.remove(_image)
+        _zeros_class = []
+        for _image in zeros_class:
+            if _image['zeros'] <= clip_amount:
+                _zeros_class.append(_image)
+            elif hard_delete and self.cache is not None:
+                self.cache.remove(self.tile_path(_image))
+            elif hard_delete:
+                os.remove(self.tile_path(_image))
         return _zeros_class
 
     @staticmethod
@@ -61,13 +161,7 @@ class ImageProcessor:
         @param best_class A list of dictionaries representing the best images. Each dictionary should have an 'id' key.
         @return Returns a numpy array representing the average image.
         """
-        _img = Image.open(f'{self.buffer_dir}%s.png' % best_class[0]['id']).convert('L')
-        _best_image = np.zeros(np.array(_img).shape)
-        for _image in best_class:
-            _img = Image.open(f'{self.buffer_dir}%s.png' % _image['id']).convert('L')
-            _img_arr = np.array(_img)
-            _best_image += _img_arr * 0.3332
-        return _best_image
+        return ImageProcessor.fill_stack(self.load_stack(best_class))[1]
 
     def replace_and_save(self, best_class, best_image):
         """
@@ -75,24 +169,137 @@ class ImageProcessor:
         @param best_class A list of dictionaries representing the best images. Each dictionary should have an 'id' key.
         @param best_image A numpy array representing the average image.
         """
-        for _image in best_class:
-            _img = Image.open(f'{self.buffer_dir}%s.png' % _image['id']).convert('L')
-            _img_arr = np.array(_img)
-            _img_mask = _img_arr == 0
-            _img_filtered = (best_image * _img_mask) + _img_arr
-            plt.imsave(f'{self.buffer_dir}%s.png' % _image['id'], _img_filtered, cmap='gray')
+        _stack = self.load_stack(best_class)
+        _tag = hashlib.sha256(np.ascontiguousarray(best_image).tobytes()).hexdigest()
+        self.save_stack(best_class, np.where(nodata_mask(_stack), best_image, _stack), is_raw(_stack), _tag)
 
-    def zero_counting_filter(self, hard_delete=False):
+    def fill_images(self, image_list, weight=0.3332):
         """
-        @brief Processes all the images in the image_lists attribute.
+        @brief Replaces the zero pixels of a list of images with their weighted sum and saves them as gap-filled copies.
+        The images are gap-filled as one stack when they fit in max_pixels, and in row blocks otherwise. The 'path' of every
+        image is set to its copy.
+        @param image_list A list of dictionaries representing images of the same size.
+        @param weight (Optional) The weight of each image in the sum. Default is 0.3332.
+        """
+        if not image_list:
+            return
+        if self.chunk_length(image_list) >= len(image_list) or not self.tile_path(image_list[0]).endswith('.npy'):
+            _stack = self.load_stack(image_list)
+            self.save_stack(image_list, ImageProcessor.fill_stack(_stack, weight)[0], is_raw(_stack), weight)
+        else:
+            self.fill_tiles(image_list, weight)
+
+    def fill_tiles(self, image_list, weight=0.3332):
+        """
+        @brief Gap-fills memory-mapped .npy tiles in row blocks, so at most max_pixels pixels are in memory at once.
+        Every copy is written to a memory-mapped temporary file, and all of them are moved in place once complete.
+        @param image_list A list of dictionaries representing images with .npy tiles of the same size.
+        @param weight (Optional) The weight of each image in the sum. Default is 0.3332.
         """
-        after_delete = []
-        for _image_list in self.image_lists:
-            _zeros_class = self.calculate_zeros(_image_list)
-            _zeros_discad = self.discard_images(_zeros_class, hard_delete=hard_delete)
-            _best_class = ImageProcessor.select_best_images(_zeros_discad)
-            _best_image = self.calculate_best_image(_best_class)
-            self.replace_and_save(_best_class, _best_image)
-            after_delete.append(_zeros_class)
+        _tiles = [read_tile(self.tile_path(_image)) for _image in image_list]
+        _raw = is_raw(_tiles[0])
+        _paths = [self.filled_path(_image, image_list, weight) for _image in image_list]
+        for _image, _path in zip(image_list, _paths):
+            _image['path'] = _path
+        if all(os.path.exists(_path) for _path in _paths):
+            for _image, _path in zip(image_list, _paths):
+                self.keep(_image, _path)
+            return
+        for _path in _paths:
+            os.makedirs(os.path.dirname(_path), exist_ok=True)
 
-        return after_delete
\ No newline at end of file
+        def write(tmps):
+            _outputs = [create_tile(_tmp, _tiles[0].shape, raw=_raw) for _tmp in tmps]
+            for _rows in row_blocks(*_tiles[0].shape, self.max_pixels // len(_tiles)):
+                _filled = ImageProcessor.fill_stack(np.stack([_tile[_rows] for _tile in _tiles]), weight)[0]
+                for _output, _image in zip(_outputs, _filled):
+                    _output[_rows] = to_storage(_image, _raw)
+            for _output in _outputs:
+                _output.flush()
+
+        atomic_save_many(_paths, write)
+        for _image, _path in zip(image_list, _paths):
+            self.keep(_image, _path)
+            if self.stats is not None:
+                self.stats.record(_path)
+
+    def save_stack(self, image_list, stack, raw, tag):
+        """
+        @brief Saves every image of a gap-filled stack as a copy of its tile, and sets the 'path' of the image to it.
+        A copy already on disk holds the same pixels and is kept.
+        @param image_list A list of dictionaries representing the images of the stack.
+        @param stack A numpy array of shape (N, H, W).
+        @param raw True to keep float values in .npy tiles, False to store them as uint8.
+        @param tag A JSON serialisable value identifying the fill parameters, see filled_path.
+        """
+        _paths = [self.filled_path(_image, image_list, tag) for _image in image_list]
+        for _image, _path, _img_filtered in zip(image_list, _paths, stack):
+            _image['path'] = _path
+            if os.path.exists(_path):
+                self.keep(_image, _path)
+                continue
+            os.makedirs(os.path.dirname(_path), exist_ok=True)
+            atomic_save(_path, lambda path: write_tile(path, _img_filtered, raw=raw))
+            self.keep(_image, _path)
+            if self.stats is not None:
+                self.stats.record(_path)
+
+    def filter_series(self, image_list, clip_amount=0.33, best_amount=3, hard_delete=False):
+        """
+        @brief Runs the zero counting filter over one series of images in a single pass.
+        With a stats index, as PrecorsiaFilter always gives, the zero fractions come from the index and only the best
+        images are decoded. Without one, as when the processor is used on its own, the series is read chunk by chunk; each
+        chunk gives the zero fractions of its images and competes for the best_amount images with the fewest zeros, so
+        every tile is decoded only once. Tiles too large for a chunk to fit in max_pixels, such as mosaics, are read in row
+        blocks instead. Every way selects, discards and gap-fills the same images.
+        The best images are gap-filled into copies in filled_dir, and their 'path' points to the copy.
+        @param image_list A list of dictionaries representing images. Each dictionary should have 'id' and 'time_start' keys.
+        @param clip_amount (Optional) A float representing the threshold proportion of zero pixels. Default is 0.33.
+        @param best_amount (Optional) The number of best images that are gap-filled. Default is 3.
+        @param hard_delete (Optional) True to delete the tiles of the discarded images. Default is False.
+        @return Returns a list of dictionaries representing the remaining images, with 'id', 'time_start', 'path' and 'zeros' keys.
+        """
+        _length = self.chunk_length(image_list)
+        if self.stats is not None or _length <= best_amount:
+            _zeros_class = self.calculate_zeros(image_list)
+            _zeros_discard = self.discard_images(_zeros_class, clip_amount, hard_delete)
+            _best_class = sorted(_zeros_discard, key=lambda _z: _z['zeros'])[:best_amount]
+            self.fill_images(_best_class, weight=0.3332 * 3 / best_amount)
+            return _zeros_discard
+
+        _zeros = np.empty(len(image_list))
+        _best_index = np.empty(0, dtype=int)
+        _best_stack = None
+        _raw = False
+
+        for _start, _stack in self.chunks(image_list, _length - best_amount):
+            _raw = is_raw(_stack)
+            _chunk_zeros = ImageProcessor.zero_fractions(_stack)
+            _zeros[_start:_start + len(_stack)] = _chunk_zeros
+
+            _kept = np.flatnonzero(_chunk_zeros <= clip_amount)
+            _candidates = np.concatenate([_best_index, _start + _kept])
+            _candidate_stack = _stack[_kept] if _best_stack is None else np.concatenate([_best_stack, _stack[_kept]])
+
+            _order = np.lexsort((_candidates, _zeros[_candidates]))[:best_amount]
+            _best_index = _candidates[_order]
+            _best_stack = _candidate_stack[_order]
+
+        _zeros_class = [{'id': _image['id'], 'time_start': _image['time_start'], 'path': self.tile_path(_image), 'zeros': float(_z)}
+                        for _image, _z in zip(image_list, _zeros)]
+        _zeros_discard = self.discard_images(_zeros_class, clip_amount, hard_delete)
+
+        if len(_best_index):
+            _best_filled = ImageProcessor.fill_stack(_best_stack, weight=0.3332 * 3 / best_amount)[0]
+            self.save_stack([_zeros_class[_i] for _i in _best_index], _best_filled, _raw, 0.3332 * 3 / best_amount)
+
+        return _zeros_discard
+
+    def zero_counting_filter(self, hard_delete=False, clip_amount=0.33):
+        """
+        @brief Processes all the images in the image_lists attribute.
+        @param hard_delete (Optional) True to delete the tiles of the discarded images. Default is False.
+        @param clip_amount (Optional) A float representing the threshold proportion of zero pixels. Default is 0.33.
+        @return Returns a list with the remaining images of each list of image_lists.
+        """
+        return [self.filter_series(_image_list, clip_amount, hard_delete=hard_delete) for _image_list in self.image_lists]
@@ -0,0 +1,193 @@
+from helpers.tileCache import atomic_save
+import contextlib
+import threading
+import cProfile
+import json
+import time
+import re
+
+class StageHook:
+    """
+    @brief Interface of the objects notified around the stages of a run. Subclasses override the methods they need.
+    """
+
+    def start(self, stage):
+        """
+        @brief Called when a stage starts.
+        @param stage The name of the stage.
+        """
+
+    def end(self, stage, record):
+        """
+        @brief Called when a stage ends, even when it failed.
+        @param stage The name of the stage.
+        @param record The dictionary of measures of the stage, see Metrics.record.
+        """
+
+
+class StageProfiler(StageHook):
+
+    def __init__(self, stage, output):
+        """
+        @brief Constructor for the StageProfiler class, a hook running cProfile over a single stage.
+        @param stage The name of the profiled stage, e.g. 'download'.
+        @param output A string representing the path of the profile, readable with pstats or snakeviz.
+        """
+        self.stage = stage
+        self.output = output
+        self.profile = None
+
+    def start(self, stage):
+        if stage == self.stage:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def end(self, stage, record):
+        if stage == self.stage and self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.output)
+            self.profile = None
+
+
+class Metrics:
+
+    def __init__(self, hooks=None, labels=None):
+        """
+        @brief Constructor for the Metrics class, which collects the wall time and the counters of each stage of a run.
+        Counters are attributed to the stage running when they are incremented, including from download threads.
+        @param hooks (Optional) A list of StageHook objects notified around every stage. Default is None.
+        @param labels (Optional) A dictionary of labels describing the run, e.g. datasets and climate, added to every export. Default is None.
+        """
+        self.hooks = list(hooks or [])
+        self.labels = dict(labels or {})
+        self.stages = {}
+        self.current = None
+        self._lock = threading.Lock()
+
+    def record(self, stage):
+        """
+        @brief Gives the measures of a stage, creating them on first use.
+        @param stage The name of the stage.
+        @return Returns a dictionary with 'seconds', 'runs' and 'counters' keys.
+        """
+        with self._lock:
+            return self.stages.setdefault(stage, {'seconds': 0.0, 'runs': 0, 'counters': {}})
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        @brief Measures a stage. Stages can be nested: counters go to the innermost stage.
+        @param name The name of the stage.
+        @return Yields the dictionary of measures of the stage.
+        """
+        _record = self.record(name)
+        _parent, self.current = self.current, name
+        for _hook in self.hooks:
+            _hook.start(name)
+        _start = time.perf_counter()
+        try:
+            yield _record
+        finally:
+            with self._lock:
+                _record['seconds'] += time.perf_counter() - _start
+                _record['runs'] += 1
+            self.current = _parent
+            for _hook in self.hooks:
+                _hook.end(name, _record)
+
+    def count(self, name, value=1):
+        """
+        @brief Increments a counter of the current stage.
+        @param name The name of the counter, e.g. 'bytes_downloaded'.
+        @param value (Optional) The increment. Default is 1.
+        """
+        _record = self.record(self.current or 'other')
+        with self._lock:
+            _record['counters'][name] = _record['counters'].get(name, 0) + value
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """
+        @brief Adds the duration of a block to a '<name>_seconds' counter and counts its calls in a '<name>_calls' counter.
+        @param name The name of the timed operation, e.g. 'compute_pixels'.
+        """
+        _start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.count(f'{name}_seconds', time.perf_counter() - _start)
+            self.count(f'{name}_calls')
+
+    def merge(self, stages):
+        """
+        @brief Adds the measures of another run, e.g. of a worker process, to these ones.
+        @param stages A dictionary of stage measures, as in the 'stages' key of to_dict.
+        """
+        for _stage, _measures in stages.items():
+            _record = self.record(_stage)
+            with self._lock:
+                _record['seconds'] += _measures['seconds']
+                _record['runs'] += _measures['runs']
+                for _name, _value in _measures['counters'].items():
+                    _record['counters'][_name] = _record['counters'].get(_name, 0) + _value
+
+    def timings(self):
+        """
+        @brief Gives the wall time of every stage.
+        @return Returns a dictionary mapping stage names to seconds.
+        """
+        with self._lock:
+            return {_stage: _record['seconds'] for _stage, _record in self.stages.items()}
+
+    def to_dict(self):
+        """
+        @brief Gives every measure in a JSON friendly form.
+        @return Returns a dictionary with 'labels' and 'stages' keys.
+        """
+        with self._lock:
+            return {'labels': dict(self.labels),
+                    'stages': {_stage: dict(_record, counters=dict(_record['counters'])) for _stage, _record in self.stages.items()}}
+
+    def write_log(self, path):
+        """
+        @brief Appends the measures as one JSON line to a structured log.
+        @param path A string representing the path of the log.
+        """
+        with open(path, 'a') as file:
+            file.write(json.dumps(dict(self.to_dict(), time=time.time())) + '\n')
+
+    @staticmethod
+    def metric_name(name):
+        """
+        @brief Turns a counter name into a valid Prometheus metric name.
+        @param name The name of the counter.
+        @return Returns a string.
+        """
+        return 'precorsia_' + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+    def write_prometheus(self, path):
+        """
+        @brief Writes the measures atomically in the Prometheus text format, for the node exporter textfile collector.
+        @param path A string representing the path of the file, ending in '.prom'.
+        """
+        _data = self.to_dict()
+        _samples = {}
+        for _stage, _record in _data['stages'].items():
+            _labels = dict(_data['labels'], stage=_stage)
+            _samples.setdefault('stage_seconds', []).append((_labels, _record['seconds']))
+            _samples.setdefault('stage_runs', []).append((_labels, _record['runs']))
+            for _name, _value in _record['counters'].items():
+                _samples.setdefault(_name, []).append((_labels, _value))
+
+        _lines = []
+        for _name, _values in sorted(_samples.items()):
+            _metric = Metrics.metric_name(_name)
+            _lines.append(f'# TYPE {_metric} gauge')
+            for _labels, _value in _values:
+                _text = ','.join('%s="%s"' % (_k, str(_v).replace('\\', '\\\\').replace('"', '\\"')) for _k, _v in sorted(_labels.items()))
+                _lines.append(f'{_metric}{{{_text}}} {float(_value)}')
+
+        def write(tmp):
+            with open(tmp, 'w') as file:
+                file.write('\n'.join(_lines) + '\n')
+        atomic_save(path, write)
@@ -0,0 +1,167 @@
+import numpy as np
+
+DAY_MS = 86400000
+
+class LagResult:
+
+    def __init__(self, lags, corr, counts, x_grid, y_grid, step_days):
+        """
+        @brief Constructor for the LagResult class, the outcome of a LagSearch.
+        @param lags A numpy array with the lags in grid steps.
+        @param corr A numpy array of shape (..., L) with the Pearson coefficient at each lag. NaN where the overlap is too small.
+        @param counts A numpy array of shape (..., L) with the number of overlapping pairs at each lag.
+        @param x_grid The first series resampled on the grid, NaN where empty.
+        @param y_grid The second series resampled on the grid, NaN where empty.
+        @param step_days The length of a grid step in days.
+        """
+        self.lags = lags
+        self.corr = corr
+        self.counts = counts
+        self.x_grid = x_grid
+        self.y_grid = y_grid
+        self.step_days = step_days
+        self.lags_days = lags * step_days
+
+        _zero = np.flatnonzero(lags == 0)[0]
+        _corr = np.where(np.isnan(corr), -np.inf, corr)
+        _best = np.argmax(_corr, axis=-1)
+        _best_corr = np.take_along_axis(_corr, _best[..., None], axis=-1)[..., 0]
+        _best = np.where(_best_corr > np.nan_to_num(corr[..., _zero], nan=0.0), _best, _zero)
+
+        self.best_index = _best
+        self.best_lag = lags[_best]
+        self.best_lag_days = self.best_lag * step_days
+        self.best_corr = np.nan_to_num(np.take_along_axis(corr, _best[..., None], axis=-1)[..., 0], nan=0.0)
+
+    def pairs(self, lag):
+        """
+        @brief Lists the pairs of values compared at a lag, for a single pair of series.
+        @param lag The lag in grid steps. A positive lag pairs the first series at t + lag with the second series at t.
+        @return Returns a list of tuples with the paired values.
+        """
+        _length = self.x_grid.shape[-1]
+        _x = self.x_grid[max(lag, 0):_length + min(lag, 0)]
+        _y = self.y_grid[max(-lag, 0):_length - max(lag, 0)]
+        _valid = ~np.isnan(_x) & ~np.isnan(_y)
+        return list(zip(_x[_valid], _y[_valid]))
+
+    def curve(self):
+        """
+        @brief Gives the lag curve in a JSON friendly form, for a single pair of series.
+        @return Returns a dictionary with 'lags_days', 'correlation' and 'counts' lists. NaN coefficients are None.
+        """
+        return {'lags_days': [float(_l) for _l in self.lags_days],
+                'correlation': [None if np.isnan(_c) else float(_c) for _c in self.corr],
+                'counts': [int(_n) for _n in self.counts]}
+
+
+class LagSearch:
+
+    def __init__(self, step_days=1, max_lag_days=None, min_overlap=2):
+        """
+        @brief Constructor for the LagSearch class, which finds the time shift that best correlates two series.
+        Both series are resampled on a regular time grid and the Pearson coefficient of every lag is computed in one
+        FFT pass, normalised by the number of overlapping samples of each lag.
+        @param step_days (Optional) The length of a grid step in days. Default is 1.
+        @param max_lag_days (Optional) The largest lag searched, in days. Default is None, a quarter of the grid length.
+        @param min_overlap (Optional) The minimum number of overlapping pairs for a lag to be considered. Default is 2.
+        """
+        self.step_days = step_days
+        self.step_ms = int(round(step_days * DAY_MS))
+        self.max_lag_days = max_lag_days
+        self.min_overlap = max(2, min_overlap)
+
+    def grid(self, *times):
+        """
+        @brief Builds the time grid covering every given time.
+        @param times Arrays of times in milliseconds, as in 'time_start'.
+        @return Returns a tuple with the origin of the grid in milliseconds and its number of steps.
+        """
+        _step = self.step_ms
+        _all = np.concatenate([np.asarray(_t, dtype=np.float64).ravel() for _t in times])
+        _origin = np.floor(_all.min() / _step) * _step
+        return _origin, int((_all.max() - _origin) // _step) + 1
+
+    def resample(self, times, values, origin, length):
+        """
+        @brief Places a series on the time grid, averaging the values that fall in the same step.
+        @param times An array of times in milliseconds.
+        @param values An array with one value per time.
+        @param origin The origin of the grid in milliseconds.
+        @param length The number of steps of the grid.
+        @return Returns a numpy array of shape (length,), NaN where no value falls.
+        """
+        _index = ((np.asarray(times, dtype=np.float64) - origin) // self.step_ms).astype(int)
+        _sums = np.bincount(_index, weights=np.asarray(values, dtype=np.float64), minlength=length)
+        _counts = np.bincount(_index, minlength=length)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(_counts > 0, _sums / _counts, np.nan)
+
+    def moments(self, x, y, max_lag=None):
+        """
+        @brief Computes the sufficient statistics of the Pearson coefficient of two gridded series at every lag, in one FFT pass.
+        Each series is centred on its mean first, which keeps the sums small and the coefficients accurate.
+        @param x A numpy array of shape (..., T), NaN where empty.
+        @param y A numpy array of shape (..., T), NaN where empty. Leading dimensions broadcast against x.
+        @param max_lag (Optional) The largest lag in grid steps. Default is None, a quarter of T.
+        @return Returns a tuple with the lags, the moments (6, ..., L) and the centres of x and y (..., 1). The moments are
+        the overlap counts and the sums of x, y, x*x, y*y and x*y over the overlapping pairs, in this order.
+        """
+        _length = x.shape[-1]
+        max_lag = min(_length - 1, _length // 4 if max_lag is None else int(max_lag))
+        _size = 1 << int(np.ceil(np.log2(max(2 * _length - 1, 1))))
+
+        _mx, _my = ~np.isnan(x), ~np.isnan(y)
+        _cx = np.nanmean(np.where(_mx.any(-1, keepdims=True), x, 0.0), -1, keepdims=True)
+        _cy = np.nanmean(np.where(_my.any(-1, keepdims=True), y, 0.0), -1, keepdims=True)
+        _x = np.where(_mx, x - _cx, 0.0)
+        _y = np.where(_my, y - _cy, 0.0)
+
+        _fx = np.fft.rfft(np.stack([_mx.astype(float), _x, _x * _x]), _size)
+        _fy = np.conj(np.fft.rfft(np.stack([_my.astype(float), _y, _y * _y]), _size))
+        _lags = np.arange(-max_lag, max_lag + 1)
+
+        def cross(a, b):
+            return np.fft.irfft(_fx[a] * _fy[b], _size)[..., _lags % _size]
+
+        _moments = np.stack([np.rint(cross(0, 0)), cross(1, 0), cross(0, 1), cross(2, 0), cross(0, 2), cross(1, 1)])
+        return _lags, _moments, (_cx, _cy)
+
+    def pearson(self, moments):
+        """
+        @brief Computes the Pearson coefficients from the sufficient statistics given by moments.
+        @param moments A numpy array of shape (6, ..., L).
+        @return Returns a numpy array of shape (..., L). NaN where the overlap is smaller than min_overlap.
+        """
+        _n, _sx, _sy, _sxx, _syy, _sxy = moments
+        with np.errstate(invalid='ignore', divide='ignore'):
+            _corr = (_n * _sxy - _sx * _sy) / np.sqrt((_n * _sxx - _sx ** 2) * (_n * _syy - _sy ** 2))
+        return np.where(_n >= self.min_overlap, np.clip(_corr, -1, 1), np.nan)
+
+    def correlate(self, x, y, max_lag=None):
+        """
+        @brief Computes the Pearson coefficient of two gridded series at every lag.
+        @param x A numpy array of shape (..., T), NaN where empty.
+        @param y A numpy array of shape (..., T), NaN where empty. Leading dimensions broadcast against x.
+        @param max_lag (Optional) The largest lag in grid steps. Default is None, a quarter of T.
+        @return Returns a tuple with the lags, the coefficients (..., L) and the overlap counts (..., L).
+        """
+        _lags, _moments, _ = self.moments(x, y, max_lag)
+        return _lags, self.pearson(_moments), _moments[0].astype(int)
+
+    def search(self, times_one, values_one, times_two, values_two):
+        """
+        @brief Finds the lag that best correlates two irregular series.
+        @param times_one An array with the times in milliseconds of the first series.
+        @param values_one An array with the values of the first series.
+        @param times_two An array with the times in milliseconds of the second series.
+        @param values_two An array with the values of the second series.
+        @return Returns a LagResult.
+        """
+        _origin, _length = self.grid(times_one, times_two)
+        _x = self.resample(times_one, values_one, _origin, _length)
+        _y = self.resample(times_two, values_two, _origin, _length)
+
+        _max_lag = None if self.max_lag_days is None else int(self.max_lag_days // self.step_days)
+        _lags, _corr, _counts = self.correlate(_x, _y, _max_lag)
+        return LagResult(_lags, _corr, _counts, _x, _y, self.step_days)
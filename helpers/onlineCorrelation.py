@@ -0,0 +1,152 @@
+from helpers.lagSearch import LagSearch, LagResult
+import numpy as np
+
+class OnlineCorrelation:
+
+    def __init__(self, lag_search, origin, lags, center, sums, counts, moments):
+        """
+        @brief Constructor for the OnlineCorrelation class, the sufficient statistics of a lag search kept up to date as pairs arrive.
+        The pairs are summed per step of the time grid, and the moments of every lag are updated for the steps that change
+        only, so adding a few pairs costs O(steps changed x lags) instead of a new search over the whole series.
+        @param lag_search The LagSearch defining the grid step and the minimum overlap.
+        @param origin The origin of the grid in milliseconds.
+        @param lags A numpy array with the lags in grid steps. It stays fixed as the grid grows.
+        @param center A tuple with the values subtracted from x and y before summing, for accuracy.
+        @param sums A numpy array of shape (2, T) with the sums of the x and y values of the pairs of each step.
+        @param counts A numpy array of shape (T,) with the number of pairs of each step.
+        @param moments A numpy array of shape (6, L) with the moments of every lag, as given by LagSearch.moments.
+        """
+        self.lag_search = lag_search
+        self.origin = int(origin)
+        self.lags = np.asarray(lags, dtype=int)
+        self.center = (float(center[0]), float(center[1]))
+        self.sums = np.asarray(sums, dtype=np.float64).reshape(2, -1)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.moments = np.asarray(moments, dtype=np.float64)
+
+    @staticmethod
+    def build(lag_search, times, x_values, y_values, max_lag=None):
+        """
+        @brief Computes the statistics of a whole series of pairs, with the same grid and lags as LagSearch.search.
+        @param lag_search The LagSearch defining the grid step and the minimum overlap.
+        @param times An array with the times in milliseconds of the pairs.
+        @param x_values An array with the first value of each pair.
+        @param y_values An array with the second value of each pair.
+        @param max_lag (Optional) The largest lag in grid steps. Default is None, a quarter of the grid length.
+        @return Returns an OnlineCorrelation.
+        """
+        _origin, _length = lag_search.grid(times)
+        _index = ((np.asarray(times, dtype=np.float64) - _origin) // lag_search.step_ms).astype(int)
+        _sums = np.stack([np.bincount(_index, weights=np.asarray(_v, dtype=np.float64), minlength=_length) for _v in (x_values, y_values)])
+        _counts = np.bincount(_index, minlength=_length)
+
+        _x = lag_search.resample(times, x_values, _origin, _length)
+        _y = lag_search.resample(times, y_values, _origin, _length)
+        _lags, _moments, (_cx, _cy) = lag_search.moments(_x, _y, max_lag)
+        return OnlineCorrelation(lag_search, _origin, _lags, (_cx.item(), _cy.item()), _sums, _counts, _moments)
+
+    def values(self, side, index):
+        """
+        @brief Gives the averaged values of one side at some steps of the grid.
+        @param side 0 for the x values, 1 for the y values.
+        @param index A numpy array of step indexes, possibly out of the grid.
+        @return Returns a numpy array, NaN for steps out of the grid or without pairs.
+        """
+        _values = np.full(index.shape, np.nan)
+        _inside = (index >= 0) & (index < len(self.counts))
+        _inside[_inside] = self.counts[index[_inside]] > 0
+        _values[_inside] = self.sums[side, index[_inside]] / self.counts[index[_inside]]
+        return _values
+
+    def contribution(self, step):
+        """
+        @brief Computes the part of the moments due to the pairs a step forms with every step, itself included.
+        @param step The index of the step in the grid.
+        @return Returns a numpy array of shape (6, L).
+        """
+        _contribution = np.zeros((6, len(self.lags)))
+        _x, _y = (self.values(_side, np.array([step]))[0] for _side in (0, 1))
+        if np.isnan(_x) or np.isnan(_y):
+            return _contribution
+
+        # At lag k the x value of step t + k is paired with the y value of step t: x of this step meets y of step - k,
+        # and y of this step meets x of step + k. The pair with itself, at lag 0, is counted once.
+        for _a, _b, _valid in ((_x, self.values(1, step - self.lags), True), (self.values(0, step + self.lags), _y, self.lags != 0)):
+            _a = np.asarray(_a - self.center[0], dtype=np.float64)
+            _b = np.asarray(_b - self.center[1], dtype=np.float64)
+            _mask = ~np.isnan(_a + _b) & _valid
+            _a, _b = np.where(_mask, _a, 0.0), np.where(_mask, _b, 0.0)
+            _contribution += np.stack([_mask.astype(float), _a, _b, _a * _a, _b * _b, _a * _b])
+        return _contribution
+
+    def extend(self, first, last):
+        """
+        @brief Grows the grid so it covers a range of steps, moving its origin back when needed.
+        @param first The index of the first step to cover, possibly negative.
+        @param last The index of the last step to cover.
+        @return Returns the number of steps the existing steps were shifted by.
+        """
+        _before = max(0, -first)
+        _after = max(0, last + 1 - len(self.counts))
+        if _before or _after:
+            self.sums = np.pad(self.sums, ((0, 0), (_before, _after)))
+            self.counts = np.pad(self.counts, (_before, _after))
+            self.origin -= _before * self.lag_search.step_ms
+        return _before
+
+    def update(self, removed=(), added=()):
+        """
+        @brief Updates the statistics with pairs leaving and joining the series.
+        @param removed (Optional) A list of (time, x, y) tuples for pairs previously added and now gone or changed. Default is none.
+        @param added (Optional) A list of (time, x, y) tuples for new or changed pairs. Default is none.
+        @return Returns the number of grid steps whose value changed.
+        """
+        _deltas = {}
+        _step_ms = self.lag_search.step_ms
+        for _sign, _pairs in ((-1, removed), (1, added)):
+            for _time, _x, _y in _pairs:
+                _delta = _deltas.setdefault(int((int(_time) - self.origin) // _step_ms), np.zeros(3))
+                _delta += _sign * np.array([_x, _y, 1.0])
+        if not _deltas:
+            return 0
+
+        _shift = self.extend(min(_deltas), max(_deltas))
+        for _step in sorted(_deltas):
+            _delta = _deltas[_step]
+            _step += _shift
+            self.moments -= self.contribution(_step)
+            self.sums[:, _step] += _delta[:2]
+            self.counts[_step] += int(round(_delta[2]))
+            if self.counts[_step] == 0:
+                self.sums[:, _step] = 0.0
+            self.moments += self.contribution(_step)
+        self.moments[0] = np.rint(self.moments[0])
+        return len(_deltas)
+
+    def result(self):
+        """
+        @brief Gives the outcome of the lag search over the current statistics.
+        @return Returns a LagResult.
+        """
+        _index = np.arange(len(self.counts))
+        return LagResult(self.lags, self.lag_search.pearson(self.moments), self.moments[0].astype(int),
+                         self.values(0, _index), self.values(1, _index), self.lag_search.step_days)
+
+    def to_dict(self):
+        """
+        @brief Gives the statistics in a JSON friendly form.
+        @return Returns a dictionary, read back by from_dict.
+        """
+        return {'step_days': self.lag_search.step_days, 'min_overlap': self.lag_search.min_overlap, 'origin': self.origin,
+                'lags': self.lags.tolist(), 'center': list(self.center), 'sums': self.sums.tolist(),
+                'counts': self.counts.tolist(), 'moments': self.moments.tolist()}
+
+    @staticmethod
+    def from_dict(data):
+        """
+        @brief Rebuilds statistics saved by to_dict.
+        @param data A dictionary, as given by to_dict.
+        @return Returns an OnlineCorrelation.
+        """
+        _lag_search = LagSearch(step_days=data['step_days'], min_overlap=data['min_overlap'])
+        return OnlineCorrelation(_lag_search, data['origin'], data['lags'], data['center'], data['sums'], data['counts'], data['moments'])
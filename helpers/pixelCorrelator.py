@@ -0,0 +1,153 @@
+from concurrent.futures import ProcessPoolExecutor
+from helpers.tileFormat import read_tile, tile_shape, nodata_mask, row_blocks
+from helpers.lagSearch import LagSearch, LagResult
+from helpers.tileCache import atomic_save
+import numpy as np
+import tempfile
+import shutil
+import os
+
+# Bands of the correlation maps, in the order of the rows returned by correlate_rows.
+BANDS = ('correlation', 'best_correlation', 'best_lag_days', 'counts')
+
+def correlate_rows(stack_paths, rows, step_days, min_overlap, max_lag):
+    """
+    @brief Computes the correlation maps of a block of rows of the stacks. Executed in a worker process.
+    @param stack_paths A tuple with the paths of the reference and comparable stacks, .npy files of shape (T, H, W).
+    @param rows A slice of rows.
+    @param step_days The length of a grid step in days.
+    @param min_overlap The minimum number of overlapping pairs for a lag to be considered.
+    @param max_lag The largest lag in grid steps, or None for a quarter of T.
+    @return Returns a tuple with the slice of rows, a float32 array of shape (len(BANDS), rows, W) and the lags in grid
+    steps. The coefficients are NaN for the pixels without enough overlapping pairs.
+    """
+    _lag_search = LagSearch(step_days=step_days, min_overlap=min_overlap)
+    _x, _y = (np.moveaxis(np.asarray(np.load(_path, mmap_mode='r')[:, rows], dtype=np.float64), 0, -1) for _path in stack_paths)
+    _lags, _moments, _ = _lag_search.moments(_x, _y, max_lag)
+    _result = LagResult(_lags, _lag_search.pearson(_moments), _moments[0], _x, _y, step_days)
+
+    _zero = np.flatnonzero(_lags == 0)[0]
+    _valid = ~np.isnan(_result.corr).all(-1)
+    _maps = np.stack([_result.corr[..., _zero], np.where(_valid, _result.best_corr, np.nan),
+                      np.where(_valid, _result.best_lag_days, np.nan), _moments[0][..., _zero]])
+    return rows, _maps.astype(np.float32), _lags
+
+
+class PixelCorrelator:
+
+    def __init__(self, corr_list, times, tiles, lag_search, max_lag=None, stack_dir='./buffer/', max_values=1 << 22, max_workers=0):
+        """
+        @brief Constructor for the PixelCorrelator class, which correlates the time series of every pixel of the footprint.
+        The tiles of the pairs are averaged per step of the lag grid into two aligned (T, H, W) stacks on disk, nodata
+        pixels left out. The stacks are then correlated in blocks of rows, so memory stays bounded whatever the size of
+        the footprint and the length of the series.
+        @param corr_list A list of tuples, where each tuple contains two lists of image IDs from two different lists that fall within the same time interval.
+        @param times A list with the time in milliseconds of each pair.
+        @param tiles A tuple of two dictionaries mapping the image IDs of each list to their tile paths.
+        @param lag_search The LagSearch defining the grid step and the minimum overlap.
+        @param max_lag (Optional) The largest lag in grid steps. Default is None, a quarter of the grid length.
+        @param stack_dir (Optional) A string representing the directory of the temporary stacks. Default is './buffer/'.
+        @param max_values (Optional) The largest number of pixel x step values correlated at once. Default is 1 << 22.
+        @param max_workers (Optional) The number of worker processes. 0 correlates in the calling process. Default is 0.
+        """
+        self.corr_list = corr_list
+        self.times = times
+        self.tiles = tiles
+        self.lag_search = lag_search
+        self.max_lag = max_lag
+        self.stack_dir = stack_dir
+        self.max_values = max_values
+        self.max_workers = max_workers
+
+    def shape(self):
+        """
+        @brief Reads the shape shared by every tile of the pairs.
+        @return Returns a tuple with the height and width of the tiles.
+        @throws ValueError If the tiles do not all have the same shape.
+        """
+        _shapes = {tuple(tile_shape(self.tiles[_side][_img])) for _pair in self.corr_list for _side in (0, 1) for _img in _pair[_side]}
+        if len(_shapes) != 1:
+            raise ValueError(f"The tiles must share one shape to be stacked, found: {sorted(_shapes)}")
+        return _shapes.pop()
+
+    def average(self, side, images, rows):
+        """
+        @brief Averages the valid pixels of some tiles over a block of rows.
+        @param side 0 for images of the first list, 1 for images of the second list.
+        @param images A list of image IDs.
+        @param rows A slice of rows.
+        @return Returns a tuple with the sums and the counts of the valid pixels.
+        """
+        _sums, _counts = 0.0, 0
+        for _img in images:
+            _block = read_tile(self.tiles[side][_img])[rows]
+            _valid = ~nodata_mask(_block)
+            _sums = _sums + np.where(_valid, _block, 0).astype(np.float64)
+            _counts = _counts + _valid
+        return _sums, _counts
+
+    def build_stacks(self, stack_dir):
+        """
+        @brief Writes the reference and comparable stacks, one frame per step of the lag grid. A pixel of a frame is the
+        average over the pairs of the step of the average of their valid images, as for the values of ImageCorrelator.
+        @param stack_dir A string representing the directory of the stacks.
+        @return Returns a tuple with the paths of the two stacks.
+        """
+        _shape = self.shape()
+        _origin, _length = self.lag_search.grid(self.times)
+        _steps = {}
+        for _index, _step in enumerate(((np.asarray(self.times, dtype=np.float64) - _origin) // self.lag_search.step_ms).astype(int)):
+            _steps.setdefault(_step, []).append(self.corr_list[_index])
+
+        _paths = tuple(os.path.join(stack_dir, f'stack_{_side}.npy') for _side in (0, 1))
+        _stacks = [np.lib.format.open_memmap(_path, mode='w+', dtype=np.float32, shape=(_length,) + _shape) for _path in _paths]
+        for _step in range(_length):
+            for _side, _stack in enumerate(_stacks):
+                if _step not in _steps:
+                    _stack[_step] = np.nan
+                    continue
+                for _rows in row_blocks(*_shape, self.max_values):
+                    _sums, _counts = 0.0, 0
+                    for _pair in _steps[_step]:
+                        _pair_sums, _pair_counts = self.average(_side, _pair[_side], _rows)
+                        _valid = _pair_counts > 0
+                        _sums = _sums + np.where(_valid, _pair_sums / np.maximum(_pair_counts, 1), 0.0)
+                        _counts = _counts + _valid
+                    _stack[_step, _rows] = np.where(_counts > 0, _sums / np.maximum(_counts, 1), np.nan)
+        for _stack in _stacks:
+            _stack.flush()
+        return _paths
+
+    def compute(self, path):
+        """
+        @brief Computes the correlation maps and saves them as a compressed .npz raster with one (H, W) array per band of
+        BANDS, plus the searched lags in 'lags_days'. 'correlation' is the coefficient without shift, and 'counts' the
+        number of steps where both series hold a value, as uint32. The other bands are float32.
+        @param path A string representing the path of the raster.
+        @return Returns the path of the raster.
+        """
+        os.makedirs(self.stack_dir, exist_ok=True)
+        _dir = tempfile.mkdtemp(prefix='.stacks.', dir=self.stack_dir)
+        try:
+            _stacks = self.build_stacks(_dir)
+            _length, _height, _width = np.load(_stacks[0], mmap_mode='r').shape
+            _size = 1 << int(np.ceil(np.log2(max(2 * _length - 1, 1))))
+            _blocks = list(row_blocks(_height, _width, max(1, self.max_values // _size)))
+            _arguments = ([_stacks] * len(_blocks), _blocks, [self.lag_search.step_days] * len(_blocks),
+                          [self.lag_search.min_overlap] * len(_blocks), [self.max_lag] * len(_blocks))
+
+            if self.max_workers == 0 or len(_blocks) == 1:
+                _results = [correlate_rows(*_args) for _args in zip(*_arguments)]
+            else:
+                with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                    _results = list(executor.map(correlate_rows, *_arguments))
+        finally:
+            shutil.rmtree(_dir, ignore_errors=True)
+
+        _maps = np.full((len(BANDS), _height, _width), np.nan, dtype=np.float32)
+        for _rows, _block, _lags in _results:
+            _maps[:, _rows] = _block
+        _bands = dict(zip(BANDS, _maps))
+        _bands['counts'] = _bands['counts'].astype(np.uint32)
+        atomic_save(path, lambda tmp: np.savez_compressed(tmp, lags_days=_lags * self.lag_search.step_days, **_bands))
+        return path
@@ -0,0 +1,148 @@
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from helpers.tileCache import atomic_save
+from helpers.sqliteIndex import connect
+import matplotlib
+import seaborn as sns
+import numpy as np
+import hashlib
+import json
+import os
+
+STYLE_VERSION = 1
+
+def render_figure(spec, dpi=150):
+    """
+    @brief Renders a correlation scatter plot with the object-oriented Agg API, without touching the global pyplot state.
+    The figure matches ImageCorrelator.plot: points coloured by the ratio of x to y values, whitegrid style, bold font.
+    @param spec A dictionary with 'path', 'points' (list of (x, y) tuples) and 'title' (dictionary with 'title', 'xlabel' and 'ylabel') keys.
+    @param dpi (Optional) The resolution of the saved image. Default is 150.
+    @return Returns the path of the saved image.
+    """
+    _points = np.asarray(spec['points'], dtype=np.float64).reshape(-1, 2)
+    _title = spec['title']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        _ratio = _points[:, 0] / _points[:, 1]
+
+    with matplotlib.rc_context(dict(sns.axes_style('whitegrid'), **{'font.weight': 'bold'})):
+        _figure = Figure(figsize=(16, 8))
+        FigureCanvasAgg(_figure)
+        _axes = _figure.add_subplot()
+        _scatter = _axes.scatter(_points[:, 0], _points[:, 1], c=_ratio, cmap='viridis')
+        _figure.colorbar(_scatter, ax=_axes, label='ratio between %s \nand %s' % (_title['xlabel'], _title['ylabel']))
+        _axes.set_title(_title['title'])
+        _axes.set_xlabel(_title['xlabel'])
+        _axes.set_ylabel(_title['ylabel'])
+
+        _extension = os.path.splitext(spec['path'])[1][1:] or 'png'
+        atomic_save(spec['path'], lambda path: _figure.savefig(path, dpi=dpi, format=_extension))
+    return spec['path']
+
+def render_batch(specs, dpi=150):
+    """
+    @brief Renders a batch of figures. Executed in a worker process.
+    @param specs A list of figure specifications, as accepted by render_figure.
+    @param dpi (Optional) The resolution of the saved images. Default is 150.
+    @return Returns a list of tuples with the path of each figure and the error message of its failure, or None.
+    """
+    _results = []
+    for _spec in specs:
+        try:
+            render_figure(_spec, dpi)
+            _results.append((_spec['path'], None))
+        except Exception as error:
+            _results.append((_spec['path'], repr(error)))
+    return _results
+
+
+class PlotRenderer:
+
+    def __init__(self, plot_dir='./plots/', max_workers=None, batch_size=16, dpi=150):
+        """
+        @brief Constructor for the PlotRenderer class, which renders correlation figures outside of the compute path.
+        The pipeline only emits the data of each figure. Figures are rendered in batches by a pool of headless workers,
+        and a figure whose data did not change since its last rendering is skipped.
+        @param plot_dir (Optional) A string representing the directory of the figures and of their index. Default is './plots/'.
+        @param max_workers (Optional) The number of worker processes. 0 renders in the calling process. Default is None, one per CPU.
+        @param batch_size (Optional) The number of figures sent to a worker at once. Default is 16.
+        @param dpi (Optional) The resolution of the saved images. Default is 150.
+        """
+        self.plot_dir = plot_dir
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.dpi = dpi
+        self.index_path = os.path.join(plot_dir, 'plots.sqlite')
+
+        os.makedirs(plot_dir, exist_ok=True)
+        with connect(self.index_path) as _db:
+            _db.execute('CREATE TABLE IF NOT EXISTS plots (path TEXT PRIMARY KEY, hash TEXT NOT NULL, spec TEXT NOT NULL, '
+                        'rendered_hash TEXT, error TEXT)')
+
+    def path(self, name):
+        """
+        @brief Gives the location of a figure.
+        @param name The file name of the figure, e.g. 'dataset_normal.jpg'.
+        @return Returns a string representing the path of the figure.
+        """
+        return os.path.join(self.plot_dir, name)
+
+    def emit(self, path, points, title):
+        """
+        @brief Queues a figure for rendering. The figure is rendered again only if its data or style changed.
+        @param path A string representing the path of the figure.
+        @param points A list of (x, y) tuples.
+        @param title A dictionary containing the title, xlabel, and ylabel for the plot.
+        @return Returns the specification of the figure.
+        """
+        _spec = {'path': path, 'points': [[float(_x), float(_y)] for _x, _y in points], 'title': title}
+        _text = json.dumps(_spec, sort_keys=True)
+        _hash = hashlib.sha256(f'{STYLE_VERSION}:{self.dpi}:{_text}'.encode()).hexdigest()
+        with connect(self.index_path) as _db:
+            _db.execute('INSERT INTO plots (path, hash, spec) VALUES (?, ?, ?) ON CONFLICT (path) DO UPDATE SET '
+                        'hash = excluded.hash, spec = excluded.spec WHERE hash != excluded.hash', (path, _hash, _text))
+        return _spec
+
+    def pending(self):
+        """
+        @brief Lists the figures waiting for rendering: the new ones, the changed ones and the ones whose image is missing.
+        @return Returns a list of tuples with the hash and the specification of each figure.
+        """
+        with connect(self.index_path) as _db:
+            _rows = _db.execute('SELECT path, hash, spec, rendered_hash FROM plots').fetchall()
+        return [(_hash, json.loads(_spec)) for _path, _hash, _spec, _rendered in _rows
+                if _rendered != _hash or not os.path.exists(_path)]
+
+    def render(self, paths=None):
+        """
+        @brief Renders the pending figures in batches.
+        @param paths (Optional) A list restricting the rendering to these figures. Default is None, every pending figure.
+        @return Returns a list with the paths of the rendered figures. Failures are stored in the index and printed.
+        """
+        _pending = self.pending()
+        if paths is not None:
+            paths = set(paths)
+            _pending = [_p for _p in _pending if _p[1]['path'] in paths]
+        if not _pending:
+            return []
+
+        _hashes = {_spec['path']: _hash for _hash, _spec in _pending}
+        _batches = [[_spec for _, _spec in _pending[_i:_i + self.batch_size]] for _i in range(0, len(_pending), self.batch_size)]
+
+        if self.max_workers == 0 or len(_batches) == 1:
+            _results = [render_batch(_batch, self.dpi) for _batch in _batches]
+        else:
+            with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                _results = list(executor.map(render_batch, _batches, [self.dpi] * len(_batches)))
+
+        rendered = []
+        with connect(self.index_path) as _db:
+            for _path, _error in (_r for _batch in _results for _r in _batch):
+                if _error is None:
+                    rendered.append(_path)
+                    _db.execute('UPDATE plots SET rendered_hash = ?, error = NULL WHERE path = ? AND hash = ?',
+                                (_hashes[_path], _path, _hashes[_path]))
+                else:
+                    print(f"Rendering of {_path} failed: {_error}")
+                    _db.execute('UPDATE plots SET error = ? WHERE path = ?', (_error, _path))
+        return rendered
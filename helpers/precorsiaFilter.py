@@ -1,47 +1,108 @@
 # Importing data processing tools
-import matplotlib.pyplot as plt
-import numpy as np
+from helpers.lagSearch import LagSearch, DAY_MS
+from helpers.onlineCorrelation import OnlineCorrelation
+from helpers.pixelCorrelator import PixelCorrelator
+from helpers.temporalJoin import TemporalJoin
+from helpers.tileStats import TileStats
+from helpers.imageCatalog import ImageCatalog
+from helpers.resultsStore import ResultsStore
+from helpers.plotRenderer import PlotRenderer
+from helpers.instrumentation import Metrics
+import hashlib
 import json
+import os
 
 class PrecorsiaFilter:
 
+    EXPECTED_KEYS = [
+        "climate", "start_date", "days", "geolocation", "image_scale", "round_factor",
+        "reference_dataset", "comparable_dataset", "reference_band_name",
+        "reference_band_range", "reference_band_unit", "comparable_band_name", 
+        "comparable_band_range", "comparable_band_unit", "gee", 
+        "imageCorrelator", "imageProcessor"
+    ]
+
     def __init__(self, configuration):
 
-        expected_keys = [
-            "climate", "start_date", "days", "geolocation", "image_scale", "round_factor",
-            "reference_dataset", "comparable_dataset", "reference_band_name",
-            "reference_band_range", "reference_band_unit", "comparable_band_name", 
-            "comparable_band_range", "comparable_band_unit", "gee", 
-            "imageCorrelator", "imageProcessor"
-        ]
+        self.check(configuration)
+
+        self.imageCorrelator = configuration["imageCorrelator"]
+
+        self.reference_dataset = configuration["reference_dataset"]
+        self.comparable_dataset = configuration["comparable_dataset"]
 
+        self.reference_band_name = configuration["reference_band_name"]
+        self.reference_band_range = configuration["reference_band_range"]
+        self.reference_band_unit = configuration["reference_band_unit"]
+        self.comparable_band_name = configuration["comparable_band_name"]
+        self.comparable_band_range = configuration["comparable_band_range"]
+        self.comparable_band_unit = configuration["comparable_band_unit"]
+
+        self.configure(configuration)
+
+        if self.pixel_maps and (self.mode == 'reduce' or self.incremental):
+            raise ValueError("Pixel maps need the tiles of every pair, they cannot be computed in 'reduce' mode or incrementally.")
+
+    def check(self, configuration):
+        """
+        @brief Checks that a configuration is a dictionary holding every key of EXPECTED_KEYS.
+        @param configuration The configuration given to the constructor.
+        @throws TypeError If the configuration is not a dictionary.
+        @throws ValueError If keys are missing from the configuration.
+        """
         if not isinstance(configuration, dict):
             raise TypeError("Configuration must be a dictionary.")
 
-        missing_keys = [key for key in expected_keys if key not in configuration]
+        missing_keys = [key for key in self.EXPECTED_KEYS if key not in configuration]
         if missing_keys:
             raise ValueError(f"Missing keys in configuration: {missing_keys}")
 
+    def configure(self, configuration):
+        """
+        @brief Reads the study settings shared by every dataset, and the optional settings with their defaults.
+        @param configuration The configuration given to the constructor.
+        """
         self.gee = configuration["gee"]
-        self.imageCorrelator = configuration["imageCorrelator"]
         self.imageProcessor = configuration["imageProcessor"]
        
-        self.START, self.END = self.gee.date_daily(configuration["start_date"], configuration["days"])
+        self.start_date = configuration["start_date"]
+        self.days = configuration["days"]
+        self.START, self.END = self.gee.date_daily(self.start_date, self.days)
         self.geolocation = configuration["geolocation"]
         self.image_scale = configuration["image_scale"]
         self.round_factor = configuration["round_factor"]
 
-        self.reference_dataset = configuration["reference_dataset"]
-        self.comparable_dataset = configuration["comparable_dataset"]
+        self.climate = configuration["climate"]
 
-        self.reference_band_name = configuration["reference_band_name"]
-        self.reference_band_range = configuration["reference_band_range"]
-        self.reference_band_unit = configuration["reference_band_unit"]
-        self.comparable_band_name = configuration["comparable_band_name"]
-        self.comparable_band_range = configuration["comparable_band_range"]
-        self.comparable_band_unit = configuration["comparable_band_unit"]
+        self.download_concurrency = configuration.get("download_concurrency", 1)
+        self.download_rate = configuration.get("download_rate", None)
+        self.tile_cache = configuration.get("tile_cache", None)
+        self.tile_format = configuration.get("tile_format", "png")
+        self.tile_stats = configuration.get("tile_stats", None)
+        self.mode = configuration.get("mode", "tiles")
+        self.pixel_scale = configuration.get("pixel_scale", None)
+        self.mosaic_tile_size = configuration.get("mosaic_tile_size", 512)
+        self.image_catalog = configuration.get("image_catalog", None)
+        self.results_store = configuration.get("results_store", None)
+        self.render = configuration.get("render", "off")
+        self.plot_renderer = configuration.get("plot_renderer", None)
+        self.metrics = configuration.get("metrics", None) or Metrics(labels=self.metric_labels())
+        self.metrics_log = configuration.get("metrics_log", None)
+        self.metrics_textfile = configuration.get("metrics_textfile", None)
+        self.incremental = configuration.get("incremental", False)
+        self.online = None
+        self.buckets = None
+        self.pixel_maps = configuration.get("pixel_maps", False)
+        self.pixel_workers = configuration.get("pixel_workers", 0)
+        self.map_file = None
 
-        self.climate = configuration["climate"]
+    def metric_labels(self):
+        """
+        @brief Gives the labels of the metrics of the study.
+        @return Returns a dictionary.
+        """
+        return {'reference_dataset': self.reference_dataset, 'comparable_dataset': self.comparable_dataset, 'climate': self.climate,
+                'longitude': self.geolocation[0], 'latitude': self.geolocation[1]}
 
     @staticmethod
     def initialize(PrecorsiaGee):
@@ -51,20 +112,167 @@ class PrecorsiaFilter:
             PrecorsiaGee.initLogin()
 
     def execute(self):
-        self.gds_one = self.gee(self.reference_dataset, self.reference_band_range)
-        self.gds_two = self.gee(self.comparable_dataset, self.comparable_band_range)
+        """
+        @brief Runs every stage of the study: listing, download, zero counting filter and correlation, then the per-pixel
+        correlation maps when enabled.
+        In incremental mode, only the images of the time buckets that changed since the last run are downloaded, filtered and averaged.
+        The tile cache is trimmed to its max_bytes once the run is over.
+        @return Returns the path of the JSON file with the results.
+        """
+        self.prepare()
+        self.timed('list', self.list_stage)
+        if self.incremental:
+            self.timed('delta', self.delta_stage)
+        self.timed('download', self.download_stage)
+        self.timed('filter', self.filter_stage)
+        file_name = self.timed('correlate', self.correlate_stage)
+        if self.pixel_maps:
+            self.timed('pixel_map', self.pixel_map_stage)
+        self.store_results(file_name)
+        self.export_metrics()
+        if self.tile_cache is not None:
+            self.tile_cache.evict()
+        return file_name
+
+    def timed(self, name, stage):
+        """
+        @brief Runs a stage inside a stage of the metrics, which records its wall time and counters and notifies the hooks.
+        @param name The name of the stage.
+        @param stage A callable running the stage.
+        @return Returns the result of the stage.
+        """
+        with self.metrics.stage(name):
+            return stage()
+
+    def export_metrics(self):
+        """
+        @brief Writes the metrics of the run to the structured log and the Prometheus textfile, when configured.
+        """
+        if self.metrics_log is not None:
+            self.metrics.write_log(self.metrics_log)
+        if self.metrics_textfile is not None:
+            self.metrics.write_prometheus(self.metrics_textfile)
+
+    def prepare(self):
+        """
+        @brief Creates the dataset objects, the statistics index, the image catalogue, the results store and the plot renderer used by the stages.
+        """
+        if self.image_catalog is None:
+            self.image_catalog = ImageCatalog()
+        if self.results_store is None:
+            self.results_store = ResultsStore()
+        if self.plot_renderer is None and self.render != 'off':
+            self.plot_renderer = PlotRenderer(max_workers=0 if self.render == 'inline' else None)
+        self.buffer_dir = self.tile_cache.cache_dir if self.tile_cache is not None else './buffer/'
+        if self.tile_stats is None:
+            self.tile_stats = TileStats(self.buffer_dir)
+        self.create_datasets()
 
-        self.gds_one_list = self.gds_one.list(self.geolocation, [self.START, self.END])
-        self.gds_two_list = self.gds_two.list(self.geolocation, [self.START, self.END])
+    def create_datasets(self):
+        """
+        @brief Creates the PrecorsiaGee object of each dataset.
+        """
+        self.gds_one = self.gee(self.reference_dataset, self.reference_band_range, file_format=self.tile_format, metrics=self.metrics)
+        self.gds_two = self.gee(self.comparable_dataset, self.comparable_band_range, file_format=self.tile_format, metrics=self.metrics)
+
+    def list_stage(self):
+        """
+        @brief Lists the images of both datasets and keeps the ones whose dates match.
+        """
+        self.gds_one_list = self.gds_one.list(self.geolocation, [self.START, self.END], catalog=self.image_catalog)
+        self.gds_two_list = self.gds_two.list(self.geolocation, [self.START, self.END], catalog=self.image_catalog)
         self.gds_one_list, self.gds_two_list = self.gee.correlate_dates(self.gds_one_list, self.gds_two_list, self.round_factor)
+        self.metrics.count('images_matched', len(self.gds_one_list) + len(self.gds_two_list))
+
+    def online_key(self):
+        """
+        @brief Builds the key of the incremental state of this study. The number of days is left out, so a longer window
+        continues the state of a shorter one.
+        @return Returns a string.
+        """
+        return json.dumps([self.reference_dataset, self.reference_band_name, self.reference_band_range, self.comparable_dataset,
+                           self.comparable_band_name, self.comparable_band_range, [float(_c) for _c in self.geolocation],
+                           str(self.start_date), self.image_scale, self.pixel_scale, self.round_factor, self.mode, self.tile_format])
+
+    def delta_stage(self):
+        """
+        @brief Keeps only the listed images of the time buckets that changed since the last incremental run of this study.
+        A bucket changed when its listed images differ. Without a previous state, every image is kept and the run is a full one.
+        """
+        _bucket_ms = 10**self.round_factor
+        _join = TemporalJoin.buckets(self.gds_one_list, self.gds_two_list, _bucket_ms)
+        self.buckets = {str(_time): hashlib.sha1(json.dumps([sorted(_ids_one), sorted(_ids_two)]).encode()).hexdigest()[:16]
+                        for _time, (_ids_one, _ids_two) in zip(_join.times, _join.pairs)}
+
+        _state = self.results_store.load_state(self.online_key())
+        if _state is None:
+            return
+        self.previous_run_id, _state = _state
+        self.online = OnlineCorrelation.from_dict(_state['correlation'])
+        self.changed = {_time for _time, _hash in self.buckets.items() if _state['buckets'].get(_time) != _hash}
+        self.changed |= set(_state['buckets']) - set(self.buckets)
+
+        self.gds_one_list = [_img for _img in self.gds_one_list if str(_img['time_start'] // _bucket_ms * _bucket_ms) in self.changed]
+        self.gds_two_list = [_img for _img in self.gds_two_list if str(_img['time_start'] // _bucket_ms * _bucket_ms) in self.changed]
+        self.metrics.count('buckets_changed', len(self.changed))
 
-        self.gee.download_images(self.gds_one_list, self.gds_one, self.reference_band_name, self.geolocation, self.image_scale)
-        self.gee.download_images(self.gds_two_list, self.gds_two, self.comparable_band_name, self.geolocation, self.image_scale)
+    def merge_pairs(self):
+        """
+        @brief Merges the pairs of the changed buckets with the other pairs of the previous run, and updates the online
+        statistics with the pairs that left and joined the series.
+        """
+        _previous = self.results_store.pairs(self.previous_run_id)
+        _removed = [(_p['time_start'], _p['reference_value'], _p['comparable_value']) for _p in _previous if str(_p['time_start']) in self.changed]
+        _added = [(_time, _x, _y) for _time, (_x, _y) in zip(self.pair_times, self.corr_avr)]
+        self.online.update(_removed, _added)
+        self.metrics.count('pairs_updated', len(_removed) + len(_added))
 
-        process = self.imageProcessor([self.gds_one_list, self.gds_two_list])
-        [self.gds_one_lz, self.gds_two_lz] = process.zero_counting_filter()
+        _merged = sorted([(_p['time_start'], (_p['reference_ids'], _p['comparable_ids']), (_p['reference_value'], _p['comparable_value']))
+                          for _p in _previous if str(_p['time_start']) not in self.changed]
+                         + list(zip(self.pair_times, self.corr_list, self.corr_avr)), key=lambda _p: _p[0])
+        self.pair_times = [_p[0] for _p in _merged]
+        self.corr_list = [_p[1] for _p in _merged]
+        self.corr_avr = [_p[2] for _p in _merged]
 
-        self.corr_list = self.gee.connected_correlation(self.gds_one_lz, self.gds_two_lz, self.round_factor)
+    def download_stage(self):
+        """
+        @brief Downloads the listed images of every dataset of downloads(). In 'reduce' mode, fetches their statistics instead.
+        With a pixel_scale, the footprint is fetched at that pixel size as tiled, memory-mapped mosaics.
+        """
+        for _gds, _list, _band_name in self.downloads():
+            _gds.fetch(_list, _band_name, self.geolocation, self.image_scale, self.mode, self.pixel_scale, self.mosaic_tile_size,
+                       concurrency=self.download_concurrency, rate=self.download_rate, cache=self.tile_cache, stats=self.tile_stats)
+
+    def downloads(self):
+        """
+        @brief Lists what the download stage fetches.
+        @return Returns a list of tuples with the PrecorsiaGee object, the image list and the band name of each dataset.
+        """
+        return [(self.gds_one, self.gds_one_list, self.reference_band_name), (self.gds_two, self.gds_two_list, self.comparable_band_name)]
+
+    def filter_stage(self):
+        """
+        @brief Runs the zero counting filter over the downloaded images of both datasets.
+        The gap-filled images are written as copies next to the cache, which keeps the downloaded tiles untouched.
+        In 'reduce' mode there are no tiles to gap-fill, so the images are only discarded by their proportion of nodata pixels.
+        """
+        process = self.imageProcessor([self.gds_one_list, self.gds_two_list], stats=self.tile_stats,
+                                      filled_dir=os.path.join(self.buffer_dir, 'filled'), cache=self.tile_cache)
+        if self.mode == 'reduce':
+            self.gds_one_lz = process.discard_images(self.gds_one_list)
+            self.gds_two_lz = process.discard_images(self.gds_two_list)
+        else:
+            [self.gds_one_lz, self.gds_two_lz] = process.zero_counting_filter()
+        self.metrics.count('images_kept', len(self.gds_one_lz) + len(self.gds_two_lz))
+
+    def correlate_stage(self):
+        """
+        @brief Pairs the filtered images, finds the best shift between the datasets and saves the plots and results.
+        @return Returns the path of the JSON file with the results.
+        @throws ValueError If no pair of images is left after filtering.
+        """
+        self.join = TemporalJoin.buckets(self.gds_one_lz, self.gds_two_lz, 10**self.round_factor)
+        self.corr_list = self.join.pairs
 
         title = {'title': f'Correlation between {self.gds_one.dataset} and \n{self.gds_two.dataset} at {self.geolocation}',
         'xlabel': f"average {self.reference_band_unit} of {self.reference_band_name} per pixel [{self.gds_one.dataset}]",
@@ -72,52 +280,104 @@ class PrecorsiaFilter:
 
         self.gds_two_dataset_name = self.gds_two.dataset.replace('/', '_')
 
-        self.corr_study = self.imageCorrelator(self.corr_list)
+        if self.mode == 'reduce':
+            self.means = ({img['id']: img['mean'] for img in self.gds_one_lz}, {img['id']: img['mean'] for img in self.gds_two_lz})
+            self.corr_study = self.imageCorrelator(self.corr_list, means=self.means)
+        else:
+            self.tiles = ({img['id']: img['path'] for img in self.gds_one_lz}, {img['id']: img['path'] for img in self.gds_two_lz})
+            self.corr_study = self.imageCorrelator(self.corr_list, tiles=self.tiles, stats=self.tile_stats)
         self.corr_avr = self.corr_study.calculate_correlation()
-        self.corr_avr = [(x * (self.reference_band_range[1] / 255), y * (self.comparable_band_range[1] / 255)) for x, y in self.corr_avr]
+        if self.tile_format != 'raw' and self.mode != 'reduce':
+            self.corr_avr = [(x * (self.reference_band_range[1] / 255), y * (self.comparable_band_range[1] / 255)) for x, y in self.corr_avr]
 
-        self.imageCorrelator.plot(self.corr_avr, title)
-        plt.savefig(f'plots/{self.gds_two_dataset_name}_{self.climate}_{self.geolocation[0]}_{self.geolocation[1]}_{self.START.args.get("value")}_{self.END.args.get("delta")._number}_normal.jpg', dpi=150)
-        plt.close()
 
+        self.pair_times = self.join.times
+        if self.online is not None:
+            self.merge_pairs()
+        if not self.corr_avr:
+            raise ValueError(f"No pairs of images left to correlate between {self.reference_dataset} and {self.comparable_dataset} after filtering.")
         self.x_values, self.y_values = zip(*self.corr_avr)
-        self.best_shifted_corr_avr = []
-        self.best_shift = 0
-        
-        self.best_corr = np.corrcoef(self.x_values, self.y_values)[0, 1]
-        if np.isnan(self.best_corr): self.best_corr = 0
-
-
-        for i in range(-int(len(self.x_values)/4), int(len(self.x_values)/4), 1):
-
-            if (i == 0): continue
-            
-            if i > 0:
-                shifted_y_values = self.y_values[:-i]
-                shifted_x_values = self.x_values[i:]
-            else:
-                shifted_y_values = self.y_values[-i:]
-                shifted_x_values = self.x_values[:i]
-
-            if len(shifted_y_values) > 1 and len(shifted_x_values) > 1:
-                shifted_corr_avr = list(zip(shifted_x_values, shifted_y_values))
-                corr = np.corrcoef(shifted_x_values, shifted_y_values)[0, 1]
-
-            if corr > self.best_corr:
-                self.best_corr = corr
-                self.best_shift = i
-                self.best_shifted_corr_avr = shifted_corr_avr
-
-        self.imageCorrelator.plot(self.best_shifted_corr_avr, title)
-        plt.savefig(f'plots/{self.gds_two_dataset_name}_{self.climate}_{self.geolocation[0]}_{self.geolocation[1]}_{self.START.args.get("value")}_{self.END.args.get("delta")._number}_shifted.jpg', dpi=150)
-        plt.close()
-        print(f"Best shift: {self.best_shift}, Best correlation: {self.best_corr}")
+
+        if self.online is not None:
+            self.lag_result = self.online.result()
+        else:
+            self.lag_search = LagSearch(step_days=max(1, 10**self.round_factor / DAY_MS))
+            self.lag_result = self.lag_search.search(self.pair_times, self.x_values, self.pair_times, self.y_values)
+            if self.buckets is not None:
+                self.online = OnlineCorrelation.build(self.lag_search, self.pair_times, self.x_values, self.y_values,
+                                                      int(self.lag_result.lags.max()))
+        self.best_shift = float(self.lag_result.best_lag_days)
+        self.best_corr = float(self.lag_result.best_corr)
+        self.best_shifted_corr_avr = self.lag_result.pairs(int(self.lag_result.best_lag))
+
+        self.plot_stage(title)
+        print(f"Best shift: {self.best_shift} days, Best correlation: {self.best_corr}")
 
         data = {"best_correlation": self.best_corr}
         data["best_shift"] = self.best_shift
+        data["lag_curve"] = self.lag_result.curve()
         data["correlation_list"] = self.corr_list
         file_name = f'data/corr_list_{self.gds_two_dataset_name}_{self.climate}_{self.geolocation[0]}_{self.geolocation[1]}_{self.START.args.get("value")}_{self.END.args.get("delta")._number}.json'
         with open(file_name, 'w') as file:
             json.dump(data, file)
 
-        return file_name
\ No newline at end of file
+        return file_name
+
+    def pixel_map_stage(self):
+        """
+        @brief Computes the correlation and best shift of every pixel over the pairs, with the lags of the correlation stage,
+        and saves them as a compressed raster next to the JSON results.
+        @return Returns the path of the raster.
+        """
+        _correlator = PixelCorrelator(self.corr_list, self.pair_times, self.tiles, self.lag_search, int(self.lag_result.lags.max()),
+                                      stack_dir=self.buffer_dir,
+                                      max_workers=self.pixel_workers)
+        self.map_file = _correlator.compute(f'data/corr_map_{self.gds_two_dataset_name}_{self.climate}_{self.geolocation[0]}_{self.geolocation[1]}_{self.START.args.get("value")}_{self.END.args.get("delta")._number}.npz')
+        return self.map_file
+
+    def plot_stage(self, title):
+        """
+        @brief Emits the normal and shifted correlation figures to the plot renderer, according to the 'render' setting:
+        'off' skips them, 'deferred' only queues their data for a later PlotRenderer.render() and 'inline' also renders them now.
+        @param title A dictionary containing the title, xlabel, and ylabel for the plots.
+        @return Returns the list of emitted figure paths.
+        """
+        if self.render == 'off':
+            return []
+        if self.render not in ('inline', 'deferred'):
+            raise ValueError(f"Unknown render setting: {self.render}")
+
+        name = f'{self.gds_two_dataset_name}_{self.climate}_{self.geolocation[0]}_{self.geolocation[1]}_{self.START.args.get("value")}_{self.END.args.get("delta")._number}'
+        paths = [self.plot_renderer.path(f'{name}_normal.jpg'), self.plot_renderer.path(f'{name}_shifted.jpg')]
+        self.plot_renderer.emit(paths[0], self.corr_avr, title)
+        self.plot_renderer.emit(paths[1], self.best_shifted_corr_avr, title)
+
+        if self.render == 'inline':
+            self.plot_renderer.render(paths)
+        return paths
+
+    def store_results(self, file_name):
+        """
+        @brief Appends the outcome of the correlation stage, its pairs, the stage timings and the metrics to the results store.
+        In incremental mode, the online statistics are saved next to the run.
+        @param file_name The path of the JSON file with the results.
+        @return Returns the run_id of the stored run.
+        """
+        run = {
+            'reference_dataset': self.reference_dataset, 'comparable_dataset': self.comparable_dataset, 'climate': self.climate,
+            'longitude': float(self.geolocation[0]), 'latitude': float(self.geolocation[1]), 'start_date': str(self.start_date),
+            'days': int(self.days), 'image_scale': self.image_scale, 'pixel_scale': self.pixel_scale, 'round_factor': self.round_factor, 'mode': self.mode,
+            'best_correlation': self.best_corr, 'best_shift': self.best_shift, 'n_pairs': len(self.corr_list), 'file_name': file_name,
+            'map_file': self.map_file
+        }
+        run.update((f'{_name}_seconds', _seconds) for _name, _seconds in self.metrics.timings().items()
+                   if f'{_name}_seconds' in ResultsStore.RUN_COLUMNS)
+        run['metrics'] = json.dumps(self.metrics.to_dict()['stages'])
+
+        pairs = [{'time_start': int(_time), 'reference_ids': _ids_one, 'comparable_ids': _ids_two,
+                  'reference_value': float(_x), 'comparable_value': float(_y)}
+                 for _time, (_ids_one, _ids_two), (_x, _y) in zip(self.pair_times, self.corr_list, self.corr_avr)]
+        self.run_id = self.results_store.add_run(run, pairs)
+        if self.online is not None and self.buckets is not None:
+            self.results_store.save_state(self.online_key(), self.run_id, {'correlation': self.online.to_dict(), 'buckets': self.buckets})
+        return self.run_id
@@ -0,0 +1,193 @@
+from helpers.sqliteIndex import connect
+import json
+import time
+import os
+
+class ResultsStore:
+
+    RUN_COLUMNS = {
+        'run_id': 'INTEGER PRIMARY KEY AUTOINCREMENT',
+        'created': 'REAL NOT NULL',
+        'reference_dataset': 'TEXT NOT NULL',
+        'comparable_dataset': 'TEXT NOT NULL',
+        'climate': 'TEXT',
+        'longitude': 'REAL',
+        'latitude': 'REAL',
+        'start_date': 'TEXT',
+        'days': 'INTEGER',
+        'image_scale': 'REAL',
+        'pixel_scale': 'REAL',
+        'round_factor': 'INTEGER',
+        'mode': 'TEXT',
+        'best_correlation': 'REAL',
+        'best_shift': 'REAL',
+        'n_pairs': 'INTEGER',
+        'list_seconds': 'REAL',
+        'download_seconds': 'REAL',
+        'filter_seconds': 'REAL',
+        'correlate_seconds': 'REAL',
+        'pixel_map_seconds': 'REAL',
+        'file_name': 'TEXT',
+        'map_file': 'TEXT',
+        'metrics': 'TEXT'
+    }
+    PAIR_COLUMNS = {
+        'run_id': 'INTEGER NOT NULL REFERENCES runs (run_id)',
+        'pair_index': 'INTEGER NOT NULL',
+        'time_start': 'INTEGER',
+        'reference_ids': 'TEXT NOT NULL',
+        'comparable_ids': 'TEXT NOT NULL',
+        'reference_value': 'REAL',
+        'comparable_value': 'REAL'
+    }
+    FUNCTIONS = ('count', 'avg', 'min', 'max', 'sum')
+
+    def __init__(self, store_dir='./data/'):
+        """
+        @brief Constructor for the ResultsStore class, an append-only table of correlation results.
+        Every run is one typed row of the runs table, and its image pairs are rows of the pairs table, so a sweep can be
+        filtered and aggregated in SQL instead of parsing one JSON file per run.
+        @param store_dir (Optional) A string representing the directory of the store. Default is './data/'.
+        """
+        self.index_path = os.path.join(store_dir, 'results.sqlite')
+
+        os.makedirs(store_dir, exist_ok=True)
+        with connect(self.index_path) as _db:
+            _db.execute('CREATE TABLE IF NOT EXISTS runs (%s)' % ', '.join(f'{_k} {_t}' for _k, _t in self.RUN_COLUMNS.items()))
+            _db.execute('CREATE TABLE IF NOT EXISTS pairs (%s, PRIMARY KEY (run_id, pair_index))'
+                        % ', '.join(f'{_k} {_t}' for _k, _t in self.PAIR_COLUMNS.items()))
+            _db.execute('CREATE TABLE IF NOT EXISTS online (key TEXT PRIMARY KEY, run_id INTEGER NOT NULL REFERENCES runs (run_id), '
+                        'state TEXT NOT NULL)')
+            _existing = {_row[1] for _row in _db.execute('PRAGMA table_info(runs)')}
+            for _column, _type in self.RUN_COLUMNS.items():
+                if _column not in _existing:
+                    _db.execute(f'ALTER TABLE runs ADD COLUMN {_column} {_type}')
+            _db.execute('CREATE INDEX IF NOT EXISTS runs_datasets ON runs (comparable_dataset, climate)')
+
+    @staticmethod
+    def where(columns, filters):
+        """
+        @brief Builds the WHERE clause of a query.
+        @param columns The names of the columns that can be filtered.
+        @param filters A dictionary mapping column names to a value, or to a list of accepted values.
+        @return Returns a tuple with the clause and its parameters.
+        @throws ValueError If a filter names an unknown column.
+        """
+        _clauses, _params = [], []
+        for _column, _value in filters.items():
+            if _column not in columns:
+                raise ValueError(f"Unknown column: {_column}")
+            if isinstance(_value, (list, tuple, set)):
+                _value = list(_value)
+                _clauses.append(f'{_column} IN ({",".join("?" * len(_value))})')
+                _params.extend(_value)
+            elif _value is None:
+                _clauses.append(f'{_column} IS NULL')
+            else:
+                _clauses.append(f'{_column} = ?')
+                _params.append(_value)
+        return (' WHERE ' + ' AND '.join(_clauses)) if _clauses else '', _params
+
+    def add_run(self, run, pairs=()):
+        """
+        @brief Appends a run and its pairs in a single transaction.
+        @param run A dictionary mapping names of RUN_COLUMNS to values. Missing columns are NULL.
+        @param pairs (Optional) A list of dictionaries mapping names of PAIR_COLUMNS to values, without 'run_id' and 'pair_index'.
+        The id lists are stored as JSON. Default is no pair.
+        @return Returns the run_id of the new run.
+        """
+        run = dict(run, created=run.get('created', time.time()))
+        _columns = [_k for _k in self.RUN_COLUMNS if _k in run and _k != 'run_id']
+        _pair_columns = list(self.PAIR_COLUMNS)
+
+        with connect(self.index_path) as _db:
+            _run_id = _db.execute(f'INSERT INTO runs ({", ".join(_columns)}) VALUES ({",".join("?" * len(_columns))})',
+                                  [run[_k] for _k in _columns]).lastrowid
+            _rows = []
+            for _index, _pair in enumerate(pairs):
+                _pair = dict(_pair, run_id=_run_id, pair_index=_index,
+                             reference_ids=json.dumps(list(_pair['reference_ids'])), comparable_ids=json.dumps(list(_pair['comparable_ids'])))
+                _rows.append([_pair.get(_k) for _k in _pair_columns])
+            _db.executemany(f'INSERT INTO pairs ({", ".join(_pair_columns)}) VALUES ({",".join("?" * len(_pair_columns))})', _rows)
+        return _run_id
+
+    def runs(self, columns=None, order_by='run_id', limit=None, **filters):
+        """
+        @brief Reads runs from the store.
+        @param columns (Optional) The names of the columns to read. Default is None, every column.
+        @param order_by (Optional) The column sorting the runs. Default is 'run_id'.
+        @param limit (Optional) The maximum number of runs. Default is None, no limit.
+        @param filters Equality filters on run columns, e.g. climate='Af' or comparable_dataset=['A', 'B'].
+        @return Returns a list of dictionaries, one per run.
+        """
+        columns = list(self.RUN_COLUMNS) if columns is None else list(columns)
+        if any(_c not in self.RUN_COLUMNS for _c in columns + [order_by]):
+            raise ValueError(f"Unknown column in: {columns + [order_by]}")
+
+        _where, _params = ResultsStore.where(self.RUN_COLUMNS, filters)
+        _query = f'SELECT {", ".join(columns)} FROM runs{_where} ORDER BY {order_by}'
+        if limit is not None:
+            _query += ' LIMIT ?'
+            _params.append(int(limit))
+        with connect(self.index_path) as _db:
+            return [dict(zip(columns, _row)) for _row in _db.execute(_query, _params)]
+
+    def aggregate(self, group_by, value='best_correlation', functions=('count', 'avg', 'min', 'max'), **filters):
+        """
+        @brief Aggregates a column of the runs by groups.
+        @param group_by A column name, or a list of column names, defining the groups, e.g. 'climate'.
+        @param value (Optional) The column aggregated. Default is 'best_correlation'.
+        @param functions (Optional) The SQL aggregate functions applied, among FUNCTIONS. Default is ('count', 'avg', 'min', 'max').
+        @param filters Equality filters on run columns, applied before grouping.
+        @return Returns a list of dictionaries with the group columns and one '<function>_<value>' key per function.
+        """
+        group_by = [group_by] if isinstance(group_by, str) else list(group_by)
+        if any(_c not in self.RUN_COLUMNS for _c in group_by + [value]):
+            raise ValueError(f"Unknown column in: {group_by + [value]}")
+        if any(_f not in self.FUNCTIONS for _f in functions):
+            raise ValueError(f"Unknown function in: {functions}")
+
+        _names = group_by + [f'{_f}_{value}' for _f in functions]
+        _where, _params = ResultsStore.where(self.RUN_COLUMNS, filters)
+        _query = (f'SELECT {", ".join(group_by + [f"{_f}({value})" for _f in functions])} FROM runs{_where} '
+                  f'GROUP BY {", ".join(group_by)} ORDER BY {", ".join(group_by)}')
+        with connect(self.index_path) as _db:
+            return [dict(zip(_names, _row)) for _row in _db.execute(_query, _params)]
+
+    def pairs(self, run_id):
+        """
+        @brief Reads the pairs of a run.
+        @param run_id The run_id of the run.
+        @return Returns a list of dictionaries, one per pair, in pair order. The id lists are decoded.
+        """
+        _columns = list(self.PAIR_COLUMNS)
+        with connect(self.index_path) as _db:
+            _rows = _db.execute(f'SELECT {", ".join(_columns)} FROM pairs WHERE run_id = ? ORDER BY pair_index', (run_id,)).fetchall()
+
+        _pairs = []
+        for _row in _rows:
+            _pair = dict(zip(_columns, _row))
+            _pair['reference_ids'] = json.loads(_pair['reference_ids'])
+            _pair['comparable_ids'] = json.loads(_pair['comparable_ids'])
+            _pairs.append(_pair)
+        return _pairs
+
+    def load_state(self, key):
+        """
+        @brief Reads the incremental state of a series of runs, as saved by save_state.
+        @param key A string identifying the series, e.g. its datasets, location and parameters.
+        @return Returns a tuple with the run_id of the last run and the decoded state, or None if the series has no state.
+        """
+        with connect(self.index_path) as _db:
+            _row = _db.execute('SELECT run_id, state FROM online WHERE key = ?', (key,)).fetchone()
+        return None if _row is None else (_row[0], json.loads(_row[1]))
+
+    def save_state(self, key, run_id, state):
+        """
+        @brief Stores the incremental state of a series of runs next to its last run, replacing the previous state.
+        @param key A string identifying the series.
+        @param run_id The run_id of the run the state was updated by.
+        @param state A JSON serialisable object.
+        """
+        with connect(self.index_path) as _db:
+            _db.execute('INSERT OR REPLACE INTO online VALUES (?, ?, ?)', (key, run_id, json.dumps(state)))
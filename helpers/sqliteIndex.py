@@ -0,0 +1,19 @@
+import contextlib
+import sqlite3
+
+@contextlib.contextmanager
+def connect(index_path, timeout=60):
+    """
+    @brief Opens a transaction on an on-disk SQLite index in WAL mode. A new connection is used for each operation so the
+    indexes of the caches and stores can be shared by threads and processes.
+    @param index_path A string representing the path of the database file.
+    @param timeout (Optional) The number of seconds to wait for a lock held by another connection. Default is 60.
+    @return Yields a sqlite3 connection, committed and closed on exit.
+    """
+    _db = sqlite3.connect(index_path, timeout=timeout)
+    try:
+        _db.execute('PRAGMA journal_mode=WAL')
+        with _db:
+            yield _db
+    finally:
+        _db.close()
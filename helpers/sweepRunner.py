@@ -0,0 +1,293 @@
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from helpers.precorsiaFilter import PrecorsiaFilter
+from helpers.tileCache import atomic_save
+from helpers.imageCatalog import ImageCatalog
+from helpers.instrumentation import Metrics
+import hashlib
+import json
+import time
+import os
+
+def load_output(path):
+    """
+    @brief Reads the output of a stage.
+    @param path A string representing the path of the output.
+    @return Returns the decoded JSON content.
+    """
+    with open(path) as file:
+        return json.load(file)
+
+def save_output(path, data):
+    """
+    @brief Writes the output of a stage atomically.
+    @param path A string representing the path of the output.
+    @param data A JSON serialisable object.
+    """
+    def write(tmp):
+        with open(tmp, 'w') as file:
+            json.dump(data, file)
+    atomic_save(path, write)
+
+def run_stage(kind, config, inputs, output, upstream=None):
+    """
+    @brief Runs one stage of a sweep. Executed in a worker process, which measures the stage with its own Metrics.
+    @param kind The kind of stage: 'list', 'download', 'filter' or 'correlate'.
+    @param config The configuration of the stage. 'list' and 'download' stages receive the fields of one dataset.
+    @param inputs A list with the output paths of the stages this one depends on.
+    @param output A string representing the path where the output of the stage is written.
+    @param upstream (Optional) A list with the measures of every stage a 'correlate' stage depends on, directly or not,
+    as in the 'stages' key of Metrics.to_dict. They are added to the stored run and the exported metrics. Default is None.
+    @return Returns a dictionary with the 'output' path and the 'metrics' of the stage, as in the 'stages' key of Metrics.to_dict.
+    """
+    gee = config['gee']
+
+    if kind == 'list':
+        metrics = Metrics(labels={'dataset': config['dataset'], 'longitude': config['geolocation'][0], 'latitude': config['geolocation'][1]})
+        with metrics.stage(kind):
+            gds = gee(config['dataset'], config['band_range'], file_format=config['tile_format'], metrics=metrics)
+            _start, _end = gee.date_daily(config['start_date'], config['days'])
+            result = gds.list(config['geolocation'], [_start, _end], catalog=config['image_catalog'] or ImageCatalog())
+
+    elif kind == 'download':
+        metrics = Metrics(labels={'dataset': config['dataset'], 'longitude': config['geolocation'][0], 'latitude': config['geolocation'][1]})
+        with metrics.stage(kind):
+            _reference = load_output(inputs[0])
+            result = {}
+            for _comparable in inputs[1:]:
+                _matched = gee.correlate_dates(_reference, load_output(_comparable), config['round_factor'])[config['side']]
+                result.update((_img['id'], _img) for _img in _matched)
+            result = list(result.values())
+
+            gds = gee(config['dataset'], config['band_range'], file_format=config['tile_format'], metrics=metrics)
+            gds.fetch(result, config['band_name'], config['geolocation'], config['image_scale'], config['mode'], config['pixel_scale'],
+                      config['mosaic_tile_size'], concurrency=config['download_concurrency'], rate=config['download_rate'],
+                      cache=config['tile_cache'])
+
+    elif kind == 'filter':
+        precorsia = PrecorsiaFilter(config)
+        metrics = precorsia.metrics
+        precorsia.prepare()
+        precorsia.gds_one_list, precorsia.gds_two_list = gee.correlate_dates(load_output(inputs[0]), load_output(inputs[1]),
+                                                                             precorsia.round_factor)
+        precorsia.timed('filter', precorsia.filter_stage)
+        result = [precorsia.gds_one_lz, precorsia.gds_two_lz]
+
+    elif kind == 'correlate':
+        precorsia = PrecorsiaFilter(config)
+        precorsia.prepare()
+        precorsia.gds_one_lz, precorsia.gds_two_lz = load_output(inputs[0])
+        _file_name = precorsia.timed('correlate', precorsia.correlate_stage)
+        metrics = Metrics()
+        metrics.merge(precorsia.metrics.to_dict()['stages'])
+        for _stages in upstream or []:
+            precorsia.metrics.merge(_stages)
+        result = {'file_name': _file_name, 'run_id': precorsia.store_results(_file_name)}
+        precorsia.export_metrics()
+
+    else:
+        raise ValueError(f"Unknown stage: {kind}")
+
+    save_output(output, result)
+    return {'output': output, 'metrics': metrics.to_dict()['stages']}
+
+
+class SweepRunner:
+
+    UNSUPPORTED_KEYS = ('incremental', 'pixel_maps')
+    LOCAL_KEYS = ('metrics',)
+
+    def __init__(self, configurations, sweep_dir='./sweep/', max_workers=4, initializer=None):
+        """
+        @brief Constructor for the SweepRunner class, which runs many PrecorsiaFilter configurations as one task graph.
+        Each configuration is split into list -> download -> filter -> correlate stages. Stages shared by several
+        configurations, such as the listing and download of a common reference dataset, run only once. Finished stages
+        are recorded in a manifest, so an interrupted sweep resumes where it stopped.
+        Every stage is measured by a Metrics object of its worker. The stage configurations leave out LOCAL_KEYS, objects
+        tied to this process: a 'metrics' object of a configuration receives the measures of every stage of its job once
+        the sweep has run, and the metrics attribute receives those of every stage of the sweep.
+        Filter stages of different configurations may gap-fill the same downloaded tiles at the same time. The tiles
+        are never rewritten: each filter writes gap-filled copies named after the tiles they are filled from, with an
+        atomic rename, so concurrent filters either share an identical copy or write separate ones.
+        @param configurations A list of PrecorsiaFilter configuration dictionaries.
+        @param sweep_dir (Optional) A string representing the directory of the manifest and stage outputs. Default is './sweep/'.
+        @param max_workers (Optional) The maximum number of stages running at the same time. Default is 4.
+        @param initializer (Optional) A callable run once in every worker process, e.g. PrecorsiaGee.init. Default is None.
+        @throws ValueError If a configuration enables one of UNSUPPORTED_KEYS.
+        """
+        self.configurations = configurations
+        self.sweep_dir = sweep_dir
+        self.max_workers = max_workers
+        self.initializer = initializer
+        self.manifest_path = os.path.join(sweep_dir, 'manifest.json')
+
+        self.stages = {}
+        self.jobs = []
+        self.failed = {}
+        self.metrics = Metrics()
+        self.build()
+
+    @staticmethod
+    def stage_key(kind, fields):
+        """
+        @brief Builds the identifier of a stage from everything that defines its output.
+        @param kind The kind of stage.
+        @param fields A JSON serialisable description of the stage.
+        @return Returns a string.
+        """
+        return f'{kind}-' + hashlib.sha1(json.dumps(fields, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+    def add_stage(self, kind, fields, config, deps):
+        """
+        @brief Adds a stage to the graph, unless an identical stage is already there.
+        @param kind The kind of stage.
+        @param fields A JSON serialisable description of the stage.
+        @param config The configuration passed to run_stage.
+        @param deps A list with the keys of the stages this one depends on.
+        @return Returns the key of the stage.
+        """
+        _key = SweepRunner.stage_key(kind, [fields, deps])
+        if _key not in self.stages:
+            self.stages[_key] = {'kind': kind, 'config': config, 'deps': deps}
+        return _key
+
+    def build(self):
+        """
+        @brief Builds the task graph of the sweep.
+        @throws ValueError If a configuration enables one of UNSUPPORTED_KEYS.
+        """
+        _jobs = []
+        _comparables = {}
+        for _config in self.configurations:
+            _unsupported = [_key for _key in self.UNSUPPORTED_KEYS if _config.get(_key)]
+            if _unsupported:
+                raise ValueError(f"Sweeps do not support {_unsupported}, run these configurations with PrecorsiaFilter.execute.")
+            _gee = _config['gee']
+            _common = {
+                'gee': _gee, 'geolocation': _config['geolocation'], 'start_date': _config['start_date'], 'days': _config['days'],
+                'image_scale': _config['image_scale'], 'round_factor': _config['round_factor'],
+                'tile_format': _config.get('tile_format', 'png'), 'mode': _config.get('mode', 'tiles'), 'tile_cache': _config.get('tile_cache', None),
+                'image_catalog': _config.get('image_catalog', None),
+                'pixel_scale': _config.get('pixel_scale', None), 'mosaic_tile_size': _config.get('mosaic_tile_size', 512),
+                'download_concurrency': _config.get('download_concurrency', 1), 'download_rate': _config.get('download_rate', None)
+            }
+
+            _sides = []
+            for _prefix in ('reference', 'comparable'):
+                _dataset = dict(_common, dataset=_config[f'{_prefix}_dataset'], band_name=_config[f'{_prefix}_band_name'],
+                                band_range=_config[f'{_prefix}_band_range'])
+                _list = self.add_stage('list', [f'{_gee.__module__}.{_gee.__qualname__}', _dataset['dataset'],
+                                                _dataset['geolocation'], _dataset['start_date'], _dataset['days']], _dataset, [])
+                _download = [_list, _dataset['band_name'], _dataset['band_range'], _dataset['image_scale'],
+                             _dataset['round_factor'], _dataset['tile_format'], _dataset['mode']]
+                if _dataset['pixel_scale'] is not None:
+                    _download += [_dataset['pixel_scale'], _dataset['mosaic_tile_size']]
+                _sides.append((_dataset, _list, _download))
+
+            _comparables.setdefault(json.dumps(_sides[0][2], default=str), set()).add(_sides[1][1])
+            _jobs.append((_config, _sides))
+
+        for _config, ((_reference, _list_one, _download_one), (_comparable, _list_two, _download_two)) in _jobs:
+            _others = sorted(_comparables[json.dumps(_download_one, default=str)])
+            _download_one = self.add_stage('download', _download_one, dict(_reference, side=0), [_list_one] + _others)
+            _download_two = self.add_stage('download', _download_two, dict(_comparable, side=1), [_list_one, _list_two])
+
+            _job = {_k: _v for _k, _v in _config.items() if _k not in ('gee', 'imageCorrelator', 'imageProcessor', 'tile_cache', 'tile_stats', 'image_catalog', 'results_store', 'plot_renderer', 'metrics')}
+            _stage_config = {_k: _v for _k, _v in _config.items() if _k not in self.LOCAL_KEYS}
+            _filter = self.add_stage('filter', _job, _stage_config, [_download_one, _download_two])
+            self.jobs.append(self.add_stage('correlate', _job, _stage_config, [_filter]))
+
+    def lineage(self, key):
+        """
+        @brief Lists a stage and every stage it depends on, directly or not.
+        @param key The key of the stage.
+        @return Returns a set of stage keys.
+        """
+        _keys = {key}
+        for _dep in self.stages[key]['deps']:
+            _keys |= self.lineage(_dep)
+        return _keys
+
+    def output_path(self, key):
+        """
+        @brief Gives the location of the output of a stage.
+        @param key The key of the stage.
+        @return Returns a string representing the path of the output.
+        """
+        return os.path.join(self.sweep_dir, 'stages', f'{key}.json')
+
+    def load_manifest(self):
+        """
+        @brief Reads the manifest of the finished stages.
+        @return Returns a dictionary mapping stage keys to their record.
+        """
+        if not os.path.exists(self.manifest_path):
+            return {}
+        return load_output(self.manifest_path)
+
+    def save_manifest(self, manifest):
+        """
+        @brief Writes the manifest of the finished stages atomically.
+        @param manifest A dictionary mapping stage keys to their record.
+        """
+        save_output(self.manifest_path, manifest)
+
+    def run(self):
+        """
+        @brief Runs every stage not finished yet, respecting their dependencies.
+        A failed stage does not stop the sweep: the stages depending on it are skipped and reported in the failed attribute.
+        The tile caches are then trimmed to their max_bytes, and the measures of the finished stages, recorded in the
+        manifest, are gathered in the metrics attribute and in the 'metrics' object of each configuration.
+        @return Returns a list with the path of the results file of each configuration, or None if its stages failed.
+        """
+        os.makedirs(os.path.join(self.sweep_dir, 'stages'), exist_ok=True)
+        manifest = self.load_manifest()
+        done = {_key for _key, _record in manifest.items() if _key in self.stages and os.path.exists(_record['output'])}
+        pending = [_key for _key in self.stages if _key not in done]
+        running = {}
+        self.failed = {}
+
+        with ProcessPoolExecutor(max_workers=self.max_workers, initializer=self.initializer) as executor:
+            while pending or running:
+                for _key in list(pending):
+                    _deps = self.stages[_key]['deps']
+                    if any(_dep in self.failed for _dep in _deps):
+                        self.failed[_key] = 'dependency failed'
+                        pending.remove(_key)
+                    elif all(_dep in done for _dep in _deps):
+                        _stage = self.stages[_key]
+                        _inputs = [manifest[_dep]['output'] for _dep in _deps]
+                        _upstream = None
+                        if _stage['kind'] == 'correlate':
+                            _upstream = [manifest[_dep].get('metrics', {}) for _dep in self.lineage(_key) - {_key}]
+                        _future = executor.submit(run_stage, _stage['kind'], _stage['config'], _inputs, self.output_path(_key), _upstream)
+                        running[_future] = _key
+                        pending.remove(_key)
+
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for _future in finished:
+                    _key = running.pop(_future)
+                    try:
+                        _result = _future.result()
+                        manifest[_key] = {'kind': self.stages[_key]['kind'], 'output': _result['output'], 'metrics': _result['metrics'],
+                                          'finished': time.time()}
+                        done.add(_key)
+                        self.save_manifest(manifest)
+                    except Exception as error:
+                        self.failed[_key] = repr(error)
+                        print(f"Stage {_key} failed: {error!r}")
+
+        for _cache in {id(_c['tile_cache']): _c['tile_cache'] for _c in self.configurations if _c.get('tile_cache') is not None}.values():
+            _cache.evict()
+
+        self.metrics = Metrics()
+        for _key in done:
+            self.metrics.merge(manifest[_key].get('metrics', {}))
+        for _config, _key in zip(self.configurations, self.jobs):
+            if _config.get('metrics') is not None:
+                for _stage in self.lineage(_key) & done:
+                    _config['metrics'].merge(manifest[_stage].get('metrics', {}))
+
+        return [load_output(manifest[_key]['output'])['file_name'] if _key in done else None for _key in self.jobs]
@@ -0,0 +1,71 @@
+import numpy as np
+
+class JoinResult:
+
+    def __init__(self, one, two, pairs, times):
+        """
+        @brief Constructor for the JoinResult class, the outcome of a TemporalJoin.
+        @param one The images of the first list that found a match, in their original order.
+        @param two The images of the second list that found a match, in their original order.
+        @param pairs A list of tuples. Each tuple contains two lists of image IDs matched together.
+        @param times A list with the time in milliseconds of each pair, the start of its bucket.
+        """
+        self.one = one
+        self.two = two
+        self.pairs = pairs
+        self.times = times
+
+
+class TemporalJoin:
+    """
+    @brief Joins two lists of images on their 'time_start' values.
+    Both lists are sorted once and merged, so joining costs O(n log n) instead of scanning one list per image of the other.
+    """
+
+    @staticmethod
+    def times(image_list):
+        """
+        @brief Extracts the 'time_start' values of a list of images.
+        @param image_list A list of dictionaries representing images. Each dictionary should have a 'time_start' key.
+        @return Returns a numpy array of int64.
+        """
+        return np.fromiter((_img['time_start'] for _img in image_list), dtype=np.int64, count=len(image_list))
+
+    @staticmethod
+    def select(image_list, mask):
+        """
+        @brief Keeps the images of a list flagged by a mask.
+        @param image_list A list of images.
+        @param mask A boolean numpy array with one value per image.
+        @return Returns a list of images, in their original order.
+        """
+        return [image_list[_i] for _i in np.flatnonzero(mask)]
+
+    @staticmethod
+    def buckets(list_one, list_two, bucket_ms, origin=0):
+        """
+        @brief Joins two lists on fixed time buckets: images whose times fall in the same bucket are matched together.
+        @param list_one A list of dictionaries representing images. Each dictionary should have 'id' and 'time_start' keys.
+        @param list_two A list of dictionaries representing images. Each dictionary should have 'id' and 'time_start' keys.
+        @param bucket_ms The length of a bucket in milliseconds.
+        @param origin (Optional) The start in milliseconds of a bucket. Default is 0, the epoch.
+        @return Returns a JoinResult with one pair per common bucket, in time order.
+        """
+        _keys_one = (TemporalJoin.times(list_one) - origin) // bucket_ms
+        _keys_two = (TemporalJoin.times(list_two) - origin) // bucket_ms
+
+        _order_one = np.argsort(_keys_one, kind='stable')
+        _order_two = np.argsort(_keys_two, kind='stable')
+        _unique_one, _start_one, _count_one = np.unique(_keys_one[_order_one], return_index=True, return_counts=True)
+        _unique_two, _start_two, _count_two = np.unique(_keys_two[_order_two], return_index=True, return_counts=True)
+        _common, _in_one, _in_two = np.intersect1d(_unique_one, _unique_two, assume_unique=True, return_indices=True)
+
+        _pairs = []
+        for _i, _j in zip(_in_one, _in_two):
+            _ids_one = [list_one[_k]['id'] for _k in _order_one[_start_one[_i]:_start_one[_i] + _count_one[_i]]]
+            _ids_two = [list_two[_k]['id'] for _k in _order_two[_start_two[_j]:_start_two[_j] + _count_two[_j]]]
+            _pairs.append((_ids_one, _ids_two))
+
+        return JoinResult(TemporalJoin.select(list_one, np.isin(_keys_one, _common)),
+                          TemporalJoin.select(list_two, np.isin(_keys_two, _common)),
+                          _pairs, [int(_k) * bucket_ms + origin for _k in _common])
@@ -0,0 +1,198 @@
+from helpers.sqliteIndex import connect
+import threading
+import tempfile
+import hashlib
+import json
+import time
+import os
+
+def atomic_save(path, writer):
+    """
+    @brief Writes a file atomically: the content is written to a temporary file in the same directory and then moved over the target.
+    @param path A string representing the destination path.
+    @param writer A callable receiving the temporary path to write to. The temporary path keeps the extension of the destination.
+    """
+    _dir, _name = os.path.split(path)
+    _fd, _tmp = tempfile.mkstemp(prefix=f'.{_name}.', suffix=os.path.splitext(_name)[1], dir=_dir or '.')
+    os.close(_fd)
+    try:
+        writer(_tmp)
+        os.replace(_tmp, path)
+    except BaseException:
+        if os.path.exists(_tmp):
+            os.remove(_tmp)
+        raise
+
+def atomic_save_many(paths, writer):
+    """
+    @brief Writes several files atomically: every content is written to a temporary file and all of them are moved over their targets once the writer returns.
+    @param paths A list of strings representing the destination paths.
+    @param writer A callable receiving the list of temporary paths to write to, in the order of paths.
+    """
+    _tmps = []
+    try:
+        for _path in paths:
+            _dir, _name = os.path.split(_path)
+            _fd, _tmp = tempfile.mkstemp(prefix=f'.{_name}.', suffix=os.path.splitext(_name)[1], dir=_dir or '.')
+            os.close(_fd)
+            _tmps.append(_tmp)
+        writer(list(_tmps))
+        for _index, _path in enumerate(paths):
+            os.replace(_tmps[_index], _path)
+            _tmps[_index] = None
+    except BaseException:
+        for _tmp in _tmps:
+            if _tmp is not None and os.path.exists(_tmp):
+                os.remove(_tmp)
+        raise
+
+
+class TileCache:
+
+    def __init__(self, cache_dir='./buffer/', max_bytes=None):
+        """
+        @brief Constructor for the TileCache class.
+        @param cache_dir (Optional) A string representing the directory where the tiles are stored. Default is './buffer/'.
+        @param max_bytes (Optional) The maximum size in bytes of the cached tiles, gap-filled copies included. The least recently
+        used tiles are evicted past it by evict(), which the pipelines call once a run is over, so the tiles of a running
+        study are never removed under it. Default is None, no limit.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, 'index.sqlite')
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        with connect(self.index_path) as _db:
+            _db.execute('CREATE TABLE IF NOT EXISTS tiles (key TEXT PRIMARY KEY, path TEXT NOT NULL, '
+                        'dataset TEXT, image TEXT, bytes INTEGER NOT NULL, last_access REAL NOT NULL)')
+            _db.execute('CREATE INDEX IF NOT EXISTS tiles_last_access ON tiles (last_access)')
+
+    def __getstate__(self):
+        _state = self.__dict__.copy()
+        del _state['lock']
+        return _state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(dataset, image, band, geolocation, scale, band_range, file_format='png', size=None):
+        """
+        @brief Builds the cache key of a tile from everything that defines its content.
+        @param dataset The ID of the dataset.
+        @param image The ID of the image in the dataset.
+        @param band A string representing the band of the tile.
+        @param geolocation A tuple containing the longitude and latitude of the location.
+        @param scale The scale in meters of the side of the square in meters.
+        @param band_range A tuple containing the minimum and maximum band values.
+        @param file_format (Optional) A string representing the storage format of the tile. Default is 'png'.
+        @param size (Optional) The side in pixels of a mosaic. Default is None, a 512 pixel tile.
+        @return Returns a hexadecimal string.
+        """
+        _fields = [dataset, image, band, [float(_c) for _c in geolocation], float(scale),
+                   [float(_r) for _r in band_range], file_format]
+        if size is not None:
+            _fields.append(int(size))
+        return hashlib.sha256(json.dumps(_fields).encode()).hexdigest()[:40]
+
+    def path(self, key, extension='png'):
+        """
+        @brief Gives the location of a tile on disk.
+        @param key The cache key of the tile.
+        @param extension (Optional) A string representing the file extension. Default is 'png'.
+        @return Returns a string representing the path of the tile.
+        """
+        return os.path.join(self.cache_dir, key[:2], f'{key}.{extension}')
+
+    def get(self, key):
+        """
+        @brief Looks a tile up in the cache, refreshing its position in the LRU order.
+        @param key The cache key of the tile.
+        @return Returns the path of the tile, or None if the tile is not cached.
+        """
+        with connect(self.index_path) as _db:
+            _row = _db.execute('SELECT path FROM tiles WHERE key = ?', (key,)).fetchone()
+            if _row is not None and os.path.exists(_row[0]):
+                _db.execute('UPDATE tiles SET last_access = ? WHERE key = ?', (time.time(), key))
+            else:
+                _row = None
+
+        with self.lock:
+            if _row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return _row[0] if _row is not None else None
+
+    def put(self, key, writer, extension='png', dataset=None, image=None):
+        """
+        @brief Stores a tile in the cache.
+        @param key The cache key of the tile.
+        @param writer A callable receiving the path to write the tile to.
+        @param extension (Optional) A string representing the file extension. Default is 'png'.
+        @param dataset (Optional) The ID of the dataset, kept in the index for inspection.
+        @param image (Optional) The ID of the image, kept in the index for inspection.
+        @return Returns the path of the stored tile.
+        """
+        _path = self.path(key, extension)
+        os.makedirs(os.path.dirname(_path), exist_ok=True)
+        atomic_save(_path, writer)
+        return self.add(key, _path, dataset, image)
+
+    def add(self, key, path, dataset=None, image=None):
+        """
+        @brief Records a file written in the cache directory by another component, such as a gap-filled copy, so it counts
+        toward max_bytes and can be evicted. Recording a file again refreshes its position in the LRU order.
+        @param key The cache key of the file.
+        @param path A string representing the path of the file.
+        @param dataset (Optional) The ID of the dataset, kept in the index for inspection.
+        @param image (Optional) The ID of the image, kept in the index for inspection.
+        @return Returns path.
+        """
+        with connect(self.index_path) as _db:
+            _db.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?)',
+                        (key, path, dataset, image, os.path.getsize(path), time.time()))
+        return path
+
+    def remove(self, path):
+        """
+        @brief Deletes a cached file and its entry in the index.
+        @param path A string representing the path of the file.
+        """
+        with connect(self.index_path) as _db:
+            _db.execute('DELETE FROM tiles WHERE path = ?', (path,))
+        if os.path.exists(path):
+            os.remove(path)
+
+    def evict(self):
+        """
+        @brief Removes the least recently used tiles until the cache fits in max_bytes. Does nothing without a max_bytes.
+        Meant to run between studies: a tile evicted during a run may still be needed by its later stages.
+        """
+        if self.max_bytes is None:
+            return
+        with connect(self.index_path) as _db:
+            _total = _db.execute('SELECT COALESCE(SUM(bytes), 0) FROM tiles').fetchone()[0]
+            if _total <= self.max_bytes:
+                return
+
+            for _key, _path, _bytes in _db.execute('SELECT key, path, bytes FROM tiles ORDER BY last_access').fetchall():
+                if _total <= self.max_bytes:
+                    break
+                _db.execute('DELETE FROM tiles WHERE key = ?', (_key,))
+                if os.path.exists(_path):
+                    os.remove(_path)
+                _total -= _bytes
+
+    def stats(self):
+        """
+        @brief Summarizes the cache usage.
+        @return Returns a dictionary with 'hits', 'misses', 'entries' and 'bytes' keys.
+        """
+        with connect(self.index_path) as _db:
+            _entries, _bytes = _db.execute('SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM tiles').fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': _entries, 'bytes': _bytes}
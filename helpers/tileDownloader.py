@@ -0,0 +1,111 @@
+from concurrent.futures import ThreadPoolExecutor, CancelledError, as_completed
+import threading
+import random
+import time
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity=None):
+        """
+        @brief Constructor for the TokenBucket class.
+        @param rate The number of tokens added to the bucket per second.
+        @param capacity (Optional) The maximum number of tokens the bucket can hold. Default is max(1, rate).
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, self.rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        @brief Blocks until a token is available and consumes it.
+        """
+        while True:
+            with self.lock:
+                _now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (_now - self.updated) * self.rate)
+                self.updated = _now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                _wait = (1 - self.tokens) / self.rate
+            time.sleep(_wait)
+
+
+class TileDownloader:
+
+    def __init__(self, concurrency=8, rate=None, retries=3, backoff=0.5, max_backoff=30.0, is_transient=None):
+        """
+        @brief Constructor for the TileDownloader class.
+        @param concurrency (Optional) The maximum number of requests in flight. Default is 8.
+        @param rate (Optional) The maximum number of requests started per second. Default is None, no limit.
+        @param retries (Optional) The number of times a transient failure is retried. Default is 3.
+        @param backoff (Optional) The initial delay in seconds between retries, doubled on each attempt. Default is 0.5.
+        @param max_backoff (Optional) The maximum delay in seconds between retries. Default is 30.
+        @param is_transient (Optional) A callable telling whether an exception is worth retrying. Default retries connection errors and timeouts.
+        """
+        self.concurrency = max(1, int(concurrency))
+        self.bucket = TokenBucket(rate) if rate else None
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.is_transient = is_transient or (lambda error: isinstance(error, (ConnectionError, TimeoutError)))
+
+    def call(self, fn, item, stop=None):
+        """
+        @brief Calls fn(item), waiting for the rate limiter and retrying transient failures with exponential backoff.
+        @param fn The callable to run.
+        @param item The argument passed to fn.
+        @param stop (Optional) A threading.Event. Once set, no new attempt is started. Default is None.
+        @return Returns the value returned by fn.
+        @throws CancelledError If stop is set before an attempt.
+        """
+        _attempt = 0
+        while True:
+            if self.bucket is not None:
+                self.bucket.acquire()
+            if stop is not None and stop.is_set():
+                raise CancelledError()
+            try:
+                return fn(item)
+            except Exception as error:
+                if _attempt >= self.retries or not self.is_transient(error):
+                    raise
+                _delay = min(self.max_backoff, self.backoff * 2 ** _attempt)
+                (stop.wait if stop is not None else time.sleep)(_delay * (0.5 + random.random() / 2))
+                _attempt += 1
+
+    def map(self, fn, items, label=None):
+        """
+        @brief Runs fn over every item using a bounded pool of worker threads.
+        The first failure that is not retried cancels the items not started yet, and is raised once the running ones end.
+        @param fn The callable to run for each item.
+        @param items A list of arguments.
+        @param label (Optional) A string printed with the progress. Default is None, no progress is printed.
+        @return Returns a list with the value returned by fn for each item, in the order of items.
+        """
+        _results = [None] * len(items)
+        if not items:
+            return _results
+
+        start_time = time.time()
+        _stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            _futures = {executor.submit(self.call, fn, item, _stop): i for i, item in enumerate(items)}
+            try:
+                for done, future in enumerate(as_completed(_futures)):
+                    _results[_futures[future]] = future.result()
+
+                    if label is not None:
+                        elapsed_time = time.time() - start_time
+                        estimated_time = elapsed_time / (done+1) * (len(items) - done - 1)
+                        print(f"\r{label} Progress: {(done+1)/len(items)*100:.2f}% | Estimated time: {estimated_time:.2f}s", end=" "*10)
+            except BaseException:
+                _stop.set()
+                executor.shutdown(cancel_futures=True)
+                raise
+
+        if label is not None:
+            print("\n")
+        return _results
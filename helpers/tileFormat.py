@@ -0,0 +1,143 @@
+import matplotlib.pyplot as plt
+from PIL import Image
+import numpy as np
+import io
+
+# Storage formats of the tiles:
+#   'png'   - colormapped image written by plt.imsave, 0 marks nodata.
+#   'uint8' - single channel uint8 array in a .npy file, 0 marks nodata.
+#   'raw'   - band values as float32 in a .npy file, NaN marks nodata.
+FORMATS = ('png', 'uint8', 'raw')
+EXTENSIONS = {'png': 'png', 'uint8': 'npy', 'raw': 'npy'}
+
+MASK_BAND = 'precorsia_mask'
+
+# Largest number of pixels read at once by the block-wise reductions, so mosaics are never loaded whole.
+BLOCK_PIXELS = 1 << 22
+
+def read_tile(path):
+    """
+    @brief Loads a tile from disk. The .npy tiles are memory-mapped, so no pixel is copied until it is used.
+    @param path A string representing the path of the tile.
+    @return Returns a 2D numpy array.
+    """
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    return np.array(Image.open(path).convert('L'))
+
+def tile_shape(path):
+    """
+    @brief Reads the shape of a tile without decoding its pixels.
+    @param path A string representing the path of the tile.
+    @return Returns a tuple with the height and width of the tile.
+    """
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r').shape
+    with Image.open(path) as image:
+        return image.size[::-1]
+
+def create_tile(path, shape, raw=False):
+    """
+    @brief Creates an empty memory-mapped .npy tile, filled in place by the caller.
+    @param path A string representing the path of the tile.
+    @param shape A tuple with the height and width of the tile.
+    @param raw (Optional) True for float32 band values, False for uint8 values. Default is False.
+    @return Returns a writable numpy memmap.
+    """
+    return np.lib.format.open_memmap(path, mode='w+', dtype=np.float32 if raw else np.uint8, shape=tuple(shape))
+
+def to_storage(array, raw=False):
+    """
+    @brief Converts pixel values to the type they are stored with.
+    @param array A numpy array.
+    @param raw (Optional) True to keep the values as float32, False to round them to uint8. Default is False.
+    @return Returns a numpy array.
+    """
+    if raw:
+        return np.asarray(array, dtype=np.float32)
+    return np.clip(np.rint(array), 0, 255).astype(np.uint8)
+
+def row_blocks(height, width, max_pixels=BLOCK_PIXELS):
+    """
+    @brief Splits the rows of a tile into blocks holding at most max_pixels pixels, and at least one row.
+    @param height The number of rows of the tile.
+    @param width The number of columns of the tile.
+    @param max_pixels (Optional) The largest number of pixels of a block. Default is BLOCK_PIXELS.
+    @return Yields slices of rows.
+    """
+    _rows = max(1, int(max_pixels) // max(1, int(width)))
+    for _start in range(0, height, _rows):
+        yield slice(_start, min(height, _start + _rows))
+
+def write_tile(path, array, raw=False):
+    """
+    @brief Saves a tile to disk, in the format given by the extension of the path.
+    @param path A string representing the path of the tile.
+    @param array A 2D numpy array.
+    @param raw (Optional) True to keep the values as float32 in .npy files, False to store them as uint8. Default is False.
+    """
+    if not path.endswith('.npy'):
+        plt.imsave(path, array, cmap='gray')
+    else:
+        np.save(path, np.ascontiguousarray(to_storage(array, raw)))
+
+def is_raw(array):
+    """
+    @brief Tells whether a tile holds raw band values instead of 8-bit visualised values.
+    @param array A numpy array.
+    @return Returns True if the array has a floating point type.
+    """
+    return np.issubdtype(array.dtype, np.floating)
+
+def nodata_mask(array):
+    """
+    @brief Finds the nodata pixels of a tile.
+    @param array A numpy array.
+    @return Returns a boolean array, True where the pixel holds no data.
+    """
+    return np.isnan(array) if is_raw(array) else array == 0
+
+def tile_zeros(array, max_pixels=BLOCK_PIXELS):
+    """
+    @brief Calculates the proportion of nodata pixels of a tile, reading it in row blocks.
+    @param array A 2D numpy array, possibly memory-mapped.
+    @param max_pixels (Optional) The largest number of pixels read at once. Default is BLOCK_PIXELS.
+    @return Returns a float.
+    """
+    _zeros = sum(int(np.count_nonzero(nodata_mask(array[_rows]))) for _rows in row_blocks(*array.shape, max_pixels))
+    return _zeros / array.size
+
+def tile_mean(array, max_pixels=BLOCK_PIXELS):
+    """
+    @brief Calculates the average value of a tile, reading it in row blocks. Raw tiles average only their valid pixels.
+    @param array A 2D numpy array, possibly memory-mapped.
+    @param max_pixels (Optional) The largest number of pixels read at once. Default is BLOCK_PIXELS.
+    @return Returns a float, NaN for a raw tile without valid pixels.
+    """
+    _sum, _count = 0.0, 0
+    for _rows in row_blocks(*array.shape, max_pixels):
+        _block = np.asarray(array[_rows], dtype=np.float64)
+        if is_raw(array):
+            _valid = ~np.isnan(_block)
+            _sum += float(_block[_valid].sum())
+            _count += int(np.count_nonzero(_valid))
+        else:
+            _sum += float(_block.sum())
+            _count += _block.size
+    return _sum / _count if _count else float('nan')
+
+def decode_pixels(data, file_format, band):
+    """
+    @brief Decodes the bytes returned by computePixels into a tile.
+    @param data The encoded image bytes.
+    @param file_format A string representing the storage format, one of FORMATS.
+    @param band A string representing the band of the tile, used by the 'raw' format.
+    @return Returns a 2D numpy array, uint8 for 'png' and 'uint8', float32 for 'raw'.
+    """
+    if file_format != 'raw':
+        return np.array(Image.open(io.BytesIO(data)).convert('L'))
+
+    _pixels = np.load(io.BytesIO(data))
+    _values = _pixels[band].astype(np.float32)
+    _values[_pixels[MASK_BAND] == 0] = np.nan
+    return _values
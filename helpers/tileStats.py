@@ -0,0 +1,105 @@
+from helpers.tileFormat import read_tile, nodata_mask, tile_mean, is_raw, row_blocks
+from helpers.sqliteIndex import connect
+import numpy as np
+import os
+
+class TileStats:
+
+    COLUMNS = ('mean', 'zeros', 'min', 'max', 'hist')
+
+    def __init__(self, stats_dir='./buffer/', bins=16):
+        """
+        @brief Constructor for the TileStats class, a sidecar index with the statistics of every tile.
+        Each row is tied to the modification time and size of its tile, so a rewritten tile is never served stale statistics.
+        @param stats_dir (Optional) A string representing the directory of the index. Default is './buffer/'.
+        @param bins (Optional) The number of bins of the histogram of each tile. Default is 16.
+        """
+        self.index_path = os.path.join(stats_dir, 'stats.sqlite')
+        self.bins = bins
+
+        os.makedirs(stats_dir, exist_ok=True)
+        with connect(self.index_path) as _db:
+            _db.execute('CREATE TABLE IF NOT EXISTS stats (path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, bytes INTEGER NOT NULL, '
+                        'mean REAL, zeros REAL, min REAL, max REAL, hist BLOB)')
+
+    def compute(self, array):
+        """
+        @brief Calculates the statistics of a tile, reading it in row blocks so a memory-mapped mosaic is never loaded whole.
+        @param array A 2D numpy array, possibly memory-mapped.
+        @return Returns a dictionary with 'mean', 'zeros', 'min', 'max' and 'hist' keys. 'min', 'max' and 'hist' cover the valid pixels only.
+        """
+        _raw = is_raw(array)
+        _zeros, _min, _max = 0, None, None
+        _hist = np.zeros(self.bins, dtype=np.uint32)
+        for _rows in row_blocks(*array.shape):
+            _block = np.asarray(array[_rows])
+            _mask = nodata_mask(_block)
+            _zeros += int(np.count_nonzero(_mask))
+            _valid = _block[~_mask]
+            if _valid.size:
+                _min = float(_valid.min()) if _min is None else min(_min, float(_valid.min()))
+                _max = float(_valid.max()) if _max is None else max(_max, float(_valid.max()))
+            if not _raw:
+                _hist += np.histogram(_valid, bins=self.bins, range=(0.0, 256.0))[0].astype(np.uint32)
+
+        if _raw:
+            _range = (_min, _max) if _min is not None else (0.0, 1.0)
+            for _rows in row_blocks(*array.shape):
+                _block = np.asarray(array[_rows])
+                _hist += np.histogram(_block[~nodata_mask(_block)], bins=self.bins, range=_range)[0].astype(np.uint32)
+
+        return {
+            'mean': tile_mean(array),
+            'zeros': float(_zeros / array.size),
+            'min': _min,
+            'max': _max,
+            'hist': _hist
+        }
+
+    def record(self, path, array=None):
+        """
+        @brief Stores the statistics of a tile, replacing any previous entry.
+        @param path A string representing the path of the tile.
+        @param array (Optional) The pixels of the tile, when already in memory. Default is None, the tile is read from disk.
+        @return Returns the dictionary of statistics.
+        """
+        _stats = self.compute(read_tile(path) if array is None else array)
+        _stat = os.stat(path)
+        with connect(self.index_path) as _db:
+            _db.execute('INSERT OR REPLACE INTO stats VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        (path, _stat.st_mtime_ns, _stat.st_size, _stats['mean'], _stats['zeros'],
+                         _stats['min'], _stats['max'], _stats['hist'].tobytes()))
+        return _stats
+
+    def lookup(self, paths):
+        """
+        @brief Fetches the statistics of many tiles, computing and storing the ones missing or outdated.
+        @param paths A list of strings representing the paths of the tiles.
+        @return Returns a list of dictionaries of statistics, in the order of paths.
+        """
+        _rows = {}
+        with connect(self.index_path) as _db:
+            for _start in range(0, len(paths), 500):
+                _chunk = paths[_start:_start + 500]
+                _query = 'SELECT path, mtime_ns, bytes, mean, zeros, min, max, hist FROM stats WHERE path IN (%s)' % ','.join('?' * len(_chunk))
+                for _row in _db.execute(_query, _chunk):
+                    _rows[_row[0]] = _row
+
+        _stats = []
+        for _path in paths:
+            _row = _rows.get(_path)
+            _stat = os.stat(_path)
+            if _row is None or _row[1] != _stat.st_mtime_ns or _row[2] != _stat.st_size:
+                _stats.append(self.record(_path))
+            else:
+                _stats.append(dict(zip(self.COLUMNS, _row[3:7] + (np.frombuffer(_row[7], dtype=np.uint32),))))
+        return _stats
+
+    def column(self, paths, name):
+        """
+        @brief Fetches one statistic for many tiles.
+        @param paths A list of strings representing the paths of the tiles.
+        @param name The name of the statistic, one of COLUMNS.
+        @return Returns a numpy array with the statistic of each tile, in the order of paths.
+        """
+        return np.array([_s[name] for _s in self.lookup(paths)], dtype=None if name == 'hist' else float)
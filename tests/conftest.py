@@ -0,0 +1,20 @@
+from benchmarks.pipelineBenchmark import configuration, DEFAULTS
+import pytest
+
+@pytest.fixture
+def synthetic(tmp_path, monkeypatch):
+    """
+    @brief Runs a test in a directory of its own, with a builder of PrecorsiaFilter configurations served by a SyntheticBackend.
+    The runs write their data, buffer and catalog directories in the current directory, so every test starts from scratch.
+    @return Returns a callable receiving benchmark parameters (see benchmarks.pipelineBenchmark.DEFAULTS) and extra
+    configuration keys, and returning the configuration dictionary.
+    """
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'data').mkdir()
+
+    def build(params=None, **keys):
+        _params = dict(DEFAULTS, images=120, tile_size=16, concurrency=2, cadence_days=1, round_factor=8)
+        _params.update(params or {})
+        return dict(configuration(_params), **keys)
+
+    return build
@@ -0,0 +1,26 @@
+from helpers.correlationEngine import CorrelationEngine
+from helpers.precorsiaFilter import PrecorsiaFilter
+import pytest
+
+COMPARABLES = ['SYNTHETIC/COMPARABLE', 'SYNTHETIC/OTHER']
+
+@pytest.mark.parametrize('mode', ['tiles', 'reduce'])
+def test_engine_agrees_with_separate_runs(synthetic, mode):
+    _separate = []
+    for _dataset in COMPARABLES:
+        _precorsia = PrecorsiaFilter(synthetic({'images': 40}, mode=mode, comparable_dataset=_dataset))
+        _precorsia.execute()
+        _separate.append((_precorsia.best_shift, _precorsia.best_corr))
+
+    _configuration = {_k: _v for _k, _v in synthetic({'images': 40}, mode=mode).items() if not _k.startswith('comparable_')}
+    _configuration['comparables'] = [{'dataset': _dataset, 'band_name': 'value', 'band_range': [0, 1], 'band_unit': 'u'}
+                                     for _dataset in COMPARABLES]
+    _engine = CorrelationEngine(_configuration)
+    _engine.execute()
+
+    assert _engine.best_shifts == [_shift for _shift, _ in _separate]
+    if mode == 'tiles':
+        assert _engine.best_corrs == [_corr for _, _corr in _separate]
+    else:
+        # Means are summed in another order than in separate runs.
+        assert _engine.best_corrs == pytest.approx([_corr for _, _corr in _separate], rel=0, abs=1e-15)
@@ -0,0 +1,116 @@
+from helpers.geeBackend import EarthEngineBackend, LocalBackend, search_region, METERS_PER_DEGREE
+from helpers.geeApi import PrecorsiaGee
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+import pickle
+import weakref
+import types
+import gc
+import ee
+
+class CountingBackend(LocalBackend):
+
+    def __init__(self):
+        """
+        @brief Constructor for the CountingBackend class, a LocalBackend counting its projection requests.
+        """
+        super().__init__(lambda asset_id, request: np.zeros((4, 4)))
+        self.projections = 0
+
+    def projection(self, crs, scale):
+        self.projections += 1
+        return super().projection(crs, scale)
+
+
+def http_error(status):
+    """
+    @brief Builds an exception carrying an HTTP status the way googleapiclient does.
+    @param status The HTTP status code.
+    @return Returns an exception.
+    """
+    _error = Exception(f'HTTP {status}')
+    _error.resp = types.SimpleNamespace(status=status)
+    return _error
+
+
+def test_grids_are_computed_once_per_backend():
+    _backend = CountingBackend()
+    _gee = PrecorsiaGee('DATASET', (0, 1), backend=_backend)
+    _grid = _gee.grid((10.0, 45.0), 5120, 64)
+    _grid['dimensions']['width'] = 1
+    assert _gee.grid((10.0, 45.0), 5120, 64)['dimensions']['width'] == 64
+    assert _backend.projections == 1
+
+    _gee.grid((10.0, 45.0), 2560, 64)
+    assert _backend.projections == 2
+
+    _other = CountingBackend()
+    PrecorsiaGee('DATASET', (0, 1), backend=_other).grid((10.0, 45.0), 5120, 64)
+    assert _other.projections == 1
+
+
+def test_grids_are_dropped_with_their_backend():
+    _backend = CountingBackend()
+    PrecorsiaGee('DATASET', (0, 1), backend=_backend).grid((10.0, 45.0), 5120, 64)
+    assert _backend in PrecorsiaGee._grids
+    _reference = weakref.ref(_backend)
+    del _backend
+    gc.collect()
+    assert _reference() is None
+
+
+def test_is_transient_classifies_status_and_messages():
+    _backend = EarthEngineBackend()
+    assert _backend.is_transient(ConnectionError())
+    assert _backend.is_transient(TimeoutError())
+    assert _backend.is_transient(http_error(429))
+    assert _backend.is_transient(http_error(503))
+    assert not _backend.is_transient(http_error(400))
+    assert not _backend.is_transient(http_error(404))
+    assert _backend.is_transient(ee.EEException('Too many requests. Please wait.'))
+    assert _backend.is_transient(ee.EEException('Computation timed out.'))
+    assert not _backend.is_transient(ee.EEException('Image.load: Image asset not found.'))
+    assert not _backend.is_transient(ValueError('bad request'))
+
+
+def test_local_backend_counts_calls_from_many_threads():
+    _backend = LocalBackend(lambda asset_id, request: np.ones((2, 2)))
+    _request = {'expression': 'IMAGE', 'bandIds': ['band'], 'fileFormat': 'NPY'}
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda _: _backend.computePixels(_request), range(400)))
+    assert _backend.calls == 400
+
+    _copy = pickle.loads(pickle.dumps(LocalBackend(None)))
+    _copy.count()
+    assert _copy.calls == 1
+
+
+def test_search_region_is_a_point_without_margin():
+    assert search_region((10, 45)) == {'type': 'Point', 'coordinates': [10.0, 45.0]}
+
+
+def test_search_region_is_a_square_around_the_location():
+    _ring = search_region((10, 60), margin=500)['coordinates'][0]
+    assert _ring[0] == _ring[-1] and len(_ring) == 5
+    _lons, _lats = [_p[0] for _p in _ring], [_p[1] for _p in _ring]
+    assert (max(_lats) - min(_lats)) * METERS_PER_DEGREE == pytest.approx(1000)
+    assert (max(_lons) - min(_lons)) * METERS_PER_DEGREE * 0.5 == pytest.approx(1000)
+    assert min(_lons) < 10 < max(_lons) and min(_lats) < 60 < max(_lats)
+
+
+def test_listing_skips_assets_without_start_time(monkeypatch):
+    _pages = [{'images': [{'id': 'DATASET/a', 'startTime': '2020-01-01T00:00:00Z'}, {'id': 'DATASET/b'}],
+               'nextPageToken': 'next'},
+              {'images': [{'id': 'DATASET/c', 'startTime': '2020-01-02T00:00:00.500Z'}]}]
+    _params = []
+
+    def list_images(params):
+        _params.append(dict(params))
+        return _pages[len(_params) - 1]
+
+    monkeypatch.setattr(ee.data, 'listImages', list_images)
+    _listed = list(EarthEngineBackend().list_images('DATASET', (10, 45), 0, 10**13, margin=50))
+    assert _listed == [[{'id': 'a', 'time_start': 1577836800000}], [{'id': 'c', 'time_start': 1577923200500}]]
+    assert _params[0]['region']['type'] == 'Polygon' and 'pageToken' not in _params[0]
+    assert _params[1]['pageToken'] == 'next'
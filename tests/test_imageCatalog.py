@@ -0,0 +1,68 @@
+from helpers.imageCatalog import ImageCatalog
+from helpers.geeBackend import LocalBackend
+from helpers.geeApi import PrecorsiaGee
+import time
+
+DAY_MS = 86400000
+START_MS = 1577836800000
+
+def test_missing_lists_the_gaps_between_covered_ranges(tmp_path):
+    _catalog = ImageCatalog(str(tmp_path))
+    _footprint = ImageCatalog.footprint((10, 45))
+    assert _catalog.missing('DATASET', _footprint, 0, 100) == [(0, 100)]
+
+    _catalog.cover('DATASET', _footprint, 10, 20)
+    _catalog.cover('DATASET', _footprint, 40, 60)
+    assert _catalog.missing('DATASET', _footprint, 0, 100) == [(0, 10), (20, 40), (60, 100)]
+    assert _catalog.missing('DATASET', _footprint, 12, 50) == [(20, 40)]
+    assert _catalog.missing('DATASET', _footprint, 40, 60) == []
+    assert _catalog.missing('OTHER', _footprint, 40, 60) == [(40, 60)]
+    assert _catalog.missing('DATASET', ImageCatalog.footprint((10, 45), 50), 40, 60) == [(40, 60)]
+
+
+def test_cover_merges_touching_ranges(tmp_path):
+    _catalog = ImageCatalog(str(tmp_path))
+    _catalog.cover('DATASET', 'here', 10, 20)
+    _catalog.cover('DATASET', 'here', 30, 40)
+    _catalog.cover('DATASET', 'here', 20, 30)
+    assert _catalog.coverage('DATASET', 'here') == [(10, 40)]
+
+
+def test_recent_days_stay_uncovered(tmp_path):
+    _catalog = ImageCatalog(str(tmp_path), settle_days=7)
+    _now = int(time.time() * 1000)
+    _catalog.cover('DATASET', 'here', _now - 30 * DAY_MS, _now)
+    _missing = _catalog.missing('DATASET', 'here', _now - 30 * DAY_MS, _now)
+    assert len(_missing) == 1 and _missing[0][1] == _now
+    assert abs(_missing[0][0] - (_now - 7 * DAY_MS)) < 60000
+
+    _catalog.cover('DATASET', 'here', _now - 3 * DAY_MS, _now)
+    assert _catalog.coverage('DATASET', 'here') == [(_now - 30 * DAY_MS, _missing[0][0])]
+
+
+def test_footprint_keys_include_the_margin():
+    assert ImageCatalog.footprint((10, 45)) == '10.000000,45.000000'
+    assert ImageCatalog.footprint((10, 45), 50) == '10.000000,45.000000,50m'
+
+
+def test_listing_requests_only_uncovered_dates(tmp_path):
+    _requests = []
+
+    def images(dataset, geolocation):
+        return [{'id': f'{_day}', 'time_start': START_MS + _day * DAY_MS} for _day in range(40)]
+
+    class RecordingBackend(LocalBackend):
+
+        def list_images(self, dataset, geolocation, start_ms, end_ms, page_size=1000, margin=0):
+            _requests.append((start_ms, end_ms, margin))
+            return super().list_images(dataset, geolocation, start_ms, end_ms, page_size, margin)
+
+    _catalog = ImageCatalog(str(tmp_path))
+    _gee = PrecorsiaGee('DATASET', (0, 1), margin=50, backend=RecordingBackend(None, images))
+    _first = _gee.list((10, 45), [START_MS, START_MS + 20 * DAY_MS], catalog=_catalog)
+    _second = _gee.list((10, 45), [START_MS + 10 * DAY_MS, START_MS + 30 * DAY_MS], catalog=_catalog)
+
+    assert [_image['id'] for _image in _first] == [f'{_day}' for _day in range(20)]
+    assert [_image['id'] for _image in _second] == [f'{_day}' for _day in range(10, 30)]
+    assert _requests == [(START_MS, START_MS + 20 * DAY_MS, 50), (START_MS + 20 * DAY_MS, START_MS + 30 * DAY_MS, 50)]
+    assert _catalog.coverage('DATASET', ImageCatalog.footprint((10, 45), 50)) == [(START_MS, START_MS + 30 * DAY_MS)]
@@ -0,0 +1,74 @@
+from helpers.imageProcessor import ImageProcessor
+from helpers.tileFormat import write_tile, read_tile
+from helpers.tileStats import TileStats
+import numpy as np
+import pytest
+import os
+
+def write_series(directory, zeros, size=16, seed=0):
+    """
+    @brief Writes a series of uint8 .npy tiles with a given proportion of zero pixels each.
+    @param directory A pathlib.Path where the tiles are written.
+    @param zeros A list with the proportion of zero pixels of every tile.
+    @param size (Optional) The side of the tiles in pixels. Default is 16.
+    @param seed (Optional) The seed of the generated pixels. Default is 0.
+    @return Returns a list of dictionaries representing the images, with 'id', 'time_start' and 'path' keys.
+    """
+    _rng = np.random.default_rng(seed)
+    _images = []
+    for _index, _fraction in enumerate(zeros):
+        _tile = _rng.integers(1, 256, (size, size), dtype=np.uint8)
+        _tile.ravel()[_rng.permutation(size * size)[:round(_fraction * size * size)]] = 0
+        _path = str(directory / f'{_index}.npy')
+        write_tile(_path, _tile)
+        _images.append({'id': str(_index), 'time_start': _index, 'path': _path})
+    return _images
+
+
+ZEROS = [0.5, 0.1, 0.25, 0.9, 0.05, 0.3, 0.7, 0.2, 0.1, 0.4]
+
+PROCESSORS = {
+    'chunks': lambda path: ImageProcessor([], chunk_size=5, filled_dir=str(path / 'filled')),
+    'stats': lambda path: ImageProcessor([], chunk_size=5, stats=TileStats(str(path / 'stats')), filled_dir=str(path / 'filled')),
+    'row_blocks': lambda path: ImageProcessor([], max_pixels=64, filled_dir=str(path / 'filled'))
+}
+
+
+def run_filter(path, kind):
+    """
+    @brief Filters the test series with one kind of processor.
+    @param path A pathlib.Path of a directory of its own.
+    @param kind A key of PROCESSORS.
+    @return Returns a tuple with the kept images and the pixels of the gap-filled copies, in their order.
+    """
+    path.mkdir()
+    _kept = PROCESSORS[kind](path).filter_series(write_series(path, ZEROS), clip_amount=0.33)
+    _filled = [read_tile(_image['path']) for _image in _kept if _image['path'].startswith(str(path / 'filled'))]
+    return _kept, _filled
+
+
+@pytest.mark.parametrize('kind', ['stats', 'row_blocks'])
+def test_every_filter_path_agrees_with_chunks(tmp_path, kind):
+    _kept, _filled = run_filter(tmp_path / 'chunks', 'chunks')
+    _other_kept, _other_filled = run_filter(tmp_path / kind, kind)
+
+    assert [_image['id'] for _image in _kept] == ['1', '2', '4', '5', '7', '8']
+    assert [_image['id'] for _image in _other_kept] == [_image['id'] for _image in _kept]
+    assert [_image['zeros'] for _image in _other_kept] == pytest.approx([_image['zeros'] for _image in _kept])
+    assert len(_filled) == 3
+    for _tile, _other_tile in zip(_filled, _other_filled):
+        np.testing.assert_array_equal(_tile, _other_tile)
+
+
+def test_discard_images_drops_consecutive_images():
+    _zeros_class = [{'id': str(_i), 'zeros': _z} for _i, _z in enumerate([0.5, 0.6, 0.1, 0.9, 0.95, 0.2, 0.8])]
+    _kept = ImageProcessor([]).discard_images(_zeros_class, clip_amount=0.33)
+    assert [_image['id'] for _image in _kept] == ['2', '5']
+    assert len(_zeros_class) == 7
+
+
+def test_hard_delete_removes_discarded_tiles(tmp_path):
+    _images = write_series(tmp_path, [0.5, 0.6, 0.1])
+    _zeros_class = ImageProcessor([]).calculate_zeros(_images)
+    ImageProcessor([]).discard_images(_zeros_class, clip_amount=0.33, hard_delete=True)
+    assert [os.path.exists(_image['path']) for _image in _images] == [False, False, True]
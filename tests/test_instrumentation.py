@@ -0,0 +1,58 @@
+from helpers.instrumentation import Metrics
+import pytest
+
+def measured(labels=None):
+    """
+    @brief Builds metrics with a nested stage and counters.
+    @param labels (Optional) The labels of the metrics. Default is None.
+    @return Returns a Metrics object.
+    """
+    _metrics = Metrics(labels=labels)
+    with _metrics.stage('download'):
+        _metrics.count('bytes_downloaded', 100)
+        with _metrics.stage('decode'):
+            _metrics.count('tiles')
+        _metrics.count('bytes_downloaded', 50)
+    _metrics.count('loose')
+    return _metrics
+
+
+def test_counters_go_to_the_innermost_stage():
+    _stages = measured().to_dict()['stages']
+    assert _stages['download']['counters'] == {'bytes_downloaded': 150}
+    assert _stages['decode']['counters'] == {'tiles': 1}
+    assert _stages['other']['counters'] == {'loose': 1}
+    assert _stages['download']['runs'] == 1 and _stages['download']['seconds'] >= _stages['decode']['seconds']
+
+
+def test_merge_adds_measures():
+    _metrics = measured()
+    _other = measured().to_dict()['stages']
+    _other['filter'] = {'seconds': 2.0, 'runs': 1, 'counters': {'images_kept': 7}}
+    _before = _metrics.to_dict()['stages']
+    _metrics.merge(_other)
+
+    _stages = _metrics.to_dict()['stages']
+    assert _stages['download']['counters'] == {'bytes_downloaded': 300}
+    assert _stages['download']['runs'] == 2
+    assert _stages['download']['seconds'] == pytest.approx(_before['download']['seconds'] + _other['download']['seconds'])
+    assert _stages['filter'] == {'seconds': 2.0, 'runs': 1, 'counters': {'images_kept': 7}}
+    _other['filter']['counters']['images_kept'] = 0
+    assert _stages['filter']['counters'] == {'images_kept': 7}
+
+
+def test_prometheus_text_format(tmp_path):
+    _metrics = Metrics(labels={'dataset': 'A/"B"', 'latitude': 45.5})
+    _metrics.merge({'download': {'seconds': 1.5, 'runs': 2, 'counters': {'bytes-downloaded': 10}}})
+    _path = str(tmp_path / 'metrics.prom')
+    _metrics.write_prometheus(_path)
+
+    with open(_path) as file:
+        assert file.read() == (
+            '# TYPE precorsia_bytes_downloaded gauge\n'
+            'precorsia_bytes_downloaded{dataset="A/\\"B\\"",latitude="45.5",stage="download"} 10.0\n'
+            '# TYPE precorsia_stage_runs gauge\n'
+            'precorsia_stage_runs{dataset="A/\\"B\\"",latitude="45.5",stage="download"} 2.0\n'
+            '# TYPE precorsia_stage_seconds gauge\n'
+            'precorsia_stage_seconds{dataset="A/\\"B\\"",latitude="45.5",stage="download"} 1.5\n')
+    assert sorted(_f.name for _f in tmp_path.iterdir()) == ['metrics.prom']
@@ -0,0 +1,95 @@
+from helpers.lagSearch import LagSearch, DAY_MS
+from helpers.onlineCorrelation import OnlineCorrelation
+import numpy as np
+import pytest
+
+START_MS = 1577836800000
+
+def planted_series(lag, length=400, seed=0):
+    """
+    @brief Builds a daily series and its copy shifted by a known lag: y at t is x at t + lag, plus a little noise.
+    @param lag The planted lag in days.
+    @param length (Optional) The number of days of the series. Default is 400.
+    @param seed (Optional) The seed of the generated data. Default is 0.
+    @return Returns a tuple with the times, the x values and the y values.
+    """
+    _rng = np.random.default_rng(seed)
+    _signal = np.cumsum(_rng.standard_normal(length + 2 * abs(lag)))
+    _x = _signal[abs(lag):abs(lag) + length]
+    _y = _signal[abs(lag) + lag:abs(lag) + lag + length] + 0.01 * _rng.standard_normal(length)
+    return START_MS + np.arange(length) * DAY_MS, _x, _y
+
+
+@pytest.mark.parametrize('lag', [9, -14, 0])
+def test_search_recovers_planted_lag_and_sign(lag):
+    _times, _x, _y = planted_series(lag)
+    _result = LagSearch(step_days=1, max_lag_days=30).search(_times, _x, _times, _y)
+    assert _result.best_lag == lag
+    assert _result.best_lag_days == lag
+    assert _result.best_corr > 0.99
+
+
+def test_correlate_matches_corrcoef_of_the_pairs():
+    _times, _x, _y = planted_series(5, length=120, seed=1)
+    _x[::7] = np.nan
+    _y[3::11] = np.nan
+    _search = LagSearch(step_days=1, max_lag_days=20)
+    _result = _search.search(_times, _x, _times, _y)
+
+    for _index, _lag in enumerate(_result.lags):
+        _pairs = np.array(_result.pairs(int(_lag)))
+        assert _result.counts[_index] == len(_pairs)
+        assert _result.corr[_index] == pytest.approx(np.corrcoef(_pairs[:, 0], _pairs[:, 1])[0, 1], abs=1e-12)
+
+
+def test_moments_and_pearson_agree_with_correlate():
+    _rng = np.random.default_rng(2)
+    _x = _rng.standard_normal((3, 64))
+    _y = _rng.standard_normal((3, 64))
+    _x[_rng.random(_x.shape) < 0.2] = np.nan
+    _search = LagSearch()
+
+    _lags, _corr, _counts = _search.correlate(_x, _y, 10)
+    _moment_lags, _moments, _ = _search.moments(_x, _y, 10)
+    np.testing.assert_array_equal(_lags, _moment_lags)
+    np.testing.assert_array_equal(_counts, _moments[0].astype(int))
+    np.testing.assert_array_equal(np.isnan(_corr), np.isnan(_search.pearson(_moments)))
+    np.testing.assert_allclose(_corr, _search.pearson(_moments), equal_nan=True)
+
+
+def test_online_update_matches_full_recompute():
+    _times, _x, _y = planted_series(6, length=200, seed=3)
+    _search = LagSearch(step_days=1)
+    _online = OnlineCorrelation.build(_search, _times[50:150], _x[50:150], _y[50:150], max_lag=25)
+
+    # New days after the end, a changed day, a removed day and new days before the start, which extend the grid.
+    _pairs = {int(_t): (_a, _b) for _t, _a, _b in zip(_times[50:150], _x[50:150], _y[50:150])}
+    _removed = [(_times[80], *_pairs[int(_times[80])]), (_times[90], *_pairs[int(_times[90])])]
+    _added = [(_t, _a, _b) for _t, _a, _b in zip(_times[150:170], _x[150:170], _y[150:170])]
+    _added += [(_times[80], 2.0, -1.0)] + [(_t, _a, _b) for _t, _a, _b in zip(_times[30:50], _x[30:50], _y[30:50])]
+    _online.update(_removed, _added)
+
+    for _time, _a, _b in _removed:
+        del _pairs[int(_time)]
+    _pairs.update((int(_t), (_a, _b)) for _t, _a, _b in _added)
+    _final = sorted(_pairs.items())
+    _expected = OnlineCorrelation.build(_search, [_t for _t, _ in _final], [_v[0] for _, _v in _final],
+                                        [_v[1] for _, _v in _final], max_lag=25).result()
+    _result = _online.result()
+
+    np.testing.assert_array_equal(_result.lags, _expected.lags)
+    np.testing.assert_array_equal(_result.counts, _expected.counts)
+    np.testing.assert_allclose(_result.corr, _expected.corr, atol=1e-12, equal_nan=True)
+    assert _result.best_lag == _expected.best_lag
+
+
+def test_online_build_matches_search_and_round_trips():
+    _times, _x, _y = planted_series(-4, length=150, seed=4)
+    _search = LagSearch(step_days=1)
+    _full = _search.search(_times, _x, _times, _y)
+    _online = OnlineCorrelation.build(_search, _times, _x, _y, max_lag=int(_full.lags.max()))
+    np.testing.assert_allclose(_online.result().corr, _full.corr, atol=1e-12, equal_nan=True)
+
+    _restored = OnlineCorrelation.from_dict(_online.to_dict())
+    np.testing.assert_array_equal(_restored.result().corr, _online.result().corr)
+    assert _restored.origin == _online.origin
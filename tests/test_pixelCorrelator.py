@@ -0,0 +1,66 @@
+from helpers.pixelCorrelator import PixelCorrelator, BANDS
+from helpers.lagSearch import LagSearch, DAY_MS
+from helpers.tileFormat import write_tile
+import numpy as np
+import pytest
+
+START_MS = 1577836800000
+LAGS = np.array([[0, 3, -4, 7], [-2, 5, 1, -6], [4, -1, 2, 6]])
+
+def planted_stacks(directory, length=120, nodata=0.1, seed=0):
+    """
+    @brief Writes daily raw tiles of two series where every pixel has its own planted lag: the comparable pixel at t is
+    the reference pixel at t + lag. Pixel (0, 0) of the comparable holds no data at all, the others miss a few days.
+    @param directory A pathlib.Path where the tiles are written.
+    @param length (Optional) The number of days. Default is 120.
+    @param nodata (Optional) The proportion of nodata pixels of every tile. Default is 0.1.
+    @param seed (Optional) The seed of the generated data. Default is 0.
+    @return Returns a tuple with the pairs, their times, the tile paths and the (T, H, W) validity of both series.
+    """
+    _rng = np.random.default_rng(seed)
+    _margin = np.abs(LAGS).max()
+    _signal = np.cumsum(_rng.standard_normal((length + 2 * _margin,) + LAGS.shape), axis=0)
+    _rows, _cols = np.indices(LAGS.shape)
+    _x = _signal[_margin:_margin + length]
+    _y = _signal[_margin + LAGS + np.arange(length)[:, None, None], _rows, _cols]
+    _x[_rng.random(_x.shape) < nodata] = np.nan
+    _y[_rng.random(_y.shape) < nodata] = np.nan
+    _y[:, 0, 0] = np.nan
+
+    _tiles = ({}, {})
+    for _day in range(length):
+        for _side, _series in enumerate((_x, _y)):
+            _tiles[_side][str(_day)] = str(directory / f'{_side}_{_day}.npy')
+            write_tile(_tiles[_side][str(_day)], _series[_day], raw=True)
+    _pairs = [([str(_day)], [str(_day)]) for _day in range(length)]
+    return _pairs, [START_MS + _day * DAY_MS for _day in range(length)], _tiles, (~np.isnan(_x), ~np.isnan(_y))
+
+
+def test_pixel_maps_recover_planted_lags(tmp_path):
+    _pairs, _times, _tiles, (_x_valid, _y_valid) = planted_stacks(tmp_path)
+    _path = PixelCorrelator(_pairs, _times, _tiles, LagSearch(step_days=1), max_lag=10, stack_dir=str(tmp_path / 'stacks')).compute(
+        str(tmp_path / 'maps.npz'))
+
+    with np.load(_path) as _maps:
+        assert set(_maps.files) == set(BANDS) | {'lags_days'}
+        np.testing.assert_array_equal(_maps['lags_days'], np.arange(-10, 11))
+        np.testing.assert_array_equal(_maps['counts'], (_x_valid & _y_valid).sum(axis=0))
+        assert _maps['counts'][0, 0] == 0
+        assert np.isnan(_maps['best_lag_days'][0, 0]) and np.isnan(_maps['best_correlation'][0, 0])
+
+        _planted = np.ones(LAGS.shape, dtype=bool)
+        _planted[0, 0] = False
+        np.testing.assert_array_equal(_maps['best_lag_days'][_planted], LAGS[_planted])
+        assert (_maps['best_correlation'][_planted] > 0.9).all()
+
+
+@pytest.mark.parametrize('max_workers', [0, 2])
+def test_row_blocks_do_not_change_the_maps(tmp_path, max_workers):
+    _pairs, _times, _tiles, _ = planted_stacks(tmp_path)
+    _whole = PixelCorrelator(_pairs, _times, _tiles, LagSearch(step_days=1), max_lag=10, stack_dir=str(tmp_path / 'stacks'))
+    _blocks = PixelCorrelator(_pairs, _times, _tiles, LagSearch(step_days=1), max_lag=10, stack_dir=str(tmp_path / 'stacks'),
+                              max_values=300, max_workers=max_workers)
+
+    with np.load(_whole.compute(str(tmp_path / 'whole.npz'))) as _expected, np.load(_blocks.compute(str(tmp_path / 'blocks.npz'))) as _maps:
+        for _band in BANDS:
+            np.testing.assert_allclose(_maps[_band], _expected[_band], rtol=1e-6)
@@ -0,0 +1,63 @@
+from helpers.plotRenderer import PlotRenderer
+from helpers.precorsiaFilter import PrecorsiaFilter
+import os
+
+TITLE = {'title': 'Correlation', 'xlabel': 'x', 'ylabel': 'y'}
+POINTS = [(1.0, 2.0), (2.0, 3.5), (3.0, 2.5)]
+
+def test_unchanged_figures_are_not_rendered_again(tmp_path):
+    _renderer = PlotRenderer(str(tmp_path), max_workers=0)
+    _path = _renderer.path('figure.png')
+    _renderer.emit(_path, POINTS, TITLE)
+    assert _renderer.render() == [_path]
+    _mtime = os.stat(_path).st_mtime_ns
+
+    _renderer.emit(_path, POINTS, TITLE)
+    assert _renderer.pending() == []
+    assert _renderer.render() == []
+    assert os.stat(_path).st_mtime_ns == _mtime
+
+    _renderer.emit(_path, POINTS + [(4.0, 1.0)], TITLE)
+    assert _renderer.render() == [_path]
+    os.remove(_path)
+    assert _renderer.render() == [_path]
+
+
+def test_render_is_restricted_to_the_given_figures(tmp_path):
+    _renderer = PlotRenderer(str(tmp_path), max_workers=0)
+    _paths = [_renderer.path(f'{_name}.png') for _name in ('one', 'two')]
+    for _path in _paths:
+        _renderer.emit(_path, POINTS, TITLE)
+    assert _renderer.render(_paths[1:]) == _paths[1:]
+    assert [_spec['path'] for _, _spec in _renderer.pending()] == _paths[:1]
+
+
+def test_failures_are_recorded_and_retried(tmp_path):
+    _renderer = PlotRenderer(str(tmp_path), max_workers=0)
+    _path = str(tmp_path / 'missing' / 'figure.png')
+    _renderer.emit(_path, POINTS, TITLE)
+    assert _renderer.render() == []
+    assert len(_renderer.pending()) == 1
+
+    os.makedirs(tmp_path / 'missing')
+    assert _renderer.render() == [_path]
+
+
+def test_deferred_figures_wait_for_render(synthetic, tmp_path):
+    _renderer = PlotRenderer(str(tmp_path / 'plots'), max_workers=0)
+    _precorsia = PrecorsiaFilter(synthetic({'images': 40}, mode='reduce', render='deferred', plot_renderer=_renderer))
+    _precorsia.execute()
+
+    _pending = sorted(_spec['path'] for _, _spec in _renderer.pending())
+    assert len(_pending) == 2 and _pending[0].endswith('_normal.jpg') and _pending[1].endswith('_shifted.jpg')
+    assert not any(os.path.exists(_path) for _path in _pending)
+    assert sorted(_renderer.render()) == _pending
+    assert all(os.path.exists(_path) for _path in _pending)
+
+
+def test_inline_figures_are_rendered_by_the_run(synthetic, tmp_path):
+    _renderer = PlotRenderer(str(tmp_path / 'plots'), max_workers=0)
+    _precorsia = PrecorsiaFilter(synthetic({'images': 40}, mode='reduce', render='inline', plot_renderer=_renderer))
+    _precorsia.execute()
+    assert _renderer.pending() == []
+    assert len([_name for _name in os.listdir(tmp_path / 'plots') if _name.endswith('.jpg')]) == 2
@@ -0,0 +1,34 @@
+from helpers.precorsiaFilter import PrecorsiaFilter
+from helpers.tileFormat import read_tile, tile_mean, tile_zeros
+import pytest
+
+def download(configuration):
+    """
+    @brief Lists and downloads the images of a configuration.
+    @param configuration A PrecorsiaFilter configuration.
+    @return Returns a tuple with the PrecorsiaFilter and its listed images of both datasets.
+    """
+    _precorsia = PrecorsiaFilter(configuration)
+    _precorsia.prepare()
+    _precorsia.list_stage()
+    _precorsia.download_stage()
+    return _precorsia, _precorsia.gds_one_list + _precorsia.gds_two_list
+
+
+def test_reduce_mode_agrees_with_tiles_mode(synthetic):
+    _tiles, _tile_images = download(synthetic({'tile_format': 'raw', 'images': 80}, mode='tiles', buffer_dir='./tiles/'))
+    _reduce, _reduced_images = download(synthetic({'tile_format': 'raw', 'images': 80}, mode='reduce', buffer_dir='./reduce/'))
+
+    assert [_image['id'] for _image in _reduced_images] == [_image['id'] for _image in _tile_images]
+    for _tile_image, _reduced_image in zip(_tile_images, _reduced_images):
+        _tile = read_tile(_tile_image['path'])
+        assert _reduced_image['zeros'] == tile_zeros(_tile)
+        # Raw tiles hold float32 values, the server reduces the float64 band values.
+        assert _reduced_image['mean'] == pytest.approx(tile_mean(_tile), rel=1e-6)
+
+    for _precorsia in (_tiles, _reduce):
+        _precorsia.filter_stage()
+        _precorsia.correlate_stage()
+    assert len(_reduce.corr_avr) == len(_tiles.corr_avr)
+    assert _reduce.best_shift == _tiles.best_shift
+    assert _reduce.best_corr == pytest.approx(_tiles.best_corr, abs=1e-4)
@@ -0,0 +1,79 @@
+from helpers.resultsStore import ResultsStore
+from helpers.sqliteIndex import connect
+import pytest
+import os
+
+RUNS = [
+    {'reference_dataset': 'REFERENCE', 'comparable_dataset': 'A', 'climate': 'Af', 'best_correlation': 0.9, 'best_shift': 3},
+    {'reference_dataset': 'REFERENCE', 'comparable_dataset': 'A', 'climate': 'BWh', 'best_correlation': 0.5, 'best_shift': -2},
+    {'reference_dataset': 'REFERENCE', 'comparable_dataset': 'B', 'climate': 'Af', 'best_correlation': 0.7, 'best_shift': 0},
+    {'reference_dataset': 'REFERENCE', 'comparable_dataset': 'B', 'climate': None, 'best_correlation': 0.1, 'best_shift': 8}
+]
+
+@pytest.fixture
+def store(tmp_path):
+    """
+    @brief Builds a store holding the runs of RUNS.
+    """
+    _store = ResultsStore(str(tmp_path))
+    for _run in RUNS:
+        _store.add_run(_run)
+    return _store
+
+
+def test_old_databases_are_migrated(tmp_path):
+    _path = os.path.join(str(tmp_path), 'results.sqlite')
+    with connect(_path) as _db:
+        _db.execute('CREATE TABLE runs (run_id INTEGER PRIMARY KEY AUTOINCREMENT, created REAL NOT NULL, reference_dataset TEXT NOT NULL, '
+                    'comparable_dataset TEXT NOT NULL, best_correlation REAL, best_shift REAL)')
+        _db.execute("INSERT INTO runs (created, reference_dataset, comparable_dataset, best_correlation, best_shift) "
+                    "VALUES (1.0, 'REFERENCE', 'A', 0.8, 4)")
+
+    _store = ResultsStore(str(tmp_path))
+    with connect(_path) as _db:
+        assert {_row[1] for _row in _db.execute('PRAGMA table_info(runs)')} == set(ResultsStore.RUN_COLUMNS)
+    assert _store.runs(['comparable_dataset', 'best_shift', 'mode', 'metrics']) == [
+        {'comparable_dataset': 'A', 'best_shift': 4, 'mode': None, 'metrics': None}]
+
+    _run_id = _store.add_run({'reference_dataset': 'REFERENCE', 'comparable_dataset': 'B', 'mode': 'reduce', 'map_file': 'map.npz'})
+    assert _store.runs(['mode', 'map_file'], run_id=_run_id) == [{'mode': 'reduce', 'map_file': 'map.npz'}]
+    ResultsStore(str(tmp_path))
+    assert len(_store.runs()) == 2
+
+
+def test_where_builds_equality_list_and_null_clauses():
+    assert ResultsStore.where(ResultsStore.RUN_COLUMNS, {}) == ('', [])
+    assert ResultsStore.where(ResultsStore.RUN_COLUMNS, {'climate': 'Af', 'comparable_dataset': ['A', 'B'], 'mode': None}) == (
+        ' WHERE climate = ? AND comparable_dataset IN (?,?) AND mode IS NULL', ['Af', 'A', 'B'])
+    with pytest.raises(ValueError):
+        ResultsStore.where(ResultsStore.RUN_COLUMNS, {'climate; DROP TABLE runs': 'Af'})
+
+
+def test_runs_are_filtered(store):
+    assert [_r['best_shift'] for _r in store.runs(['best_shift'], climate='Af')] == [3, 0]
+    assert [_r['best_shift'] for _r in store.runs(['best_shift'], climate=None)] == [8]
+    assert [_r['best_shift'] for _r in store.runs(['best_shift'], order_by='best_correlation', limit=2, comparable_dataset=['A', 'B'])] == [8, -2]
+
+
+def test_aggregate_groups_runs(store):
+    assert store.aggregate('comparable_dataset') == [
+        {'comparable_dataset': 'A', 'count_best_correlation': 2, 'avg_best_correlation': pytest.approx(0.7),
+         'min_best_correlation': 0.5, 'max_best_correlation': 0.9},
+        {'comparable_dataset': 'B', 'count_best_correlation': 2, 'avg_best_correlation': pytest.approx(0.4),
+         'min_best_correlation': 0.1, 'max_best_correlation': 0.7}]
+    assert store.aggregate(['comparable_dataset', 'climate'], 'best_shift', ('sum',), climate='Af') == [
+        {'comparable_dataset': 'A', 'climate': 'Af', 'sum_best_shift': 3},
+        {'comparable_dataset': 'B', 'climate': 'Af', 'sum_best_shift': 0}]
+    with pytest.raises(ValueError):
+        store.aggregate('climate', functions=('median',))
+    with pytest.raises(ValueError):
+        store.aggregate('unknown')
+
+
+def test_pairs_are_stored_with_their_run(store):
+    _run_id = store.add_run(RUNS[0], [{'time_start': 10, 'reference_ids': ['a', 'b'], 'comparable_ids': ['c'], 'reference_value': 1.5},
+                                      {'time_start': 20, 'reference_ids': ['d'], 'comparable_ids': ['e', 'f']}])
+    _pairs = store.pairs(_run_id)
+    assert [(_p['pair_index'], _p['reference_ids'], _p['comparable_ids']) for _p in _pairs] == [(0, ['a', 'b'], ['c']), (1, ['d'], ['e', 'f'])]
+    assert _pairs[0]['reference_value'] == 1.5 and _pairs[1]['reference_value'] is None
+    assert store.pairs(1) == []
@@ -0,0 +1,116 @@
+from benchmarks.pipelineBenchmark import START_MS, REFERENCE, COMPARABLE
+from benchmarks.syntheticBackend import SyntheticBackend, SyntheticDate
+from helpers.precorsiaFilter import PrecorsiaFilter
+from helpers.instrumentation import Metrics
+from helpers.sweepRunner import SweepRunner
+from helpers.geeApi import PrecorsiaGee
+import pytest
+import json
+
+IMAGES = 40
+
+class SyntheticGee(PrecorsiaGee):
+    """
+    @brief PrecorsiaGee served by a SyntheticBackend, defined at module level so sweep stages can be sent to worker processes.
+    """
+    backend = SyntheticBackend(START_MS, image_count=IMAGES, cadence_days={REFERENCE: 1}, tile_size=16)
+    date_daily = staticmethod(SyntheticDate.daily)
+
+
+class BrokenGee(SyntheticGee):
+    """
+    @brief SyntheticGee whose listings always fail.
+    """
+
+    def list(self, *args, **kwargs):
+        raise ValueError('listing failed')
+
+
+def sweep_configurations(synthetic, comparables, gee=SyntheticGee, **keys):
+    """
+    @brief Builds one configuration per comparable dataset, sharing the synthetic reference.
+    @param synthetic The synthetic fixture.
+    @param comparables A list of comparable dataset IDs.
+    @param gee (Optional) The PrecorsiaGee class of the configurations. Default is SyntheticGee.
+    @return Returns a list of configuration dictionaries.
+    """
+    return [synthetic({'images': IMAGES}, gee=gee, comparable_dataset=_dataset, **keys) for _dataset in comparables]
+
+
+def finished(runner):
+    """
+    @brief Reads when every stage of a sweep finished.
+    @param runner The SweepRunner.
+    @return Returns a dictionary mapping stage keys to their finish time.
+    """
+    with open(runner.manifest_path) as file:
+        return {_key: _record['finished'] for _key, _record in json.load(file).items()}
+
+
+def test_stage_keys_ignore_field_order():
+    assert SweepRunner.stage_key('list', {'a': 1, 'b': [1, 2]}) == SweepRunner.stage_key('list', {'b': [1, 2], 'a': 1})
+    assert SweepRunner.stage_key('list', {'a': 1}) != SweepRunner.stage_key('download', {'a': 1})
+    assert SweepRunner.stage_key('list', {'a': 1}) != SweepRunner.stage_key('list', {'a': 2})
+
+
+def test_shared_stages_are_built_once(synthetic):
+    _runner = SweepRunner(sweep_configurations(synthetic, [COMPARABLE, 'SYNTHETIC/OTHER']))
+    _kinds = [_stage['kind'] for _stage in _runner.stages.values()]
+    assert {_kind: _kinds.count(_kind) for _kind in set(_kinds)} == {'list': 3, 'download': 3, 'filter': 2, 'correlate': 2}
+
+    _again = SweepRunner(sweep_configurations(synthetic, [COMPARABLE, COMPARABLE]))
+    assert len(_again.stages) == 6 and _again.jobs[0] == _again.jobs[1]
+
+
+def test_sweep_matches_separate_runs_and_resumes(synthetic):
+    _configurations = sweep_configurations(synthetic, [COMPARABLE, 'SYNTHETIC/OTHER'])
+    _runner = SweepRunner(_configurations, max_workers=2)
+    _files = _runner.run()
+    assert _runner.failed == {}
+    for _configuration, _file in zip(_configurations, _files):
+        with open(_file) as file:
+            _result = json.load(file)
+        _precorsia = PrecorsiaFilter(_configuration)
+        _precorsia.execute()
+        assert (_result['best_shift'], _result['best_correlation']) == (_precorsia.best_shift, _precorsia.best_corr)
+
+    _finished = finished(_runner)
+    _resumed = SweepRunner(_configurations, max_workers=2)
+    assert _resumed.run() == _files
+    assert finished(_resumed) == _finished
+
+    _manifest = _runner.load_manifest()
+    del _manifest[_runner.jobs[1]]
+    _runner.save_manifest(_manifest)
+    _resumed.run()
+    assert {_key for _key, _time in finished(_resumed).items() if _time != _finished[_key]} == {_runner.jobs[1]}
+
+
+def test_failed_stages_skip_their_dependents_only(synthetic):
+    _configurations = sweep_configurations(synthetic, [COMPARABLE]) + sweep_configurations(synthetic, ['SYNTHETIC/OTHER'], gee=BrokenGee)
+    _runner = SweepRunner(_configurations, max_workers=2)
+    _files = _runner.run()
+    assert _files[0] is not None and _files[1] is None
+
+    _broken = _runner.lineage(_runner.jobs[1])
+    assert set(_runner.failed) == _broken
+    assert sorted(_runner.failed[_key] for _key in _broken if _runner.stages[_key]['kind'] != 'list') == ['dependency failed'] * 4
+    assert all('listing failed' in _runner.failed[_key] for _key in _broken if _runner.stages[_key]['kind'] == 'list')
+
+
+@pytest.mark.parametrize('key', SweepRunner.UNSUPPORTED_KEYS)
+def test_unsupported_configurations_are_rejected(synthetic, key):
+    with pytest.raises(ValueError, match=key):
+        SweepRunner(sweep_configurations(synthetic, [COMPARABLE], **{key: True}))
+
+
+def test_configuration_metrics_stay_in_the_parent(synthetic):
+    _configurations = sweep_configurations(synthetic, [COMPARABLE], metrics=Metrics())
+    _runner = SweepRunner(_configurations, max_workers=2)
+    assert all('metrics' not in _stage['config'] for _stage in _runner.stages.values())
+
+    assert _runner.run()[0] is not None
+    _stages = _configurations[0]['metrics'].to_dict()['stages']
+    assert {'list', 'download', 'filter', 'correlate'} <= set(_stages)
+    assert _stages['list']['runs'] == 2
+    assert _runner.metrics.to_dict()['stages']['correlate']['runs'] == 1
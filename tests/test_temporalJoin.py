@@ -0,0 +1,60 @@
+from helpers.temporalJoin import TemporalJoin
+from helpers.geeApi import PrecorsiaGee
+import numpy as np
+import pytest
+
+def random_images(count, seed, prefix):
+    """
+    @brief Builds a list of images at random times, in random order, several sharing a time.
+    @param count The number of images.
+    @param seed The seed of the generated times.
+    @param prefix A string starting every image ID.
+    @return Returns a list of dictionaries with 'id' and 'time_start' keys.
+    """
+    _rng = np.random.default_rng(seed)
+    _times = 1577836800000 + _rng.integers(0, 200, count) * 3600000 * 7
+    return [{'id': f'{prefix}{_i}', 'time_start': int(_t)} for _i, _t in enumerate(_times)]
+
+
+def scan_dates(list_one, list_two, round_factor):
+    """
+    @brief The membership scan correlate_dates used before TemporalJoin.
+    """
+    _one_rounded = [_img['time_start'] // 10**round_factor * 10**round_factor for _img in list_one]
+    _two_rounded = [_img['time_start'] // 10**round_factor * 10**round_factor for _img in list_two]
+    _common_rounded = np.intersect1d(_one_rounded, _two_rounded)
+    return ([img for img in list_one if img['time_start'] // 10**round_factor * 10**round_factor in _common_rounded],
+            [img for img in list_two if img['time_start'] // 10**round_factor * 10**round_factor in _common_rounded])
+
+
+def scan_pairs(list_one, list_two, round_factor):
+    """
+    @brief The membership scan connected_correlation used before TemporalJoin, sorted by time.
+    """
+    _one_rounded = [_img['time_start'] // 10**round_factor * 10**round_factor for _img in list_one]
+    _two_rounded = [_img['time_start'] // 10**round_factor * 10**round_factor for _img in list_two]
+    _pairs = []
+    for rounded_val in sorted(set(_one_rounded).intersection(set(_two_rounded))):
+        one_ids = [img['id'] for img in list_one if img['time_start'] // 10**round_factor * 10**round_factor == rounded_val]
+        two_ids = [img['id'] for img in list_two if img['time_start'] // 10**round_factor * 10**round_factor == rounded_val]
+        _pairs.append((rounded_val, (one_ids, two_ids)))
+    return _pairs
+
+
+@pytest.mark.parametrize('round_factor', [7, 8, 9])
+def test_buckets_match_the_membership_scan(round_factor):
+    _one, _two = random_images(150, 0, 'a'), random_images(120, 1, 'b')
+    _join = TemporalJoin.buckets(_one, _two, 10**round_factor)
+
+    assert (_join.one, _join.two) == scan_dates(_one, _two, round_factor)
+    assert PrecorsiaGee.correlate_dates(_one, _two, round_factor) == scan_dates(_one, _two, round_factor)
+    assert list(zip(_join.times, _join.pairs)) == scan_pairs(_one, _two, round_factor)
+    assert PrecorsiaGee.connected_correlation(_one, _two, round_factor) == [_pair for _, _pair in scan_pairs(_one, _two, round_factor)]
+
+
+def test_buckets_of_disjoint_or_empty_lists_are_empty():
+    _one = [{'id': 'a', 'time_start': 0}]
+    _two = [{'id': 'b', 'time_start': 10**9}]
+    for _lists in ((_one, _two), (_one, []), ([], _two)):
+        _join = TemporalJoin.buckets(*_lists, 10**8)
+        assert (_join.one, _join.two, _join.pairs, _join.times) == ([], [], [], [])
@@ -0,0 +1,93 @@
+from helpers.tileCache import TileCache, atomic_save
+from helpers.imageProcessor import ImageProcessor
+from helpers.tileFormat import write_tile, read_tile
+import numpy as np
+import pytest
+import time
+import os
+
+def write_bytes(size):
+    """
+    @brief Builds a writer filling a file with a given number of bytes.
+    @param size The number of bytes.
+    @return Returns a callable receiving the path to write to.
+    """
+    def writer(path):
+        with open(path, 'wb') as file:
+            file.write(b'x' * size)
+    return writer
+
+
+def test_keys_differ_for_the_same_image_at_two_locations():
+    _here = TileCache.key('DATASET', 'IMAGE', 'band', (10.0, 45.0), 5120, (0, 1))
+    _there = TileCache.key('DATASET', 'IMAGE', 'band', (11.0, 45.0), 5120, (0, 1))
+    assert _here != _there
+    assert _here == TileCache.key('DATASET', 'IMAGE', 'band', [10, 45], 5120.0, [0.0, 1.0])
+
+
+def test_hits_and_misses_are_counted(tmp_path):
+    _cache = TileCache(str(tmp_path))
+    assert _cache.get('a' * 40) is None
+    _path = _cache.put('a' * 40, write_bytes(10))
+    assert _cache.get('a' * 40) == _path
+    assert _cache.get('b' * 40) is None
+    assert _cache.stats() == {'hits': 1, 'misses': 2, 'entries': 1, 'bytes': 10}
+
+
+def test_a_failed_write_leaves_no_file(tmp_path):
+    _target = str(tmp_path / 'tile.png')
+    atomic_save(_target, write_bytes(4))
+
+    def failing(path):
+        write_bytes(8)(path)
+        raise RuntimeError('interrupted')
+
+    with pytest.raises(RuntimeError):
+        atomic_save(_target, failing)
+    assert os.path.getsize(_target) == 4
+    assert os.listdir(tmp_path) == ['tile.png']
+
+
+def test_evict_removes_least_recently_used_first_and_only_when_asked(tmp_path):
+    _cache = TileCache(str(tmp_path), max_bytes=25)
+    _paths = {}
+    for _key in 'abc':
+        _paths[_key] = _cache.put(_key * 40, write_bytes(10))
+        time.sleep(0.01)
+    _cache.get('a' * 40)
+
+    assert all(os.path.exists(_path) for _path in _paths.values())
+    _cache.evict()
+    assert not os.path.exists(_paths['b'])
+    assert os.path.exists(_paths['a']) and os.path.exists(_paths['c'])
+    assert _cache.stats()['bytes'] == 20
+
+
+def test_filled_copies_count_toward_max_bytes(tmp_path):
+    _cache = TileCache(str(tmp_path), max_bytes=1)
+    _images = []
+    for _index in range(3):
+        _tile = np.full((4, 4), 100 + _index, dtype=np.uint8)
+        _tile[_index] = 0
+        _path = _cache.put(f'{_index}' * 40, lambda path: write_tile(path, _tile), 'npy')
+        _images.append({'id': str(_index), 'time_start': _index, 'path': _path})
+
+    _processor = ImageProcessor([_images], filled_dir=str(tmp_path / 'filled'), cache=_cache)
+    _kept = _processor.zero_counting_filter(clip_amount=0.5)[0]
+    _filled = [_image['path'] for _image in _kept]
+    assert all(_path.startswith(str(tmp_path / 'filled')) for _path in _filled)
+    assert _cache.stats()['entries'] == 6
+    assert (read_tile(_filled[1]) > 0).all()
+
+    _cache.evict()
+    assert _cache.stats()['entries'] == 0
+    assert not any(os.path.exists(_path) for _path in _filled)
+
+
+def test_hard_delete_goes_through_the_cache(tmp_path):
+    _cache = TileCache(str(tmp_path))
+    _path = _cache.put('d' * 40, write_bytes(10))
+    _processor = ImageProcessor([], cache=_cache)
+    assert _processor.discard_images([{'id': 'd', 'path': _path, 'zeros': 0.9}], hard_delete=True) == []
+    assert not os.path.exists(_path)
+    assert _cache.stats()['entries'] == 0
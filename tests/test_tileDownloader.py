@@ -0,0 +1,81 @@
+from helpers.tileDownloader import TileDownloader, TokenBucket
+import threading
+import pytest
+import time
+
+class Flaky:
+
+    def __init__(self, failures, error=ConnectionError):
+        """
+        @brief Constructor for the Flaky class, a callable failing a given number of times before returning its argument.
+        @param failures The number of calls raising error.
+        @param error (Optional) The exception class raised. Default is ConnectionError.
+        """
+        self.failures = failures
+        self.error = error
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, item):
+        with self.lock:
+            self.calls += 1
+            _failing = self.calls <= self.failures
+        if _failing:
+            raise self.error('failure')
+        return item
+
+
+def test_transient_failures_are_retried_with_backoff():
+    _fn = Flaky(2)
+    _start = time.monotonic()
+    assert TileDownloader(concurrency=1, retries=3, backoff=0.05).call(_fn, 'tile') == 'tile'
+    assert _fn.calls == 3
+    assert time.monotonic() - _start >= 0.05 * 0.5 + 0.1 * 0.5
+
+
+def test_retries_are_bounded():
+    _fn = Flaky(10)
+    with pytest.raises(ConnectionError):
+        TileDownloader(retries=2, backoff=0.001).call(_fn, 'tile')
+    assert _fn.calls == 3
+
+
+def test_fatal_failures_are_not_retried():
+    _fn = Flaky(1, ValueError)
+    with pytest.raises(ValueError):
+        TileDownloader(retries=3, backoff=0.001).call(_fn, 'tile')
+    assert _fn.calls == 1
+
+
+def test_first_fatal_failure_cancels_the_rest():
+    _started = []
+
+    def fetch(item):
+        _started.append(item)
+        if item == 0:
+            raise ValueError('not found')
+        time.sleep(0.01)
+        return item
+
+    with pytest.raises(ValueError):
+        TileDownloader(concurrency=2, retries=3).map(fetch, list(range(50)))
+    assert len(_started) < 10
+
+
+def test_map_keeps_the_order_of_items():
+    _items = list(range(20))
+    assert TileDownloader(concurrency=4).map(lambda item: item * 2, _items) == [_item * 2 for _item in _items]
+
+
+def test_token_bucket_limits_the_rate():
+    _bucket = TokenBucket(20, capacity=1)
+    _start = time.monotonic()
+    for _ in range(11):
+        _bucket.acquire()
+    assert time.monotonic() - _start >= 0.45
+
+
+def test_downloader_rate_allows_a_burst_then_throttles():
+    _start = time.monotonic()
+    TileDownloader(concurrency=4, rate=10).map(lambda item: item, list(range(15)))
+    assert time.monotonic() - _start >= 0.4
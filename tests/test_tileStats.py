@@ -0,0 +1,36 @@
+from helpers.tileStats import TileStats
+from helpers.tileFormat import write_tile
+from helpers.sqliteIndex import connect
+import numpy as np
+import pytest
+import os
+
+def test_statistics_are_recorded_once(tmp_path):
+    _stats = TileStats(str(tmp_path))
+    _path = str(tmp_path / 'tile.npy')
+    write_tile(_path, np.array([[0, 10], [20, 30]], dtype=np.uint8))
+
+    _first = _stats.lookup([_path])[0]
+    assert _first['zeros'] == 0.25
+    assert (_first['min'], _first['max']) == (10, 30)
+    with connect(_stats.index_path) as _db:
+        _db.execute('UPDATE stats SET mean = -1 WHERE path = ?', (_path,))
+    assert _stats.column([_path], 'mean')[0] == -1
+
+
+@pytest.mark.parametrize('same_size', [True, False])
+def test_rewritten_tiles_are_not_served_stale_statistics(tmp_path, same_size):
+    _stats = TileStats(str(tmp_path))
+    _path = str(tmp_path / 'tile.npy')
+    write_tile(_path, np.full((4, 4), 10, dtype=np.uint8))
+    assert _stats.column([_path], 'mean')[0] == pytest.approx(10)
+    _stat = os.stat(_path)
+
+    write_tile(_path, np.full((4, 4) if same_size else (4, 8), 50, dtype=np.uint8))
+    # A rewrite of the same size is caught by the modification time, a rewrite keeping the modification time by the size.
+    if same_size:
+        os.utime(_path, ns=(_stat.st_atime_ns, _stat.st_mtime_ns + 1000))
+    else:
+        os.utime(_path, ns=(_stat.st_atime_ns, _stat.st_mtime_ns))
+    assert _stats.column([_path], 'mean')[0] == pytest.approx(50)
+    assert _stats.column([_path], 'mean')[0] == pytest.approx(50)